@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+from contextlib import contextmanager
+from datetime import date, timedelta
+import argparse
+import json
+import logging
+import os.path
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import slice
+
+
+# records the wall time, and optionally the peak traced memory, of consecutive phases
+class PhaseRecorder:
+  def __init__(self, trace_memory):
+    self.trace_memory = trace_memory
+    self.phases = {}
+    self.__name = None
+    self.__start = None
+
+  def start(self, name):
+    self.stop()
+    if self.trace_memory:
+      tracemalloc.reset_peak()
+    self.__name = name
+    self.__start = time.perf_counter()
+
+  def stop(self):
+    if self.__name is None:
+      return
+    phase = {"seconds": time.perf_counter() - self.__start}
+    if self.trace_memory:
+      current, peak = tracemalloc.get_traced_memory()
+      phase["peak_bytes"] = peak
+      phase["retained_bytes"] = current
+    self.phases[self.__name] = phase
+    self.__name = None
+
+
+# holds todo.txt and the slice file in memory, and edits the slice with a script rather than $EDITOR
+class BenchTodoEnv(slice.AbstractTodoEnv):
+  __todo_dir_path = "TODO"
+  __todo_file_path = os.path.join(__todo_dir_path, "todo.txt")
+  __edit_dir_path = "EDIT"
+
+  def __init__(self, todo_lines, today, edit_script, recorder):
+    slice.AbstractTodoEnv.__init__(self, {
+        "TODO_DIR": self.__todo_dir_path,
+        "TODO_FILE": self.__todo_file_path,
+        "EDITOR": "EDITOR",
+        "TODOTXT_DATE_ON_ADD": "1",
+        "TODOTXT_PRESERVE_LINE_NUMBERS": "1",
+        "TODOTXT_DISABLE_FILTER": "0",
+        "TODOTXT_SLICE_REVIEW_INTERVALS": "_:0,A:1,B:7,C:56,Z:182",
+        })
+    self.files = {self.__todo_file_path: todo_lines}
+    self.__today = today
+    self.__edit_script = edit_script
+    self.__recorder = recorder
+
+  def today(self):
+    return self.__today
+
+  def read_lines(self, path):
+    if path.startswith(self.__edit_dir_path):
+      # the editor has exited, so the rest of SliceEditor.edit_and_merge is the merge
+      self.__recorder.start("merge")
+    return self.files[path]
+
+  def write_lines(self, path, lines):
+    self.files[path] = list(lines)
+
+  @contextmanager
+  def create_temp_dir(self):
+    yield self.__edit_dir_path
+
+  def subprocess_check_call(self, path, args):
+    self.__recorder.start("edit")
+    [edit_path] = args
+    self.files[edit_path] = self.__edit_script(self.files[edit_path])
+
+  def print_diff(self, id, max_id_len, task_a, task_b):
+    pass
+
+
+# generates realistic todo.txt lines
+class TodoGenerator:
+  __words = ("call email write review plan fix check update buy book meet read draft send prepare "
+      "report invoice budget slides notes meeting project client server release docs tests design").split()
+  __levels = [None, None, None, "A", "B", "B", "C", "C", "C", "D", "Z"]
+
+  def __init__(self, seed, today, tag_density, completion_ratio, future_ratio, blank_ratio, date_span_days):
+    self.random = random.Random(seed)
+    self.today = today
+    self.tag_density = tag_density
+    self.completion_ratio = completion_ratio
+    self.future_ratio = future_ratio
+    self.blank_ratio = blank_ratio
+    self.date_span_days = date_span_days
+
+  # skewed towards recent dates, as most old tasks have been completed and archived
+  def past_date(self):
+    return self.today - timedelta(days = int(self.random.expovariate(3.0 / self.date_span_days)))
+
+  def future_date(self):
+    return self.today + timedelta(days = self.random.randint(1, self.date_span_days))
+
+  def tag(self):
+    r = self.random.random()
+    if r < 0.4:
+      return "@" + "ctx%d" % self.random.randint(1, 20)
+    elif r < 0.85:
+      return "+" + "Proj%d" % int(self.random.paretovariate(1.0))
+    else:
+      return "due:" + self.future_date().isoformat()
+
+  def line(self):
+    r = self.random
+    if r.random() < self.blank_ratio:
+      return ""
+
+    parts = []
+    complete = r.random() < self.completion_ratio
+    if complete:
+      parts.append("x " + self.past_date().isoformat())
+    level = r.choice(self.__levels)
+    if level and not complete:
+      parts.append("(%s)" % level)
+    if r.random() < 0.8:
+      parts.append(self.past_date().isoformat())
+
+    words = [r.choice(self.__words) for i in range(r.randint(2, 10))]
+    for i in range(int(r.expovariate(1.0 / self.tag_density)) if self.tag_density > 0 else 0):
+      words.insert(r.randint(0, len(words)), self.tag())
+    if r.random() < 0.02:
+      words.append("https://example.com/%d" % r.randint(1, 10000))
+    if r.random() < self.future_ratio:
+      words.append("t:" + self.future_date().isoformat())
+
+    return " ".join(parts + words)
+
+  def lines(self, count):
+    return [self.line() for i in range(count)]
+
+
+# edits, deletes and inserts a fraction of the tasks in the slice
+def make_edit_script(seed, edit_ratio, delete_ratio, insert_count):
+  def edit_script(lines):
+    r = random.Random(seed)
+    edited_lines = []
+    for line in lines:
+      if line.startswith("#") or line == "":
+        edited_lines.append(line)
+        continue
+      x = r.random()
+      if x < delete_ratio:
+        continue
+      elif x < delete_ratio + edit_ratio:
+        edited_lines.append(line + " edited")
+      else:
+        edited_lines.append(line)
+    edited_lines.extend(["inserted task %d @bench" % i for i in range(insert_count)])
+    return edited_lines
+  return edit_script
+
+
+def run_slice(todo_lines, today, slice_name, slice_args, edit_script, trace_memory):
+  recorder = PhaseRecorder(trace_memory)
+  env = BenchTodoEnv(todo_lines, today, edit_script, recorder)
+  todo_file_path = env.todo_file_path()
+
+  if trace_memory:
+    tracemalloc.start()
+  try:
+    # this mirrors slice.main, which selects the tasks in the slice as they are loaded, and saves them with the merge
+    recorder.start("load")
+    task_slice = slice.build_slice(env, slice_name, list(slice_args))
+    with slice.TaskFiles(env, [todo_file_path]) as files:
+      editor = files.editor(task_slice)
+      max_id = editor.max_id
+
+      recorder.start("export")
+      merged_tasks = editor.edit_and_merge()
+
+      recorder.start("save")
+      files.save(editor, merged_tasks)
+    recorder.stop()
+  finally:
+    if trace_memory:
+      tracemalloc.stop()
+
+  return {
+      "max_id": max_id,
+      "slice_tasks": len(editor.editable_tasks),
+      "changed_tasks": len(editor.changed_ids),
+      "phases": recorder.phases,
+      }
+
+
+# times starting the slice launcher, as time beyond that of starting python itself
+def run_startup(runs):
+  launcher = os.path.join(os.path.dirname(os.path.abspath(__file__)), "slice")
+  # the bytecode cache is written on the first run, as it would have been long ago for an installed add-on
+  env = {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+
+  def time_command(command):
+    start = time.perf_counter()
+    completed = subprocess.run(command, env = env, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, check = True, universal_newlines = True)
+    return time.perf_counter() - start, completed.stderr
+
+  def median(values):
+    return sorted(values)[len(values) // 2]
+
+  time_command([sys.executable, launcher, "usage"])
+  python_seconds = median([time_command([sys.executable, "-c", "pass"])[0] for i in range(runs)])
+  slice_seconds = median([time_command([sys.executable, launcher, "usage"])[0] for i in range(runs)])
+
+  # each line of -X importtime is "import time: <self us> | <cumulative us> | <indented module name>"
+  imports = []
+  for line in time_command([sys.executable, "-X", "importtime", launcher, "usage"])[1].splitlines():
+    fields = line[len("import time:"):].split("|")
+    if line.startswith("import time:") and len(fields) == 3 and fields[0].strip().isdigit():
+      imports.append({"module": fields[2].strip(), "self_us": int(fields[0]), "cumulative_us": int(fields[1])})
+
+  return {
+      "python_seconds": python_seconds,
+      "slice_usage_seconds": slice_seconds,
+      "startup_seconds": slice_seconds - python_seconds,
+      "slowest_imports": sorted(imports, key = lambda i: i["self_us"], reverse = True)[:10],
+      }
+
+
+# times tokenizing each line with the single-pass tokenizer and with the regex that defines tags, taking the best of the runs
+def run_tokenize(todo_lines, runs):
+  def best_seconds(tokenize):
+    seconds = []
+    for i in range(runs):
+      start = time.perf_counter()
+      for line in todo_lines:
+        tokenize(line)
+      seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+  for line in todo_lines:
+    assert slice.Tag.tokenize(line) == slice.Tag.tokenize_with_regex(line), "tokenizers differ for %r" % line
+  regex_seconds = best_seconds(slice.Tag.tokenize_with_regex)
+  tokenize_seconds = best_seconds(slice.Tag.tokenize)
+  return {
+      "regex_seconds": regex_seconds,
+      "tokenize_seconds": tokenize_seconds,
+      "speedup": regex_seconds / tokenize_seconds,
+      }
+
+
+# times saving changes to tasks into a todo.txt that was written meanwhile, not only by appending,
+# as by todo.sh adding a task at the top and deleting others while the slice was being edited
+def run_merge(todo_lines, seed, edit_ratio, runs):
+  r = random.Random(seed)
+  current_lines = ["(A) added meanwhile"] + [line if r.random() > 0.01 else "" for line in todo_lines]
+  tasks = {}
+  for id, line in enumerate(todo_lines, 1):
+    if len(line) > 0 and r.random() < edit_ratio:
+      tasks[id] = slice.Task.parse(line + " edited")
+  env = BenchTodoEnv(current_lines, None, None, None)
+  todo_file_path = env.todo_file_path()
+
+  seconds = []
+  for i in range(runs):
+    env.files[todo_file_path] = current_lines
+    start = time.perf_counter()
+    slice.Task.save_changes(env, [(todo_file_path, todo_lines, None, tasks, set(tasks.keys()), {})], ["bench"], env.preserve_line_numbers())
+    seconds.append(time.perf_counter() - start)
+  return {
+      "changed_tasks": len(tasks),
+      "merge_seconds": min(seconds),
+      }
+
+
+def main(args):
+  parser = argparse.ArgumentParser(description = "Benchmarks loading, slicing, merging and saving synthetic todo.txt files.")
+  parser.add_argument("--sizes", default = "1000,10000,100000", help = "comma-separated line counts (default: %(default)s)")
+  parser.add_argument("--slices", default = "all,terms,tags,future,review,query", help = "comma-separated slices to run (default: %(default)s)")
+  parser.add_argument("--tag-density", type = float, default = 1.5, help = "mean tags per task (default: %(default)s)")
+  parser.add_argument("--completion-ratio", type = float, default = 0.3, help = "fraction of completed tasks (default: %(default)s)")
+  parser.add_argument("--future-ratio", type = float, default = 0.05, help = "fraction of tasks with a future start date (default: %(default)s)")
+  parser.add_argument("--blank-ratio", type = float, default = 0.02, help = "fraction of blank lines (default: %(default)s)")
+  parser.add_argument("--date-span", type = int, default = 730, help = "span of generated dates in days (default: %(default)s)")
+  parser.add_argument("--edit-ratio", type = float, default = 0.1, help = "fraction of sliced tasks edited (default: %(default)s)")
+  parser.add_argument("--delete-ratio", type = float, default = 0.01, help = "fraction of sliced tasks deleted (default: %(default)s)")
+  parser.add_argument("--insert", type = int, default = 10, help = "number of tasks inserted into each slice (default: %(default)s)")
+  parser.add_argument("--seed", type = int, default = 0, help = "random seed (default: %(default)s)")
+  parser.add_argument("--no-memory", action = "store_true", help = "skip the extra run that traces peak memory per phase")
+  parser.add_argument("--output", help = "write the JSON report to this file rather than stdout")
+  parser.add_argument("--startup", action = "store_true", help = "only benchmark starting 'slice usage', failing if it exceeds the startup budget")
+  parser.add_argument("--startup-runs", type = int, default = 20, help = "runs of 'slice usage' to take the median of (default: %(default)s)")
+  parser.add_argument("--startup-budget", type = float, default = 50, help = "milliseconds that startup may take beyond starting python (default: %(default)s)")
+  parser.add_argument("--tokenize", action = "store_true", help = "only benchmark tokenizing the generated lines, against the regex tokenizer")
+  parser.add_argument("--tokenize-runs", type = int, default = 5, help = "runs of tokenizing to take the best of (default: %(default)s)")
+  parser.add_argument("--merge", action = "store_true", help = "only benchmark saving the edited tasks into a todo.txt written meanwhile")
+  parser.add_argument("--merge-runs", type = int, default = 3, help = "runs of merging to take the best of (default: %(default)s)")
+  options = parser.parse_args(args)
+
+  if options.startup:
+    startup = run_startup(options.startup_runs)
+    write_report({"python": platform.python_version(), "options": vars(options), "startup": startup}, options.output)
+    print("startup %.1fms (budget %.1fms)" % (startup["startup_seconds"] * 1000, options.startup_budget), file = sys.stderr)
+    if startup["startup_seconds"] * 1000 > options.startup_budget:
+      sys.exit(1)
+    return
+
+  today = date(2020, 1, 1)
+  slice_args = {
+      "all": [],
+      "terms": ["report"],
+      "tags": ["+Proj1"],
+      "future": [],
+      "review": [],
+      "query": ["(pri<=B", "or", "due<=today+7)", "-@ctx1", "sort:due"],
+      }
+
+  if options.tokenize:
+    results = []
+    for size in [int(size) for size in options.sizes.split(",")]:
+      generator = TodoGenerator(options.seed, today, options.tag_density, options.completion_ratio,
+          options.future_ratio, options.blank_ratio, options.date_span)
+      result = run_tokenize(generator.lines(size), options.tokenize_runs)
+      result["lines"] = size
+      results.append(result)
+      print("%8d lines  regex %.3fs  tokenize %.3fs  speedup %.2fx" % (size, result["regex_seconds"], result["tokenize_seconds"], result["speedup"]), file = sys.stderr)
+    write_report({"python": platform.python_version(), "options": vars(options), "tokenize": results}, options.output)
+    return
+
+  if options.merge:
+    results = []
+    for size in [int(size) for size in options.sizes.split(",")]:
+      generator = TodoGenerator(options.seed, today, options.tag_density, options.completion_ratio,
+          options.future_ratio, options.blank_ratio, options.date_span)
+      result = run_merge(generator.lines(size), options.seed, options.edit_ratio, options.merge_runs)
+      result["lines"] = size
+      results.append(result)
+      print("%8d lines  merge %.3fs" % (size, result["merge_seconds"]), file = sys.stderr)
+    write_report({"python": platform.python_version(), "options": vars(options), "merge": results}, options.output)
+    return
+
+  results = []
+  for size in [int(size) for size in options.sizes.split(",")]:
+    generator = TodoGenerator(options.seed, today, options.tag_density, options.completion_ratio,
+        options.future_ratio, options.blank_ratio, options.date_span)
+    todo_lines = generator.lines(size)
+    edit_script = make_edit_script(options.seed, options.edit_ratio, options.delete_ratio, options.insert)
+
+    for slice_name in options.slices.split(","):
+      # memory is traced in a separate run, as tracing distorts the timings
+      result = run_slice(todo_lines, today, slice_name, slice_args[slice_name], edit_script, trace_memory = False)
+      if not options.no_memory:
+        memory_result = run_slice(todo_lines, today, slice_name, slice_args[slice_name], edit_script, trace_memory = True)
+        for name, phase in memory_result["phases"].items():
+          result["phases"][name]["peak_bytes"] = phase["peak_bytes"]
+          result["phases"][name]["retained_bytes"] = phase["retained_bytes"]
+      result.update({"lines": size, "slice": slice_name, "args": slice_args[slice_name]})
+      results.append(result)
+      print("%8d lines  %-7s %s" % (size, slice_name, "  ".join("%s %.3fs" % (name, phase["seconds"]) for name, phase in result["phases"].items())), file = sys.stderr)
+
+  write_report({"python": platform.python_version(), "options": vars(options), "results": results}, options.output)
+
+
+def write_report(report, output):
+  if output:
+    with open(output, "w", encoding = "utf-8") as f:
+      json.dump(report, f, indent = 2)
+  else:
+    json.dump(report, sys.stdout, indent = 2)
+    print()
+
+
+if __name__ == "__main__":
+  # warnings about review intervals etc. are expected for synthetic data
+  logging.getLogger("slice").setLevel(logging.ERROR)
+  main(sys.argv[1:])
@@ -0,0 +1,3397 @@
+#!/usr/bin/env python3
+from array import array
+import collections
+import contextlib
+from datetime import date, datetime, timedelta
+import functools
+import itertools
+import logging
+import operator
+import os
+import re
+import string
+import sys
+
+# modules only needed by some runs (e.g. difflib, subprocess, tempfile) are imported where they are used
+# as slice is run interactively, and importing them all costs about as much as the rest of startup
+# those that collections imports anyway, such as itertools and operator, are imported here, as they cost nothing more
+
+log = logging.getLogger(__name__)
+
+
+# a regex that is compiled on first use rather than when its class is defined
+# it then replaces itself with the compiled regex, so later uses cost no more than a plain class attribute
+class LazyRegex:
+  def __init__(self, pattern, flags = 0):
+    self.__pattern = pattern
+    self.__flags = flags
+
+  def __set_name__(self, owner, name):
+    self.__owner = owner
+    self.__name = name
+
+  def __get__(self, instance, owner = None):
+    regex = re.compile(self.__pattern, self.__flags)
+    setattr(self.__owner, self.__name, regex)
+    return regex
+
+
+class ColorDiff:
+  __CYAN = "\033[36m"
+  __RED = "\033[31m"
+  __GREEN = "\033[32m"
+  __DEFAULT = "\033[0m"
+
+  __word_re = LazyRegex(r"(\s+)")
+
+  # beyond this many pairs of changed words, changed words are not matched up, as that is quadratic
+  __max_word_pairs = 10000
+
+  # returns colored diff lines for the terminal
+  @classmethod
+  def diff(cls, header, a, b):
+    a_out = [cls.__CYAN, header]
+    b_out = [cls.__CYAN, header]
+
+    for tag, a_text, b_text in cls.__diff_words(a, b):
+      if tag == "equal":
+        cls.__append(a_out, cls.__DEFAULT, a_text)
+        cls.__append(b_out, cls.__DEFAULT, b_text)
+      else:
+        # only color the characters that changed, e.g. the day of a date
+        prefix_len = cls.__common_prefix_len(a_text, b_text)
+        suffix_len = cls.__common_prefix_len(a_text[prefix_len:][::-1], b_text[prefix_len:][::-1])
+        for out, text, color in [(a_out, a_text, cls.__RED), (b_out, b_text, cls.__GREEN)]:
+          cls.__append(out, cls.__DEFAULT, text[:prefix_len])
+          cls.__append(out, color, text[prefix_len:len(text) - suffix_len])
+          cls.__append(out, cls.__DEFAULT, text[len(text) - suffix_len:])
+
+    a_out.append(cls.__DEFAULT)
+    b_out.append(cls.__DEFAULT)
+
+    lines = []
+    if len(a) > 0:
+      lines.append("".join(a_out))
+    if len(b) > 0:
+      lines.append("".join(b_out))
+    lines.append("")
+    return "".join(line + "\n" for line in lines)
+
+  # yields (tag, a_text, b_text) for the equal and changed runs of words (and whitespace) of a and b
+  # tasks are mostly edited in one place, so the common leading and trailing words are trimmed before matching
+  @classmethod
+  def __diff_words(cls, a, b):
+    a_words = cls.__word_re.split(a)
+    b_words = cls.__word_re.split(b)
+
+    max_len = min(len(a_words), len(b_words))
+    start = 0
+    while start < max_len and a_words[start] == b_words[start]:
+      start += 1
+    end = 0
+    while end < max_len - start and a_words[-1 - end] == b_words[-1 - end]:
+      end += 1
+
+    a_middle = a_words[start:len(a_words) - end]
+    b_middle = b_words[start:len(b_words) - end]
+
+    yield "equal", "".join(a_words[:start]), "".join(b_words[:start])
+    if len(a_middle) * len(b_middle) <= cls.__max_word_pairs:
+      import difflib
+      sm = difflib.SequenceMatcher(a = a_middle, b = b_middle, autojunk = False)
+      for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        yield tag, "".join(a_middle[i1:i2]), "".join(b_middle[j1:j2])
+    else:
+      yield "replace", "".join(a_middle), "".join(b_middle)
+    yield "equal", "".join(a_words[len(a_words) - end:]), "".join(b_words[len(b_words) - end:])
+
+  @staticmethod
+  def __append(out, color, text):
+    if len(text) > 0:
+      out.append(color)
+      out.append(text)
+
+  @staticmethod
+  def __common_prefix_len(a, b):
+    return len(os.path.commonprefix([a, b]))
+
+
+# the lines of a file, as byte offsets into a buffer of its bytes, which are only decoded when accessed
+class LineTable:
+  __newline_re = LazyRegex(rb"\n")
+  __lone_carriage_return_re = LazyRegex(rb"\r(?!\n)")
+  # the boundaries other than "\n" and "\r\n" on which str.splitlines also splits
+  __other_line_boundaries = [b"\x0b", b"\x0c", b"\x1c", b"\x1d", b"\x1e", b"\xc2\x85", b"\xe2\x80\xa8", b"\xe2\x80\xa9"]
+
+  def __init__(self, buffer, starts):
+    self.buffer = buffer
+    # the os.stat_result of the file that the buffer was read from, if any
+    self.stat = None
+    # the start of each line, followed by the end of the buffer
+    self.__starts = starts
+
+  # returns None if the buffer has line boundaries other than "\n" and "\r\n", which are too rare to be worth supporting
+  @classmethod
+  def build(cls, buffer):
+    # find is much faster than searching for all the boundaries with one regex
+    if any(buffer.find(boundary) >= 0 for boundary in cls.__other_line_boundaries):
+      return None
+    if buffer.find(b"\r") >= 0 and cls.__lone_carriage_return_re.search(buffer) is not None:
+      return None
+    starts = array("Q", [0])
+    starts.extend(m.end() for m in cls.__newline_re.finditer(buffer))
+    if starts[-1] != len(buffer):
+      starts.append(len(buffer))
+    return cls(buffer, starts)
+
+  def __len__(self):
+    return len(self.__starts) - 1
+
+  def __getitem__(self, i):
+    start, end = self.span(i)
+    return str(self.buffer[start:end], "utf-8")
+
+  # the buffer has no lone "\r", so stripping the line ending of whole lines is equivalent to span, and cheaper
+  def __iter__(self):
+    buffer, starts = self.buffer, self.__starts
+    for i in range(len(starts) - 1):
+      yield str(buffer[starts[i]:starts[i + 1]], "utf-8").rstrip("\r\n")
+
+  # returns the (start, end) byte offsets of line i, excluding the line ending
+  def span(self, i):
+    if not 0 <= i < len(self):
+      raise IndexError("line %d out of range" % i)
+    start, end = self.__starts[i], self.__starts[i + 1]
+    if end > start and self.buffer[end - 1] == 0x0a:
+      end -= 1
+      if end > start and self.buffer[end - 1] == 0x0d:
+        end -= 1
+    return start, end
+
+  def raw(self, i):
+    start, end = self.span(i)
+    return self.buffer[start:end]
+
+
+# a subset of the lines of a file, keyed by line number (starting at 1)
+# the lines are only looked up when accessed, so lines that are never written back are never decoded
+class LineSelection:
+  def __init__(self, lines):
+    self.__lines = lines
+    self.__selected = bytearray(len(lines) + 1)
+    self.__count = 0
+
+  def add(self, id):
+    if not self.__selected[id]:
+      self.__selected[id] = 1
+      self.__count += 1
+
+  def __len__(self):
+    return self.__count
+
+  def __contains__(self, id):
+    return 0 < id < len(self.__selected) and self.__selected[id] == 1
+
+  def __getitem__(self, id):
+    if id not in self:
+      raise KeyError(id)
+    return self.__lines[id - 1]
+
+  def keys(self):
+    return (id for id in range(1, len(self.__selected)) if self.__selected[id])
+
+
+class AbstractTodoEnv:
+  def __init__(self, os_environ):
+    self.__os_environ = os_environ
+    self.todo_dir_path = lambda: self.__environ("TODO_DIR")
+    self.todo_file_path = lambda: self.__environ("TODO_FILE")
+    self.done_file_path = lambda: self.__environ("DONE_FILE")
+    self.editor_path = lambda: self.__environ("EDITOR")
+    self.date_on_add = lambda: self.__environ("TODOTXT_DATE_ON_ADD") == "1"
+    self.default_create_date = lambda: self.today() if self.date_on_add() else None
+    self.preserve_line_numbers = lambda: self.__environ("TODOTXT_PRESERVE_LINE_NUMBERS") == "1"
+    self.disable_filter = lambda: self.__environ("TODOTXT_DISABLE_FILTER") == "1"
+    self.slice_review_intervals = lambda: self.__environ("TODOTXT_SLICE_REVIEW_INTERVALS", default = "_:0,A:1,B:7,C:56,Z:182")
+    self.slice_cache = lambda: self.__optional_environ("TODOTXT_SLICE_CACHE", default = "0") == "1"
+    self.slice_jobs = self.__slice_jobs
+    self.slice_socket = lambda: self.__optional_environ("TODOTXT_SLICE_SOCKET", default = "")
+    self.slice_stats = lambda: self.__optional_environ("TODOTXT_SLICE_STATS", default = "")
+    self.slice_profile = lambda: self.__optional_environ("TODOTXT_SLICE_PROFILE", default = "")
+    self.slice_journal = lambda: self.__optional_environ("TODOTXT_SLICE_JOURNAL", default = "1") == "1"
+    self.slice_journal_size = self.__slice_journal_size
+
+  def __environ(self, key, default = None):
+    try:
+      return self.__os_environ[key]
+    except KeyError:
+      if default is not None:
+        log.warning("Environment variable %s is not defined. Falling back to default: '%s'" % (key, default))
+        return default
+      else:
+        log.warning("Mandatory environment variable %s is not defined." % key)
+        sys.exit(1)
+
+  # the number of processes to parse large files in, which must be at least 1
+  def __slice_jobs(self):
+    value = self.__optional_environ("TODOTXT_SLICE_JOBS", default = "1")
+    jobs = int(value) if value.strip().isdigit() else 0
+    if jobs < 1:
+      log.warning("Error parsing TODOTXT_SLICE_JOBS='%s': expected a number of processes of at least 1" % value)
+      sys.exit(1)
+    return jobs
+
+  def __slice_journal_size(self):
+    value = self.__optional_environ("TODOTXT_SLICE_JOURNAL_SIZE", default = "100")
+    size = int(value) if value.strip().isdigit() else 0
+    if size < 1:
+      log.warning("Error parsing TODOTXT_SLICE_JOURNAL_SIZE='%s': expected a number of changes of at least 1" % value)
+      sys.exit(1)
+    return size
+
+  # for optional settings of this add-on, which todo.sh does not define
+  def __optional_environ(self, key, default):
+    return self.__os_environ.get(key, default)
+
+  # returns a value that changes whenever the file at path changes, or None if this is not supported
+  # it is taken from the lines of the file, as opened by open_lines, so that it is of the lines that were parsed
+  def fingerprint(self, path, lines):
+    return None
+
+  # like fingerprint, but cheap enough to check before every request to the slice server, as it does not read the file
+  def modification_key(self, path):
+    return None
+
+  # returns the fingerprint and the (id, line, record) entries cached for the file at path, or None if there is no cache
+  # the entries of a different fingerprint are still useful, as the records of the lines that have not changed
+  def read_task_cache(self, path):
+    return None
+
+  def write_task_cache(self, path, fingerprint, entries):
+    pass
+
+  # yields the lines of the file at path, which subclasses may read lazily
+  def iter_lines(self, path):
+    return iter(self.read_lines(path))
+
+  # returns the (id, record) of each task in the given lines of the file at path, as Task.parse_records does
+  # or None if the lines should be parsed serially instead
+  def parse_records_in_parallel(self, path, lines, allow_comments):
+    return None
+
+  # writes the diffs that print_diff may have buffered
+  def flush_diffs(self):
+    pass
+
+  # returns a context manager for a sequence of the lines of the file at path
+  # subclasses may decode the lines lazily, in which case the sequence is only valid in the context
+  def open_lines(self, path):
+    return contextlib.nullcontext(self.read_lines(path))
+
+  # appends an entry, a dict of builtin types, to the journal of saved changes that 'slice undo' reverts
+  # subclasses without a journal do nothing, and return no entries
+  def append_journal(self, entry):
+    pass
+
+  def read_journal(self):
+    return []
+
+  # returns a context manager that holds an advisory lock on the file at path, so that concurrent slices save it in turn
+  def lock_file(self, path):
+    return contextlib.nullcontext()
+
+  # replaces the given lines of the file at path, keyed by line number (starting at 1)
+  # line numbers beyond the end of the file are appended, and trailing empty lines are removed
+  # subclasses may override this to copy the lines that have not changed rather than decoding and encoding them again
+  def patch_lines(self, path, patches):
+    with self.open_lines(path) as lines:
+      lines = list(lines)
+    max_id = max(patches.keys()) if len(patches) > 0 else 0
+    lines.extend([""] * (max_id - len(lines)))
+    for id, line in patches.items():
+      lines[id - 1] = line
+    while len(lines) > 0 and lines[-1] == "":
+      lines.pop()
+    self.write_lines(path, lines)
+
+
+# a thin shim between us and the real world
+# try to minimize what goes in here as it will not be tested
+class TodoEnv(AbstractTodoEnv):
+  def __init__(self):
+    AbstractTodoEnv.__init__(self, os.environ)
+    self.__diffs = []
+    # the slice server replaces these for each request
+    self.stdin = sys.stdin
+    self.stdout = sys.stdout
+
+  def today(self):
+    return date.today()
+
+  # the path "-" is stdin or stdout, as is usual for command line tools
+  def read_lines(self, path):
+    if path == "-":
+      return self.stdin.read().splitlines()
+    with open(path, "r", encoding="utf-8") as f:
+      return f.read().splitlines()
+
+  def iter_lines(self, path):
+    with self.open_lines(path) as lines:
+      yield from lines
+
+  # reads the file into bytes once, and only decodes lines when they are accessed
+  # the lines are a copy rather than a mapping of the file, as they are kept while the editor is open,
+  # and another program may rewrite the file in place meanwhile
+  # a file that does not exist yet, such as done.txt before anything is archived, has no lines
+  @contextlib.contextmanager
+  def open_lines(self, path):
+    try:
+      with open(path, "rb") as f:
+        data = f.read()
+        st = os.fstat(f.fileno())
+    except FileNotFoundError:
+      yield []
+      return
+    lines = LineTable.build(data)
+    if lines is None:
+      yield str(data, "utf-8").splitlines()
+      return
+    lines.stat = st
+    yield lines
+
+  # an existing file is replaced rather than truncated, so that it is never seen half written
+  def write_lines(self, path, lines):
+    if path == "-":
+      self.stdout.writelines(line + "\n" for line in lines)
+      self.stdout.flush()
+      return
+    if os.path.exists(path):
+      self.__replace_file(path, [line.encode("utf-8") + b"\n" for line in lines])
+      return
+    with open(path, "w", encoding="utf-8") as f:
+      for line in lines:
+        f.write(line)
+        f.write("\n")
+
+  # atomically replaces the file at path with the given chunks of bytes, keeping its permissions
+  # a symlink, e.g. into a synced folder, is followed so the file it links to is replaced rather than the link
+  def __replace_file(self, path, chunks):
+    import tempfile
+    path = os.path.realpath(path)
+    dir_path = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir = dir_path, prefix = ".%s." % os.path.basename(path))
+    try:
+      with os.fdopen(fd, "wb") as f:
+        f.writelines(chunks)
+        f.flush()
+        os.fsync(f.fileno())
+      os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+      os.replace(temp_path, path)
+    except BaseException:
+      os.unlink(temp_path)
+      raise
+
+  def patch_lines(self, path, patches):
+    with self.open_lines(path) as lines:
+      # only "\n" and "\r\n" line endings can be patched by offset, as read_lines splits on any line boundary
+      if not isinstance(lines, LineTable):
+        if len(lines) > 0 or not os.path.exists(path):
+          AbstractTodoEnv.patch_lines(self, path, patches)
+          return
+        lines = LineTable.build(b"")
+      self.__replace_with_patched_lines(path, lines, patches)
+
+  # the whole file is still written, so saving costs as much I/O as the size of the file, however few lines are patched,
+  # but only the patched lines are encoded, and the bytes of the others are copied as they were read
+  def __replace_with_patched_lines(self, path, lines, patches):
+    data = lines.buffer
+    line_count = len(lines)
+    encoded_patches = {id: line.encode("utf-8") for id, line in patches.items()}
+
+    def content(id):
+      if id in encoded_patches:
+        return encoded_patches[id]
+      if id > line_count:
+        return b""
+      return lines.raw(id - 1)
+
+    # trailing empty lines are removed, as Task.save_all would do
+    last_id = max([line_count] + list(encoded_patches.keys()))
+    while last_id > 0 and len(content(last_id)) == 0:
+      last_id -= 1
+
+    # unchanged spans are copied into a temp file that atomically replaces the original,
+    # so that a concurrent reader never sees the file half written
+    missing_final_newline = len(data) > 0 and data[len(data) - 1] != 0x0a
+    chunks = []
+    pos = 0
+    for id in sorted(id for id in encoded_patches.keys() if id <= min(last_id, line_count)):
+      start, end = lines.span(id - 1)
+      chunks.append(data[pos:start])
+      chunks.append(encoded_patches[id])
+      pos = end
+    end_pos = len(data) if last_id >= line_count else lines.span(last_id)[0]
+    chunks.append(data[pos:end_pos])
+    if last_id > line_count:
+      if missing_final_newline:
+        chunks.append(b"\n")
+      for id in range(line_count + 1, last_id + 1):
+        chunks.append(content(id) + b"\n")
+    self.__replace_file(path, chunks)
+
+  # below this many lines, starting the worker processes costs more than it saves
+  __min_lines_to_parse_in_parallel = 50000
+
+  def parse_records_in_parallel(self, path, lines, allow_comments):
+    jobs = self.slice_jobs()
+    if jobs <= 1 or not isinstance(lines, LineTable) or lines.stat is None or len(lines) < self.__min_lines_to_parse_in_parallel:
+      return None
+
+    # each worker reads its own range of the file, so only the records are sent between processes
+    chunk_len = -(-len(lines) // jobs)
+    chunks = []
+    for i in range(0, len(lines), chunk_len):
+      last = min(i + chunk_len, len(lines)) - 1
+      chunks.append((path, i + 1, lines.span(i)[0], lines.span(last)[1], allow_comments))
+
+    import concurrent.futures
+    import multiprocessing
+    # fork, as the workers must find Task under the same module name, which need not be importable
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    with concurrent.futures.ProcessPoolExecutor(max_workers = jobs, mp_context = context) as executor:
+      chunk_records = list(executor.map(Task.parse_records, *zip(*chunks)))
+
+    # the workers read the file again, so only read the lines if it is still the file that they were read from
+    if self.modification_key(path) != (lines.stat.st_ino, lines.stat.st_size, lines.stat.st_mtime_ns):
+      return None
+    if any(records is None for records in chunk_records):
+      log.error("Found task starting with '#' which could be confused with a comment.")
+      sys.exit(1)
+    return [record for records in chunk_records for record in records]
+
+  def __journal_path(self):
+    return os.path.join(self.todo_dir_path(), ".slice-journal") if self.slice_journal() else None
+
+  # the journal is a line of JSON per entry, and is appended to, so an entry costs as much as its changes
+  # its entries are counted by their line endings, and only once it holds more than slice_journal_size of them
+  # are the last ones decoded, to replace it with
+  def append_journal(self, entry):
+    journal_path = self.__journal_path()
+    if journal_path is None:
+      return
+    import json
+    with self.lock_file(journal_path):
+      with open(journal_path, "a", encoding = "utf-8") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+      with open(journal_path, "rb") as f:
+        data = f.read()
+      size = self.slice_journal_size()
+      count = data.count(b"\n")
+      if count > size:
+        entries = trim_journal(self.__decode_journal(journal_path, data.splitlines()[-size:]), count - size)
+        self.__replace_file(journal_path, [(json.dumps(entry) + "\n").encode("utf-8") for entry in entries])
+
+  def read_journal(self):
+    journal_path = self.__journal_path()
+    if journal_path is None or not os.path.exists(journal_path):
+      return []
+    with open(journal_path, "rb") as f:
+      return self.__decode_journal(journal_path, f.read().splitlines())
+
+  # an entry that was cut short, e.g. by a crash while it was appended, is skipped
+  @staticmethod
+  def __decode_journal(journal_path, lines):
+    import json
+    entries = []
+    for line in lines:
+      try:
+        entries.append(json.loads(line))
+      except ValueError:
+        log.warning("Skipping incomplete entry in %s" % journal_path)
+    return entries
+
+  # the lock is on a separate file, as the todo file itself is replaced when it is written
+  @contextlib.contextmanager
+  def lock_file(self, path):
+    try:
+      import fcntl
+    except ImportError:
+      yield
+      return
+    # the link to a symlinked todo file locks the same file as its target, as both are saved to the target
+    path = os.path.realpath(path)
+    # a dotted name, such as that of the journal, is not dotted again
+    lock_path = os.path.join(os.path.dirname(path), ".%s.lock" % os.path.basename(path).lstrip("."))
+    with open(lock_path, "a") as f:
+      fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+  # a file that does not exist yet has a key of its own, which changes once it is created
+  def modification_key(self, path):
+    try:
+      st = os.stat(path)
+    except FileNotFoundError:
+      return ()
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+  # hashing the file and collecting records to cache costs more than parsing lazily, so is only done when caching
+  # the file is not opened again, as it may have been replaced since its lines were read
+  def fingerprint(self, path, lines):
+    if self.__task_cache_path(path) is None or not isinstance(lines, LineTable) or lines.stat is None:
+      return None
+    import hashlib
+    digest = hashlib.sha1(lines.buffer).hexdigest()
+    return (os.path.abspath(path), lines.stat.st_size, lines.stat.st_mtime_ns, digest)
+
+  # each cache holds a single file's records, so is only worth having for todo.txt and done.txt, which 'done' slices
+  def __task_cache_path(self, path):
+    if not self.slice_cache():
+      return None
+    if os.path.abspath(path) == os.path.abspath(self.todo_file_path()):
+      return os.path.join(self.todo_dir_path(), ".slice-cache")
+    if os.path.abspath(path) == os.path.abspath(self.done_file_path()):
+      return os.path.join(self.todo_dir_path(), ".slice-cache-done")
+    return None
+
+  # the marshal format is specific to the python version, so is part of the cache format
+  def __task_cache_format(self):
+    import marshal
+    return (marshal.version, tuple(sys.version_info[:2]))
+
+  def read_task_cache(self, path):
+    cache_path = self.__task_cache_path(path)
+    if cache_path is None:
+      return None
+    import marshal
+    try:
+      with open(cache_path, "rb") as f:
+        format, fingerprint, entries = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+      return None
+    return (fingerprint, entries) if format == self.__task_cache_format() else None
+
+  def write_task_cache(self, path, fingerprint, entries):
+    cache_path = self.__task_cache_path(path)
+    if cache_path is None:
+      return
+    import marshal
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(cache_path)), prefix = ".slice-cache.")
+    try:
+      with os.fdopen(fd, "wb") as f:
+        f.write(marshal.dumps((self.__task_cache_format(), fingerprint, entries)))
+      os.replace(temp_path, cache_path)
+    except OSError as e:
+      os.unlink(temp_path)
+      log.warning("Could not write task cache %s: %s" % (cache_path, e))
+
+  def create_temp_dir(self):
+    import tempfile
+    return tempfile.TemporaryDirectory()
+
+  def subprocess_check_call(self, path, args):
+    import subprocess
+    subprocess.check_call([path] + args)
+
+  def print_diff(self, id, max_id_len, task_a, task_b):
+    # we should only be printing diffs where there is actually a difference
+    assert task_a != task_b, "expected task_a <%s> != task_b: <%s>" % (task_a, task_b)
+    header = "%s " % str(id).zfill(max_id_len)
+    log_a = task_a.line if task_a else ""
+    log_b = task_b.line if task_b else ""
+    self.__diffs.append(ColorDiff.diff(header, log_a, log_b))
+
+  # the diffs of a large edit are written at once, as writing each separately is slower than diffing them
+  def flush_diffs(self):
+    self.stdout.write("".join(self.__diffs))
+    self.stdout.flush()
+    self.__diffs = []
+
+
+class Priority:
+  __slots__ = ("level", "explicit", "raw")
+
+  __priority_re = LazyRegex(r"""^
+    ( \( (?P<level> [A-Z_] ) \) )?
+  $""", re.VERBOSE)
+
+  # priorities are immutable, so there is a single shared instance of each
+  __instances = {}
+  __instances_by_raw = {}
+
+  @classmethod
+  def parse(cls, raw):
+    priority = cls.__instances_by_raw.get(raw)
+    if priority is not None:
+      return priority
+    m = cls.__priority_re.match(raw)
+    if m is None:
+      raise ValueError("Cannot parse priority: %s" % raw)
+    raw_level = m.group("level")
+    explicit = raw_level is not None
+    level = raw_level if raw_level != "_" else None
+    priority = Priority(level, explicit)
+    assert priority.raw == raw, "parsing should not lose information: <%s> != <%s>" % (priority.raw, raw)
+    return priority
+
+  def __new__(cls, level, explicit_no_level = False):
+    explicit = level is not None or bool(explicit_no_level)
+    priority = cls.__instances.get((level, explicit))
+    if priority is None:
+      if level is not None and level not in string.ascii_uppercase:
+        raise ValueError("Invalid level: %s" % level)
+      priority = object.__new__(cls)
+      priority.level = level
+      priority.explicit = explicit
+      priority.raw = "(" + (level or "_") + ")" if explicit else ""
+      cls.__instances[(level, explicit)] = priority
+      cls.__instances_by_raw[priority.raw] = priority
+    return priority
+
+  def __reduce__(self):
+    return (Priority, (self.level, self.explicit))
+
+  def normalize(self, explicit_no_level):
+    return Priority(self.level, explicit_no_level) if not self.level and self.explicit != explicit_no_level else self
+
+  def __repr__(self):
+    return self.raw
+
+  # ignore explicitness in comparison
+  def __eq__(self, other):
+    return other is not None and self.level.__eq__(other.level)
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __hash__(self):
+    return self.level.__hash__()
+
+
+class Tag:
+  __tag_re = LazyRegex(r"""
+    (
+      (?<= \s )           # tag must be preceded by whitespace
+    |
+      (?<= \A )           # or start of string
+    )
+    (
+      (?P<prefix> [@+] )  # project/context prefix
+      (?P<name> \S+ )     # name
+    |
+      (?P<key> \S+? ) :   # key:
+      (?!//)              # don't match URLs
+      (?P<value> \S+ )    # value
+    )
+  """, re.VERBOSE)
+
+  __slots__ = ("raw",)
+
+  # tags are immutable, so tokenized tags share a single instance per distinct tag to save memory
+  # the slice server parses for as long as it runs, so the tags are forgotten once there are too many to keep
+  __shared_tags = {}
+  __max_shared_tags = 1 << 17
+
+  # returns the shared tag of the given kind (as in sort_key), creating it the first time it is seen
+  @classmethod
+  def shared(cls, raw, kind, name, value = None):
+    tag = Tag.__shared_tags.get(raw)
+    if tag is None:
+      if kind == 0:
+        tag = ContextTag(sys.intern(name))
+      elif kind == 1:
+        tag = ProjectTag(sys.intern(name))
+      else:
+        assert kind == 2, "unknown tag kind: %s" % kind
+        tag = KeyValueTag(sys.intern(name), sys.intern(value))
+      assert tag.raw == raw, "parsing should not lose information: <%s> != <%s>" % (tag.raw, raw)
+      if len(Tag.__shared_tags) >= Tag.__max_shared_tags:
+        Tag.__shared_tags.clear()
+      Tag.__shared_tags[raw] = tag
+    return tag
+
+  @staticmethod
+  def __handle_match(m):
+    raw = m.group(0)
+    tag = Tag.__shared_tags.get(raw)
+    if tag is not None:
+      return tag
+    prefix = m.group("prefix")
+    name = m.group("name")
+    key = m.group("key")
+    value = m.group("value")
+    if prefix:
+      assert name, "name should be captured if prefix is captured: %s" % raw
+      if prefix == "@":
+        return Tag.shared(raw, 0, name)
+      elif prefix == "+":
+        return Tag.shared(raw, 1, name)
+      else:
+        assert False, "unknown prefix: %s" % prefix
+    else:
+      assert key and value, "key and value should be captured if prefix is not: %s" % raw
+      return Tag.shared(raw, 2, key, value)
+
+  __whitespace_re = LazyRegex(r"(\s+)")
+
+  # returns the tag that the word (which must not contain whitespace) would be tokenized into, or None if it is not a tag
+  # this matches __tag_re at the start of the word, without the expense of its lookbehinds
+  @staticmethod
+  def __tag_of_word(word):
+    tag = Tag.__shared_tags.get(word)
+    if tag is not None:
+      return tag
+    if len(word) >= 2:
+      if word[0] == "@":
+        return Tag.shared(word, 0, word[1:])
+      elif word[0] == "+":
+        return Tag.shared(word, 1, word[1:])
+    # the key is as short as possible, so is up to the first colon that is followed by a value other than a URL's "//"
+    sep = word.find(":", 1)
+    while sep >= 0:
+      if sep + 1 < len(word) and not word.startswith("//", sep + 1):
+        return Tag.shared(word, 2, word[:sep], word[sep + 1:])
+      sep = word.find(":", sep + 1)
+    return None
+
+  @classmethod
+  def parse(cls, raw):
+    tag = cls.__tag_of_word(raw) if len(raw) > 0 and len(cls.__whitespace_re.split(raw)) == 1 else None
+    if tag is None:
+      raise ValueError("Cannot parse tag: %s" % raw)
+    return tag
+
+  # returns a list of Tags and non-empty strings
+  # the string is split into words and whitespace once, and only words that could be tags are checked
+  @classmethod
+  def tokenize(cls, raw):
+    if "@" not in raw and "+" not in raw and ":" not in raw:
+      return [raw] if len(raw) > 0 else []
+    tag_of_word = cls.__tag_of_word
+    tokens = []
+    # words and whitespace alternate, starting and ending with a (possibly empty) word
+    parts = cls.__whitespace_re.split(raw)
+    start = 0
+    for i in range(0, len(parts), 2):
+      word = parts[i]
+      if ":" in word or word.startswith(("@", "+")):
+        tag = tag_of_word(word)
+        if tag is not None:
+          if i > start:
+            tokens.append("".join(parts[start:i]))
+          tokens.append(tag)
+          start = i + 1
+    if start < len(parts):
+      str_token = "".join(parts[start:])
+      if len(str_token) > 0:
+        tokens.append(str_token)
+    return tokens
+
+  # tokenizes as tokenize does, but with __tag_re, which defines what a tag is
+  @classmethod
+  def tokenize_with_regex(cls, raw):
+    tokens = []
+    pos = 0
+
+    def handle_str(end):
+      str_token = raw[pos:end]
+      if len(str_token) > 0:
+        tokens.append(str_token)
+
+    for m in cls.__tag_re.finditer(raw):
+      handle_str(m.start())
+      tokens.append(cls.__handle_match(m))
+      pos = m.end()
+
+    handle_str(len(raw))
+
+    return tokens
+
+  # joins the given tokens
+  # where there are two adjacent tokens with no intermediate whitespace, a space is inserted
+  # where there are two adjacent tokens and both supply whitespace, the second whitespace is dropped
+  # leading and trailing whitespace is removed
+  @classmethod
+  def join_tokens(cls, tokens):
+    str_tokens = []
+    preceding_space = True
+
+    for token in tokens:
+      if isinstance(token, Tag):
+        start_space = False
+        end_space = False
+        str_token = str(token)
+      else:
+        assert isinstance(token, str) and len(token) > 0, "Expected non-Tag token to be a non-empty string: %s" % token
+        start_space = token[0].isspace()
+        end_space = token[-1].isspace()
+        str_token = token.lstrip() if preceding_space else token
+
+      if not preceding_space and not start_space:
+        str_tokens.append(" ")
+      str_tokens.append(str_token)
+
+      preceding_space = end_space
+
+    return "".join(str_tokens).rstrip()
+
+  # returns the tokens that tokenize(join_tokens(tokens)) would return, without rescanning the joined string
+  # this relies on string tokens never containing tags, which holds for any tokens derived from tokenize
+  @classmethod
+  def normalize_tokens(cls, tokens):
+    normalized_tokens = []
+    str_parts = []
+    preceding_space = True
+
+    def flush_str():
+      str_token = "".join(str_parts)
+      if len(str_token) > 0:
+        normalized_tokens.append(str_token)
+      str_parts.clear()
+
+    for token in tokens:
+      if isinstance(token, Tag):
+        if not preceding_space:
+          str_parts.append(" ")
+        flush_str()
+        normalized_tokens.append(token)
+        preceding_space = False
+      else:
+        assert isinstance(token, str) and len(token) > 0, "Expected non-Tag token to be a non-empty string: %s" % token
+        if not preceding_space and not token[0].isspace():
+          str_parts.append(" ")
+        str_parts.append(token.lstrip() if preceding_space else token)
+        preceding_space = token[-1].isspace()
+
+    # trailing whitespace is removed
+    str_token = "".join(str_parts).rstrip()
+    if len(str_token) > 0:
+      normalized_tokens.append(str_token)
+
+    return normalized_tokens
+
+  # sorts the tags between the "edge" and the first non-whitespace token
+  # the "edge" is the start if trailing is false, else the end
+  @classmethod
+  def sort_edge_tags(cls, tokens, trailing):
+    # split tokens into "tags at the edge", and whatever remains
+    edge_tags = []
+    edge_pos = -1 if trailing else 0
+    rem_tokens = tokens[:]
+    while len(rem_tokens) > 0:
+      token = rem_tokens[edge_pos]
+      if isinstance(token, Tag):
+        edge_tags.append(token)
+      else:
+        assert isinstance(token, str) and len(token) > 0, "Expected non-Tag token to be a non-empty string: %s" % token
+        if not token.isspace():
+          # no longer at edge
+          break
+      rem_tokens.pop(edge_pos)
+
+    edge_tags.sort(key = lambda tag: tag.sort_key())
+    return rem_tokens + edge_tags if trailing else edge_tags + rem_tokens
+
+  def sort_key(self):
+    raise NotImplementedError
+
+  def __init__(self, raw):
+    self.raw = raw
+
+  def __repr__(self):
+    return self.raw
+
+  def __eq__(self, other):
+    return other is not None and self.raw.__eq__(other.raw)
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __hash__(self):
+    return self.raw.__hash__()
+
+
+class ContextTag(Tag):
+  __slots__ = ("name",)
+
+  def __init__(self, name):
+    Tag.__init__(self, "@" + name)
+    self.name = name
+
+  def sort_key(self):
+    return (0, self.name, None)
+
+
+class ProjectTag(Tag):
+  __slots__ = ("name",)
+
+  def __init__(self, name):
+    Tag.__init__(self, "+" + name)
+    self.name = name
+
+  def sort_key(self):
+    return (1, self.name, None)
+
+
+class KeyValueTag(Tag):
+  __slots__ = ("key", "value")
+
+  def __init__(self, key, value):
+    Tag.__init__(self, key + ":" + value)
+    self.key = key
+    self.value = value
+
+  def sort_key(self):
+    return (2, self.key, self.value)
+
+
+class Task:
+  __slots__ = ("priority", "create_date", "complete_date", "__title", "__line", "__tokens", "__tag_spans", "__tags", "__start_date", "__due_date")
+
+  # marks derived dates that have not been parsed yet, as None means there is no date
+  __unparsed = object()
+
+  __task_re = LazyRegex(r"""
+    ^
+    ( x \s+ (?P<complete> [0-9]{4}-[0-9]{2}-[0-9]{2} ) \s+ )?
+    ( (?P<priority> \( [A-Z_] \) ) \s+ )?
+    ( (?P<create> [0-9]{4}-[0-9]{2}-[0-9]{2} ) \s+ )?
+    (?P<title> .*? )
+    $
+  """, re.VERBOSE)
+
+  # this is called for several dates on almost every line, so avoid the expense of strptime where possible
+  # the same dates recur throughout a todo file, so recently parsed dates are memoized too
+  @staticmethod
+  @functools.lru_cache(maxsize = 1024)
+  def __parse_date(date_str):
+    if date_str is None:
+      return None
+    try:
+      if len(date_str) == 10 and date_str[4] == "-" and date_str[7] == "-":
+        year, month, day = date_str[0:4], date_str[5:7], date_str[8:10]
+        if year.isdecimal() and month.isdecimal() and day.isdecimal():
+          return date(int(year), int(month), int(day))
+      # anything else is unusual (e.g. a single digit month), so defer to strptime to validate it
+      return datetime.strptime(date_str, "%Y-%m-%d").date()
+    except ValueError:
+      return None
+
+  @classmethod
+  def load_all(cls, env, path, allow_comments = False, cached = False):
+    with env.open_lines(path) as lines:
+      return dict(cls.iter_all(env, path, allow_comments, cached, lines))
+
+  # loads only the tasks for which keep(task) is true, so memory scales with the slice rather than the file
+  # the other lines are only selected if keep_other_lines is true, as they are needed to rewrite the file
+  # lines may be given as opened by env.open_lines, which must then stay open for as long as the other lines are used
+  # returns the kept tasks, the other lines, and the maximum id of any task
+  @classmethod
+  def load_matching(cls, env, path, keep, keep_other_lines, cached = False, lines = None):
+    if keep_other_lines and lines is None:
+      lines = env.read_lines(path)
+    tasks = {}
+    other_lines = LineSelection(lines) if keep_other_lines else {}
+    max_id = 0
+    for id, task in cls.iter_all(env, path, cached = cached, lines = lines):
+      if keep(task):
+        tasks[id] = task
+      elif keep_other_lines:
+        other_lines.add(id)
+      max_id = id
+    return tasks, other_lines, max_id
+
+  # yields (id, task) for each task in the file at path, in order
+  @classmethod
+  def iter_all(cls, env, path, allow_comments = False, cached = False, lines = None):
+    if cached and lines is None:
+      # the fingerprint must be of the same lines that are parsed
+      with env.open_lines(path) as lines:
+        yield from cls.iter_all(env, path, allow_comments, cached, lines)
+      return
+
+    fingerprint = env.fingerprint(path, lines) if cached else None
+    # the parser collects the records to cache, so is only needed when caching
+    parser = IncrementalParser(to_task = cls.from_record, from_task = cls.to_record) if fingerprint is not None else None
+    if fingerprint is not None:
+      cache = env.read_task_cache(path)
+      if cache is not None:
+        cache_fingerprint, entries = cache
+        if cache_fingerprint == fingerprint:
+          for id, line, record in entries:
+            yield id, cls.from_record(record)
+          return
+        # the file has changed, so only its new lines need parsing
+        parser = IncrementalParser({line: record for id, line, record in entries}, cls.from_record, cls.to_record)
+
+    # parsing in parallel would parse every line again
+    use_parallel = lines is not None and (parser is None or not parser.has_previous())
+    records = env.parse_records_in_parallel(path, lines, allow_comments) if use_parallel else None
+    if records is not None:
+      for id, record in records:
+        yield id, cls.from_record(record)
+      if fingerprint is not None:
+        env.write_task_cache(path, fingerprint, [(id, lines[id - 1], record) for id, record in records])
+      return
+
+    entries = []
+    for i, line in enumerate(lines if lines is not None else env.iter_lines(path)):
+      id = i + 1
+      if line.startswith("#"):
+        if allow_comments:
+          continue
+        else:
+          log.error("Found task starting with '#' which could be confused with a comment.")
+          sys.exit(1)
+      line1 = line.rstrip("\r\n")
+      if len(line1) > 0:
+        if parser is None:
+          yield id, cls.parse(line1)
+        else:
+          task = parser.parse(line1)
+          entries.append((id, line1, parser.parsed[line1]))
+          yield id, task
+
+    if parser is not None:
+      env.write_task_cache(path, fingerprint, entries)
+
+  # returns the (id, record) of each task in the given byte range of the file at path, whose first line has the given id
+  # or None if comments are not allowed and a line starts with '#'
+  # this is the work done by each process when parsing in parallel, so must be picklable by name
+  @classmethod
+  def parse_records(cls, path, first_id, start, end, allow_comments):
+    with open(path, "rb") as f:
+      f.seek(start)
+      data = f.read(end - start)
+    records = []
+    for i, line in enumerate(str(data, "utf-8").splitlines()):
+      if line.startswith("#"):
+        if allow_comments:
+          continue
+        return None
+      if len(line) > 0:
+        records.append((first_id + i, cls.parse(line).to_record()))
+    return records
+
+  @classmethod
+  def save_all(cls, env, tasks, path, preserve_line_numbers, comments = [], changed_ids = None, other_lines = {}):
+    # with stable line numbers, only the changed lines need to be encoded, though the whole file is written
+    if changed_ids is not None and len(comments) == 0 and preserve_line_numbers:
+      patches = {id: tasks[id].line if id in tasks else "" for id in changed_ids}
+      env.patch_lines(path, patches)
+      return
+
+    lines = []
+
+    if len(comments) > 0:
+      for comment in comments:
+        lines.append("# " + comment)
+      lines.append("")
+
+    # other_lines holds the lines of tasks that were not loaded, which are written back as they were
+    max_id = max(max(tasks.keys(), default = 0), max(other_lines.keys(), default = 0))
+    for id in range(1, max_id + 1):
+      if id in tasks:
+        task = tasks[id]
+        lines.append(task.line)
+      elif id in other_lines:
+        lines.append(other_lines[id])
+      elif preserve_line_numbers:
+        lines.append("")
+
+    env.write_lines(path, lines)
+
+  # saves the changed tasks of each file as save_all does, unless the file no longer has the lines that the tasks were loaded from
+  # in which case another process has written it since, e.g. todo.sh adding a task, and the changes are merged into its lines
+  # each of files is a (path, loaded_lines, modification_key, tasks, changed_ids, other_lines)
+  # modification_key is the key of the file when the lines were loaded, which saves comparing them if it has not changed
+  # loaded_lines are the base of the merge, so must be a copy of the lines as they were loaded, not a view of the file
+  # the changes that are written, rather than those the slice made, are journaled with the given comments while the files are locked,
+  # so that 'slice undo' reverts what was written even if the merge kept both versions of a task
+  @classmethod
+  def save_changes(cls, env, files, comments, preserve_line_numbers):
+    with contextlib.ExitStack() as stack:
+      writes = []
+      changes = {}
+      for path, loaded_lines, modification_key, tasks, changed_ids, other_lines in files:
+        stack.enter_context(env.lock_file(path))
+        write, file_changes = cls.__prepare_changes(env, path, loaded_lines, modification_key, tasks, changed_ids, other_lines, preserve_line_numbers)
+        writes.append(write)
+        if len(file_changes) > 0:
+          changes[path] = file_changes
+      journal_changes(env, comments, changes)
+      for write in writes:
+        write()
+
+  # returns a function that writes the changed tasks to the file at path, and the (line id, before, after) changes it writes
+  @classmethod
+  def __prepare_changes(cls, env, path, loaded_lines, modification_key, tasks, changed_ids, other_lines, preserve_line_numbers):
+    if modification_key is None or env.modification_key(path) != modification_key:
+      lines = env.read_lines(path)
+      if len(lines) != len(loaded_lines) or any(line != loaded_line for line, loaded_line in zip(lines, loaded_lines)):
+        return cls.__merge_changes(env, path, loaded_lines, lines, tasks, changed_ids, preserve_line_numbers)
+
+    changes = []
+    for id in sorted(changed_ids):
+      before = loaded_lines[id - 1] if id <= len(loaded_lines) and len(loaded_lines[id - 1]) > 0 else None
+      after = tasks[id].line if id in tasks else None
+      if before != after:
+        changes.append((id, before, after))
+    return lambda: cls.save_all(env, tasks, path, preserve_line_numbers, changed_ids = changed_ids, other_lines = other_lines), changes
+
+  # three-way merges the changed tasks, by line id, from the loaded lines into the lines now in the file at path
+  # a changed task whose line has also changed in the file is added as a new task instead, so neither change is lost
+  # the changes are by line id in the file as it is now, except that added lines are by their line id once written
+  @classmethod
+  def __merge_changes(cls, env, path, loaded_lines, lines, tasks, changed_ids, preserve_line_numbers):
+    # the loaded lines that are still in the file, by their index in each
+    if len(lines) >= len(loaded_lines) and all(line == loaded_line for line, loaded_line in zip(lines, loaded_lines)):
+      moved = range(len(loaded_lines))
+    else:
+      moved = cls.__match_lines(list(loaded_lines), lines)
+
+    merged_lines = list(lines)
+    added_lines = []
+    changes = []
+    for id in sorted(changed_ids):
+      task = tasks.get(id)
+      if id <= len(loaded_lines) and len(loaded_lines[id - 1]) > 0:
+        if id - 1 not in moved:
+          if task is not None:
+            log.warning("Task %d has been changed by someone else since it was loaded. Keeping both versions." % id)
+            added_lines.append(task.line)
+          else:
+            log.warning("Task %d has been changed by someone else since it was loaded. Not deleting it." % id)
+          continue
+        merged_lines[moved[id - 1]] = task.line if task is not None else None
+        changes.append((moved[id - 1] + 1, lines[moved[id - 1]], task.line if task is not None else None))
+      elif task is not None:
+        added_lines.append(task.line)
+
+    if preserve_line_numbers:
+      merged_lines = ["" if line is None else line for line in merged_lines]
+    else:
+      merged_lines = [line for line in merged_lines if line]
+    while len(merged_lines) > 0 and merged_lines[-1] == "":
+      merged_lines.pop()
+    changes.extend((len(merged_lines) + i + 1, None, line) for i, line in enumerate(added_lines))
+    return lambda: env.write_lines(path, merged_lines + added_lines), changes
+
+  # returns the index in b of each line of a that is still in b, in the same order
+  # as in patience diff, the common prefix and suffix are matched first, then the longest run of task lines in the same order in both,
+  # and then the lines between those, rather than diffing the whole files,
+  # which is quadratic in lines repeated as often as the empty lines of deleted tasks
+  @staticmethod
+  def __match_lines(a, b):
+    import bisect
+    moved = {}
+    regions = [(0, len(a), 0, len(b))]
+    while len(regions) > 0:
+      a_start, a_end, b_start, b_end = regions.pop()
+      while a_start < a_end and b_start < b_end and a[a_start] == b[b_start]:
+        moved[a_start] = b_start
+        a_start += 1
+        b_start += 1
+      while a_start < a_end and b_start < b_end and a[a_end - 1] == b[b_end - 1]:
+        a_end -= 1
+        b_end -= 1
+        moved[a_end] = b_end
+
+      # the k-th occurrence of a task line in a is paired with its k-th occurrence in b, so a unique line with itself
+      b_indexes = {}
+      for j in range(b_start, b_end):
+        if len(b[j]) > 0:
+          b_indexes.setdefault(b[j], []).append(j)
+      occurrences = {}
+      pairs = []
+      for i in range(a_start, a_end):
+        indexes = b_indexes.get(a[i])
+        if indexes is not None:
+          k = occurrences.get(a[i], 0)
+          occurrences[a[i]] = k + 1
+          if k < len(indexes):
+            pairs.append((i, indexes[k]))
+
+      # the longest run of pairs in the same order in both, by patience sorting
+      tails = []
+      tail_pairs = []
+      previous_pairs = []
+      for n, (i, j) in enumerate(pairs):
+        k = bisect.bisect_left(tails, j)
+        previous_pairs.append(tail_pairs[k - 1] if k > 0 else None)
+        if k == len(tails):
+          tails.append(j)
+          tail_pairs.append(n)
+        else:
+          tails[k] = j
+          tail_pairs[k] = n
+      anchors = []
+      n = tail_pairs[-1] if len(tail_pairs) > 0 else None
+      while n is not None:
+        anchors.append(pairs[n])
+        n = previous_pairs[n]
+      anchors.reverse()
+
+      if len(anchors) == 0:
+        continue
+      for i, j in anchors:
+        moved[i] = j
+      for (i, j), (next_i, next_j) in zip([(a_start - 1, b_start - 1)] + anchors, anchors + [(a_end, b_end)]):
+        if next_i - i > 1 and next_j - j > 1:
+          regions.append((i + 1, next_i, j + 1, next_j))
+    return moved
+
+  @classmethod
+  def sorted(cls, tasks, key = lambda task: task.line):
+    return {i + 1: task for i, task in enumerate(sorted(tasks.values(), key = key))}
+
+  @classmethod
+  def parse(cls, line):
+    m = cls.__task_re.match(line)
+    assert m is not None, "__task_re should match all lines: %s" % line
+    title = m.group("title")
+    priority = Priority.parse(m.group("priority")) if m.group("priority") else Priority(None)
+    create_date = cls.__parse_date(m.group("create"))
+    complete_date = cls.__parse_date(m.group("complete"))
+    return cls(title, priority, create_date, complete_date)
+
+  # builds a task from already tokenized title, avoiding a re-tokenize
+  # the title is only joined from the tokens if it is needed, e.g. when the line is written
+  @classmethod
+  def from_tokens(cls, tokens, priority, create_date, complete_date):
+    return cls(None, priority, create_date, complete_date, tokens = Tag.normalize_tokens(tokens))
+
+  # builds a task from a record returned by to_record, without parsing anything
+  @classmethod
+  def from_record(cls, record):
+    title, level, explicit, create_ordinal, complete_ordinal, start_ordinal, due_ordinal, tag_spans = record
+    to_date = lambda ordinal: date.fromordinal(ordinal) if ordinal > 0 else None
+    task = cls(title, Priority(level, explicit), to_date(create_ordinal), to_date(complete_ordinal))
+    task.__tag_spans = tag_spans
+    task.__start_date = to_date(start_ordinal)
+    task.__due_date = to_date(due_ordinal)
+    return task
+
+  def __init__(self, title, priority, create_date, complete_date, tokens = None):
+    assert title is not None or tokens is not None, "Expected either a title or tokens"
+    self.__title = title
+    self.priority = priority
+    self.create_date = create_date
+    self.complete_date = complete_date
+    self.__line = None
+    # the rest is derived data, computed lazily as most tasks are never inspected by the slice
+    self.__tokens = tokens
+    self.__tag_spans = None
+    self.__tags = None
+    self.__start_date = Task.__unparsed
+    self.__due_date = Task.__unparsed
+
+  @property
+  def title(self):
+    if self.__title is None:
+      self.__title = Tag.join_tokens(self.__tokens)
+    return self.__title
+
+  @property
+  def line(self):
+    if self.__line is None and not (self.complete_date or self.priority.explicit or self.create_date):
+      # share the title rather than copying it
+      self.__line = self.title
+    elif self.__line is None:
+      self.__line = "".join([
+        "x %s " % self.complete_date.isoformat() if self.complete_date else "",
+        self.priority.raw + (" " if len(self.priority.raw) > 0 else ""),
+        "%s " % self.create_date.isoformat() if self.create_date else "",
+        self.title
+      ])
+    return self.__line
+
+  @property
+  def tokens(self):
+    if self.__tokens is None:
+      if self.__tag_spans is not None:
+        self.__tokens = self.__decode_tag_spans(self.title, self.__tag_spans)
+      else:
+        self.__tokens = Tag.tokenize(self.__title)
+    return self.__tokens
+
+  @property
+  def tags(self):
+    if self.__tags is None:
+      self.__tags = { token for token in self.tokens if isinstance(token, Tag) }
+    return self.__tags
+
+  @property
+  def start_date(self):
+    if self.__start_date is Task.__unparsed:
+      self.__start_date = self.get_key_value_date("t")
+    return self.__start_date
+
+  @property
+  def due_date(self):
+    if self.__due_date is Task.__unparsed:
+      self.__due_date = self.get_key_value_date("due")
+    return self.__due_date
+
+  # returns a copy of this task with a different prefix, sharing the title and its derived data
+  def __with_prefix(self, priority, create_date, complete_date):
+    task = Task(self.__title, priority, create_date, complete_date, tokens = self.__tokens)
+    task.__tag_spans = self.__tag_spans
+    task.__tags = self.__tags
+    task.__start_date = self.__start_date
+    task.__due_date = self.__due_date
+    return task
+
+  # cheap check to avoid tokenizing tasks that cannot have the key:value tag
+  def __may_have_key_value_tag(self, key):
+    if self.__title is None:
+      return True
+    key_prefix = key + ":"
+    pos = self.__title.find(key_prefix)
+    while pos >= 0:
+      # tags must be preceded by whitespace or the start of the title
+      if pos == 0 or self.__title[pos - 1].isspace():
+        return True
+      pos = self.__title.find(key_prefix, pos + 1)
+    return False
+
+  # a compact form of the parsed task, containing only builtin types so it can be marshalled or pickled
+  def to_record(self):
+    to_ordinal = lambda d: d.toordinal() if d else 0
+    return (
+      self.title,
+      self.priority.level,
+      self.priority.explicit,
+      to_ordinal(self.create_date),
+      to_ordinal(self.complete_date),
+      to_ordinal(self.start_date),
+      to_ordinal(self.due_date),
+      self.__encode_tag_spans(self.tokens)
+    )
+
+  # each tag is encoded as (kind, start, separator, end) offsets into the title, where kind is as in Tag.sort_key
+  # this is much cheaper to store and load than the tokens themselves
+  @staticmethod
+  def __encode_tag_spans(tokens):
+    spans = array("I")
+    pos = 0
+    for token in tokens:
+      end = pos + len(str(token))
+      if isinstance(token, ContextTag):
+        spans.extend((0, pos, pos, end))
+      elif isinstance(token, ProjectTag):
+        spans.extend((1, pos, pos, end))
+      elif isinstance(token, KeyValueTag):
+        spans.extend((2, pos, pos + len(token.key), end))
+      pos = end
+    return spans.tobytes()
+
+  @staticmethod
+  def __decode_tag_spans(title, tag_spans):
+    spans = array("I")
+    spans.frombytes(tag_spans)
+    tokens = []
+    pos = 0
+    for i in range(0, len(spans), 4):
+      kind, start, sep, end = spans[i:i + 4]
+      if start > pos:
+        tokens.append(title[pos:start])
+      if kind == 2:
+        tokens.append(Tag.shared(title[start:end], kind, title[start:sep], title[sep + 1:end]))
+      else:
+        tokens.append(Tag.shared(title[start:end], kind, title[start + 1:end]))
+      pos = end
+    if len(title) > pos:
+      tokens.append(title[pos:])
+    return tokens
+
+  def __repr__(self):
+    return self.line
+
+  def __eq__(self, other):
+    return other is not None and self.line.__eq__(other.line)
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __hash__(self):
+    return self.line.__hash__()
+
+  def is_hidden(self, date):
+    return self.complete_date or (self.start_date and self.start_date > date)
+
+  def normalize(self, date):
+    task = self
+
+    priority = task.priority if not task.complete_date else Priority(None)
+    task = task.set_priority(priority.normalize(explicit_no_level = False))
+
+    task = task.remove_duplicate_tags()
+
+    if task.start_date and task.start_date <= date:
+      task = task.set_start_date(None)
+
+    # do this after all other tag operations, inc. setting start date (which is a tag)
+    task = task.normalize_tag_order()
+
+    return task
+
+  def normalize_tag_order(self):
+    tokens = self.tokens
+    tokens = Tag.sort_edge_tags(tokens, trailing = False)
+    tokens = Tag.sort_edge_tags(tokens, trailing = True)
+    return Task.from_tokens(tokens, self.priority, self.create_date, self.complete_date)
+
+  def remove_tags(self, tags):
+    tokens = [token for token in self.tokens if token not in tags]
+    return Task.from_tokens(tokens, self.priority, self.create_date, self.complete_date)
+
+  def remove_duplicate_tags(self):
+    tags = set()
+    tokens = []
+
+    for token in self.tokens:
+      if isinstance(token, Tag):
+        if token not in tags:
+          tags.add(token)
+          tokens.append(token)
+        else:
+          log.warning("Discarding duplicate tag: %s" % token)
+      else:
+        tokens.append(token)
+
+    return Task.from_tokens(tokens, self.priority, self.create_date, self.complete_date)
+
+  def add_tags(self, tags, trailing = True):
+    rem_tokens = [token for token in self.tokens if not isinstance(token, Tag) or token not in tags]
+    tokens = rem_tokens + list(tags) if trailing else list(tags) + rem_tokens
+    return Task.from_tokens(tokens, self.priority, self.create_date, self.complete_date)
+
+  def get_key_value_date(self, key):
+    tag = self.get_key_value_tag(key)
+    return self.__parse_date(tag.value) if tag else None
+
+  def get_key_value_tag(self, key):
+    if not self.__may_have_key_value_tag(key):
+      return None
+    # use self.tokens as it is a list, not a set, and thus will expose duplicates
+    tags = [tag for tag in self.tokens if isinstance(tag, KeyValueTag) and tag.key == key]
+    if len(tags) == 0:
+      return None
+    tag = tags.pop()
+    if len(tags) > 0:
+      log.warning("Ignoring duplicate tags: %s" % tags)
+    return tag
+
+  def pop_key_value_tag(self, key):
+    if not self.__may_have_key_value_tag(key):
+      return None, self
+    # use self.tokens as it is a list, not a set, and thus will expose duplicates
+    tags = [tag for tag in self.tokens if isinstance(tag, KeyValueTag) and tag.key == key]
+    if len(tags) == 0:
+      return None, self
+    task = self.remove_tags(set(tags))
+    tag = tags.pop()
+    if len(tags) > 0:
+      log.warning("Discarding duplicate tags: %s" % tags)
+    return tag, task
+
+  def set_priority(self, priority):
+    return self.__with_prefix(priority, self.create_date, self.complete_date)
+
+  def set_create_date(self, create_date):
+    return self.__with_prefix(self.priority, create_date, self.complete_date)
+
+  def set_start_date(self, start_date):
+    _, task = self.pop_key_value_tag("t")
+    if start_date:
+      task = task.add_tags({KeyValueTag("t", start_date.isoformat())})
+    return task
+
+
+# the columns of the tasks that slices select by, with one row per id so a task's row can be updated in place
+# dates are day ordinals and levels are 1 to 26 for A to Z, with 0 for none, and rows without a task are not present
+# selections are masks over the rows, computed with NumPy if it is available, and otherwise as bytes of 0 or 1 per row
+class TaskColumns:
+  __date_columns = ["create_dates", "start_dates", "due_dates", "complete_dates"]
+
+  def __init__(self, tasks, use_numpy = True):
+    self.__numpy = None
+    if use_numpy:
+      try:
+        import numpy
+        self.__numpy = numpy
+      except ImportError:
+        pass
+    self.present = bytearray()
+    self.levels = array("B")
+    for name in self.__date_columns:
+      setattr(self, name, array("q"))
+    for id, task in tasks.items():
+      self.update(id, task)
+
+  def __len__(self):
+    return len(self.present)
+
+  @staticmethod
+  def level_code(level):
+    return ord(level) - ord("A") + 1 if level else 0
+
+  # task is None if the task with the given id was removed
+  def update(self, id, task):
+    if id >= len(self):
+      grow_by = max(id + 1, 2 * len(self)) - len(self)
+      self.present.extend(bytes(grow_by))
+      self.levels.extend(bytes(grow_by))
+      for name in self.__date_columns:
+        getattr(self, name).extend(array("q", bytes(8 * grow_by)))
+    self.present[id] = task is not None
+    self.levels[id] = self.level_code(task.priority.level) if task else 0
+    for name, day in zip(self.__date_columns, [task.create_date, task.start_date, task.due_date, task.complete_date] if task else [None] * 4):
+      getattr(self, name)[id] = day.toordinal() if day else 0
+
+  def __column(self, name):
+    column = getattr(self, name)
+    if self.__numpy is None:
+      return column
+    return self.__numpy.frombuffer(column, dtype = self.__numpy.bool_ if name == "present" else self.__numpy.uint8 if name == "levels" else self.__numpy.int64)
+
+  # the mask of rows whose value in the named column compares true with value, a number or a list indexed by level
+  # e.g. where("start_dates", operator.gt, today) or where("create_dates", operator.le, cutoffs_by_level)
+  def where(self, name, compare, value):
+    column = self.__column(name)
+    if isinstance(value, list):
+      if self.__numpy is None:
+        return bytes(map(compare, column, map(value.__getitem__, self.levels)))
+      value = self.__numpy.array(value, dtype = self.__numpy.int64)[self.__column("levels")]
+      return compare(column, value)
+    if self.__numpy is None:
+      return bytes(map(compare, column, itertools.repeat(value)))
+    return compare(column, value)
+
+  # the mask of the rows with any of the given levels
+  def with_levels(self, levels):
+    if self.__numpy is None:
+      table = bytearray(256)
+      for level in levels:
+        table[level] = 1
+      return self.levels.tobytes().translate(table)
+    return self.__numpy.isin(self.__column("levels"), list(levels))
+
+  # the mask of the rows with the given ids
+  def with_ids(self, ids):
+    if self.__numpy is None:
+      mask = bytearray(len(self))
+      for id in ids:
+        mask[id] = 1
+      return bytes(mask)
+    mask = self.__numpy.zeros(len(self), dtype = self.__numpy.bool_)
+    mask[list(ids)] = True
+    return mask
+
+  def everything(self):
+    return self.__column("present") if self.__numpy is not None else bytes(self.present)
+
+  # the bytes of 0 or 1 are combined as big integers, so each operation is a single pass in C
+  def all(self, masks):
+    if self.__numpy is not None:
+      return functools.reduce(self.__numpy.logical_and, masks, self.everything())
+    bits = functools.reduce(lambda bits, mask: bits & int.from_bytes(mask, "little"), masks, int.from_bytes(self.present, "little"))
+    return bits.to_bytes(len(self), "little")
+
+  def any(self, masks):
+    if self.__numpy is not None:
+      return functools.reduce(self.__numpy.logical_or, masks, self.__numpy.zeros(len(self), dtype = self.__numpy.bool_))
+    bits = functools.reduce(lambda bits, mask: bits | int.from_bytes(mask, "little"), masks, 0)
+    return bits.to_bytes(len(self), "little")
+
+  def invert(self, mask):
+    if self.__numpy is not None:
+      return self.__numpy.logical_not(mask)
+    return (int.from_bytes(mask, "little") ^ int.from_bytes(b"\x01" * len(self), "little")).to_bytes(len(self), "little")
+
+  # the ids of the present rows in the mask, in order
+  def ids(self, mask):
+    mask = self.all([mask])
+    if self.__numpy is not None:
+      return self.__numpy.flatnonzero(mask).tolist()
+    return list(itertools.compress(range(len(self)), mask))
+
+
+# maps tags, priority levels and lowercase trigrams to the ids of the tasks containing them
+# each kind of posting list is built on first use, so a slice only pays for the lookups it makes
+# this only pays off when several slices are taken from the same tasks, as a single slice can simply scan them
+class TaskIndex:
+  def __init__(self, tasks, use_numpy = True):
+    self.tasks = tasks
+    self.use_numpy = use_numpy
+    self.__tag_ids = None
+    self.__level_ids = None
+    self.__trigram_ids = None
+    self.__columns = None
+
+  @staticmethod
+  def __add(postings, key, id):
+    if key in postings:
+      postings[key].add(id)
+    else:
+      postings[key] = {id}
+
+  @staticmethod
+  def __discard(postings, key, id):
+    if key in postings:
+      postings[key].discard(id)
+
+  @staticmethod
+  def __trigrams(task):
+    line = task.line.lower()
+    return {line[i:i + 3] for i in range(len(line) - 2)}
+
+  # updates the posting lists that have been built, after the task with the given id has changed in tasks
+  # old_task is None if the task was added, and new_task is None if it was removed
+  def update(self, id, old_task, new_task):
+    for task, update_postings in [(old_task, self.__discard), (new_task, self.__add)]:
+      if task is None:
+        continue
+      if self.__tag_ids is not None:
+        for tag in task.tags:
+          update_postings(self.__tag_ids, tag, id)
+      if self.__level_ids is not None:
+        update_postings(self.__level_ids, task.priority.level, id)
+      if self.__trigram_ids is not None:
+        for trigram in self.__trigrams(task):
+          update_postings(self.__trigram_ids, trigram, id)
+    if self.__columns is not None:
+      self.__columns.update(id, new_task)
+
+  def columns(self):
+    if self.__columns is None:
+      self.__columns = TaskColumns(self.tasks, self.use_numpy)
+    return self.__columns
+
+  def ids_with_tag(self, tag):
+    if self.__tag_ids is None:
+      self.__tag_ids = {}
+      for id, task in self.tasks.items():
+        for task_tag in task.tags:
+          self.__add(self.__tag_ids, task_tag, id)
+    return self.__tag_ids.get(tag, set())
+
+  # level is None for tasks without a priority
+  def ids_with_level(self, level):
+    if self.__level_ids is None:
+      self.__level_ids = {}
+      for id, task in self.tasks.items():
+        self.__add(self.__level_ids, task.priority.level, id)
+    return self.__level_ids.get(level, set())
+
+  # returns a superset of the ids of tasks whose line contains term (case-insensitive),
+  # or None if the term is too short to narrow the tasks down
+  def ids_maybe_containing(self, term):
+    term = term.lower()
+    if len(term) < 3:
+      return None
+
+    if self.__trigram_ids is None:
+      self.__trigram_ids = {}
+      for id, task in self.tasks.items():
+        for trigram in self.__trigrams(task):
+          self.__add(self.__trigram_ids, trigram, id)
+
+    empty = set()
+    return self.intersect([self.__trigram_ids.get(term[i:i + 3], empty) for i in range(len(term) - 2)])
+
+  # intersects the given sets of ids, smallest first; None stands for all ids
+  @staticmethod
+  def intersect(id_sets):
+    id_sets = sorted([ids for ids in id_sets if ids is not None], key = len)
+    if len(id_sets) == 0:
+      return None
+    ids = set(id_sets[0])
+    for other_ids in id_sets[1:]:
+      ids &= other_ids
+    return ids
+
+
+# the settings that slices use for every task, resolved once per run rather than looked up in the environment each time
+# a run that spans midnight still sees the day it started on
+class RunContext(collections.namedtuple("RunContext", ["today", "disable_filter", "preserve_line_numbers", "default_create_date"])):
+  __slots__ = ()
+
+  @classmethod
+  def resolve(cls, env):
+    today = env.today()
+    return cls(today, env.disable_filter(), env.preserve_line_numbers(), today if env.date_on_add() else None)
+
+
+class TaskSlice:
+  # the context is resolved from env if it is not given
+  def __init__(self, env, context = None):
+    self.env = env
+    self.context = context if context is not None else RunContext.resolve(env)
+
+  def comments(self):
+    raise NotImplementedError
+
+  def hidden(self, task):
+    return task.is_hidden(self.context.today) and not self.context.disable_filter
+
+  def matches(self, task):
+    raise NotImplementedError
+
+  # whether the task belongs in the slice
+  def selects(self, task):
+    return not self.hidden(task) and self.matches(task)
+
+  # returns a superset of the ids of the tasks that match, using the given TaskIndex, or None for all ids
+  def candidate_ids(self, index):
+    return None
+
+  # returns the ids of the tasks that the slice selects, as selects would, using the columns of the given TaskIndex
+  # or None if the slice cannot be selected by its columns
+  def selected_ids(self, index):
+    columns = index.columns()
+    today = self.context.today.toordinal()
+    mask = self.matches_mask(columns, today, index)
+    if mask is None:
+      return None
+    if not self.context.disable_filter:
+      mask = columns.all([mask, columns.invert(self.hidden_mask(columns, today))])
+    return columns.ids(mask)
+
+  def hidden_mask(self, columns, today):
+    return columns.any([columns.where("complete_dates", operator.ne, 0), columns.where("start_dates", operator.gt, today)])
+
+  # the mask of the tasks that match, as matches would, or None if it cannot be computed from the columns
+  def matches_mask(self, columns, today, index):
+    return None
+
+  # the key of a task in the slice file, where the sliced task is as apply returned it, and the original task as it was loaded
+  def sort_key(self, sliced_task, original_task):
+    return sliced_task.line
+
+  def apply(self, task):
+    raise NotImplementedError
+
+  def unapply(self, sliced_task, original_task):
+    raise NotImplementedError
+
+
+class AllTaskSlice(TaskSlice):
+  def comments(self):
+    return ["All tasks"]
+
+  def matches(self, task):
+    return True
+
+  def matches_mask(self, columns, today, index):
+    return columns.everything()
+
+  def apply(self, task):
+    sliced_task = task
+    sliced_task = sliced_task.set_create_date(None)
+    return sliced_task
+
+  def unapply(self, sliced_task, original_task):
+    task = sliced_task
+    task = task.set_create_date(original_task.create_date if original_task else self.context.default_create_date)
+    return task
+
+
+class FutureTaskSlice(TaskSlice):
+  def __init__(self, env, context = None):
+    TaskSlice.__init__(self, env, context)
+
+  def comments(self):
+    return ["Future tasks"]
+
+  def hidden(self, task):
+    return task.complete_date and not self.context.disable_filter
+
+  def matches(self, task):
+    return task.start_date and task.start_date > self.context.today
+
+  def hidden_mask(self, columns, today):
+    return columns.where("complete_dates", operator.ne, 0)
+
+  def matches_mask(self, columns, today, index):
+    return columns.where("start_dates", operator.gt, today)
+
+  def sort_key(self, sliced_task, original_task):
+    return sliced_task.start_date
+
+  def apply(self, task):
+    sliced_task = task
+    sliced_task = sliced_task.set_create_date(None)
+    return sliced_task
+
+  def unapply(self, sliced_task, original_task):
+    task = sliced_task
+    task = task.set_create_date(original_task.create_date if original_task else self.context.default_create_date)
+    return task
+
+
+class TermsTaskSlice(TaskSlice):
+  def __init__(self, env, inc_terms, exc_terms, context = None):
+    TaskSlice.__init__(self, env, context)
+    self.inc_terms = [term.lower() for term in inc_terms]
+    self.exc_terms = [term.lower() for term in exc_terms]
+
+  def comments(self):
+    if len(self.inc_terms) == 0 and len(self.exc_terms) == 0:
+      comment = "All tasks"
+    else:
+      comment = "Tasks "
+      if len(self.inc_terms) > 0:
+        comment += "including terms: " + " ".join(self.inc_terms)
+      if len(self.exc_terms) > 0:
+        if len(self.inc_terms) > 0:
+          comment += " and "
+        comment += "excluding terms: " + " ".join(self.exc_terms)
+    return [comment]
+
+  def matches(self, task):
+    task_line_lower = task.line.lower()
+
+    for term in self.inc_terms:
+      if not term in task_line_lower:
+        return False
+
+    for term in self.exc_terms:
+      if term in task_line_lower:
+        return False
+
+    return True
+
+  def candidate_ids(self, index):
+    return TaskIndex.intersect([index.ids_maybe_containing(term) for term in self.inc_terms])
+
+  def apply(self, task):
+    sliced_task = task
+    sliced_task = sliced_task.set_create_date(None)
+    return sliced_task
+
+  def unapply(self, sliced_task, original_task):
+    task = sliced_task
+    task = task.set_create_date(original_task.create_date if original_task else self.context.default_create_date)
+    return task
+
+
+class TagsTaskSlice(TaskSlice):
+  def __init__(self, env, priority = None, tags = set(), context = None):
+    TaskSlice.__init__(self, env, context)
+    self.priority = priority
+    self.tags = tags
+
+  def comments(self):
+    if not self.priority and len(self.tags) == 0:
+      comment = "All tasks"
+    else:
+      comment = "Tasks with "
+      if self.priority:
+        comment += "priority " + str(self.priority.normalize(explicit_no_level = True))
+      if len(self.tags) > 0:
+        if self.priority:
+          comment += " and "
+        comment += "tags: " + " ".join([str(tag) for tag in self.tags])
+    return [comment]
+
+  def matches(self, task):
+    return (not self.priority or task.priority == self.priority) and task.tags >= self.tags
+
+  def candidate_ids(self, index):
+    id_sets = [index.ids_with_tag(tag) for tag in self.tags]
+    if self.priority:
+      id_sets.append(index.ids_with_level(self.priority.level))
+    return TaskIndex.intersect(id_sets)
+
+  def matches_mask(self, columns, today, index):
+    masks = [columns.with_ids(index.ids_with_tag(tag)) for tag in self.tags]
+    if self.priority:
+      masks.append(columns.with_levels([TaskColumns.level_code(self.priority.level)]))
+    return columns.all(masks)
+
+  def apply(self, task):
+    sliced_task = task
+    sliced_task = sliced_task.remove_tags(self.tags)
+    sliced_task = sliced_task.set_priority(Priority(None) if self.priority else task.priority)
+    sliced_task = sliced_task.set_create_date(None)
+    return sliced_task
+
+  def unapply(self, sliced_task, original_task):
+    task = sliced_task
+    task = task.set_create_date(original_task.create_date if original_task else self.context.default_create_date)
+    if self.priority and not task.priority.level:
+      task = task.set_priority(self.priority)
+    task = task.add_tags(self.tags)
+    return task
+
+
+class ReviewTaskSlice(TaskSlice):
+  # intervals is the setting that priority_to_interval was parsed from, which the comments show
+  def __init__(self, env, intervals, priority_to_interval, context = None):
+    TaskSlice.__init__(self, env, context)
+    self.intervals = intervals
+    self.priority_to_interval = priority_to_interval
+
+  def comments(self):
+    return ["Reviewable tasks (%s)" % self.intervals]
+
+  def matches(self, task):
+    if not task.create_date:
+      return True
+
+    if task.start_date and task.start_date <= self.context.today:
+      return True
+
+    age = self.context.today - task.create_date
+    # unconfigured priorities will never escape the review
+    if task.priority in self.priority_to_interval:
+      interval = self.priority_to_interval[task.priority]
+      return age >= interval
+    else:
+      log.warning("Priority %s is not configured in TODOTXT_SLICE_REVIEW_INTERVALS. Ignoring task: %s" % (task.priority.normalize(explicit_no_level = True), task.line))
+      return False
+
+  def matches_mask(self, columns, today, index):
+    # a task is old enough to review if it was created on or before the cutoff for its level; unconfigured levels have none
+    cutoffs = [None] * (TaskColumns.level_code("Z") + 1)
+    for priority, interval in self.priority_to_interval.items():
+      cutoffs[TaskColumns.level_code(priority.level)] = today - interval.days
+    unconfigured_levels = [level for level, cutoff in enumerate(cutoffs) if cutoff is None]
+    cutoffs = [cutoff if cutoff is not None else -1 for cutoff in cutoffs]
+
+    undated = columns.where("create_dates", operator.eq, 0)
+    started = columns.all([columns.where("start_dates", operator.ne, 0), columns.where("start_dates", operator.le, today)])
+    unreviewed = columns.invert(columns.any([undated, started]))
+
+    # warn about the tasks that matches would, in order
+    visible = columns.everything() if self.context.disable_filter else columns.invert(self.hidden_mask(columns, today))
+    unconfigured = columns.with_levels(unconfigured_levels)
+    for id in columns.ids(columns.all([unreviewed, unconfigured, visible])):
+      task = index.tasks[id]
+      log.warning("Priority %s is not configured in TODOTXT_SLICE_REVIEW_INTERVALS. Ignoring task: %s" % (task.priority.normalize(explicit_no_level = True), task.line))
+
+    return columns.any([undated, started, columns.where("create_dates", operator.le, cutoffs)])
+
+  def apply(self, task):
+    sliced_task = task
+    sliced_task = sliced_task.set_priority(Priority(None, True))
+    sliced_task = sliced_task.set_create_date(None)
+    return sliced_task
+
+  def unapply(self, sliced_task, original_task):
+    task = sliced_task
+
+    if original_task and (task.priority.level or task.is_hidden(self.context.today)):
+      # successful review; reset create_date to today if it's not completed already
+      task = task.set_create_date(self.context.today if not task.complete_date else original_task.create_date)
+      task = task.set_priority(task.priority if task.priority.level else original_task.priority)
+    else:
+      # failed review; restore create_date and priority
+      task = task.set_create_date(original_task.create_date if original_task else self.context.default_create_date)
+      task = task.set_priority(original_task.priority if original_task else task.priority if task.priority.level else Priority(None))
+
+    return task
+
+
+# a clause of a query, compiled from its text once so that matching a task does no parsing
+# cost ranks how much work matching a task takes, so the planner can check the cheapest clauses first
+class QueryClause:
+  cost = 0
+
+  def matches(self, task):
+    raise NotImplementedError
+
+  # returns a superset of the ids of the tasks that match, using the given TaskIndex, or None for all ids
+  def candidate_ids(self, index):
+    return None
+
+
+class QueryPriorityClause(QueryClause):
+  cost = 0
+
+  # tasks without a priority have the level "_", which compares after "Z"
+  def __init__(self, compare, level):
+    self.compare = compare
+    self.level = level
+
+  def matches(self, task):
+    return self.compare(task.priority.level or "_", self.level)
+
+  def candidate_ids(self, index):
+    levels = [level for level in string.ascii_uppercase + "_" if self.compare(level, self.level)]
+    return set().union(*[index.ids_with_level(level if level != "_" else None) for level in levels])
+
+
+class QueryTagClause(QueryClause):
+  cost = 1
+
+  def __init__(self, tag):
+    self.tag = tag
+
+  def matches(self, task):
+    return self.tag in task.tags
+
+  def candidate_ids(self, index):
+    return index.ids_with_tag(self.tag)
+
+
+class QueryTermClause(QueryClause):
+  cost = 2
+
+  def __init__(self, term):
+    self.term = term.lower()
+
+  def matches(self, task):
+    return self.term in task.line.lower()
+
+  def candidate_ids(self, index):
+    return index.ids_maybe_containing(self.term)
+
+
+# compares a date of the task, or the value of one of its key:value tags, with a value
+# the value is compared as a date or an integer if it is one, and tasks without the date or tag never match
+class QueryCompareClause(QueryClause):
+  cost = 3
+
+  __dates = {
+    "created": lambda task: task.create_date,
+    "done": lambda task: task.complete_date,
+    "t": lambda task: task.start_date,
+    "due": lambda task: task.due_date,
+  }
+
+  def __init__(self, key, compare, value):
+    self.compare = compare
+    self.value = value
+    if key in self.__dates:
+      self.task_value = self.__dates[key]
+    elif isinstance(value, date):
+      self.task_value = lambda task: task.get_key_value_date(key)
+    elif isinstance(value, int):
+      self.task_value = lambda task: self.__int(task.get_key_value_tag(key))
+    else:
+      self.task_value = lambda task: task.get_key_value_tag(key).value if task.get_key_value_tag(key) else None
+
+  @staticmethod
+  def __int(tag):
+    try:
+      return int(tag.value) if tag else None
+    except ValueError:
+      return None
+
+  def matches(self, task):
+    task_value = self.task_value(task)
+    return task_value is not None and self.compare(task_value, self.value)
+
+
+class QueryNotClause(QueryClause):
+  def __init__(self, clause):
+    self.clause = clause
+    self.cost = clause.cost
+
+  def matches(self, task):
+    return not self.clause.matches(task)
+
+
+# the planner: the clauses are checked cheapest first, so the expensive ones are only checked for the tasks that remain
+class QueryAndClause(QueryClause):
+  def __init__(self, clauses):
+    self.clauses = sorted(clauses, key = lambda clause: clause.cost)
+    self.cost = sum(clause.cost for clause in clauses)
+
+  def matches(self, task):
+    return all(clause.matches(task) for clause in self.clauses)
+
+  def candidate_ids(self, index):
+    return TaskIndex.intersect([clause.candidate_ids(index) for clause in self.clauses])
+
+
+class QueryOrClause(QueryClause):
+  def __init__(self, clauses):
+    self.clauses = sorted(clauses, key = lambda clause: clause.cost)
+    self.cost = sum(clause.cost for clause in clauses)
+
+  def matches(self, task):
+    return any(clause.matches(task) for clause in self.clauses)
+
+  def candidate_ids(self, index):
+    id_sets = [clause.candidate_ids(index) for clause in self.clauses]
+    return None if any(ids is None for ids in id_sets) else set().union(*id_sets)
+
+
+# parses a query into a QueryClause, and the key to sort the tasks it matches by
+# a query is a sequence of words, which must all match, unless joined by 'or'
+# each word is one of:
+# - @context, +project or key:value, which match tasks with the tag
+# - pri<op>LEVEL, which compares the priority, e.g. pri<=B
+# - created, done, t (start) or due <op>DATE, which compare dates, where DATE may be today, today+N or today-N days
+# - key<op>VALUE, which compares the value of a key:value tag
+# - sort:FIELD, which sorts the tasks by pri, created, done, t, due or any other key
+# - any other word is a term that the task must contain (case-insensitive)
+# where <op> is one of =, !=, <, <=, > or >=
+# 'not WORD' or -WORD matches the tasks that WORD does not, and words can be grouped with parentheses
+class QueryParser:
+  __token_re = LazyRegex(r"\(|\)|[^\s()]+")
+  __compare_re = LazyRegex(r"^(?P<key>[\w-]+)(?P<op><=|>=|!=|=|<|>)(?P<value>\S+)$")
+  __today_re = LazyRegex(r"^today(?P<days>[+-]\d+)?$")
+
+  def __init__(self, text, today):
+    self.__compare_ops = {"=": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+    self.text = text
+    self.today = today
+    self.tokens = self.__token_re.findall(text)
+    self.pos = 0
+    self.sort_field = None
+    self.__nesting = 0
+    self.__sort_count = 0
+
+  def parse(self):
+    clause = self.__parse_or()
+    if self.pos < len(self.tokens):
+      self.__error("unexpected '%s'" % self.tokens[self.pos])
+    # a query of only sort:FIELD matches every task
+    return clause if clause is not None else QueryAndClause([])
+
+  def __error(self, message):
+    log.warning("Error parsing query '%s': %s" % (self.text, message))
+    sys.exit(1)
+
+  def __peek(self):
+    return self.tokens[self.pos].lower() if self.pos < len(self.tokens) else None
+
+  # parses a clause under 'not' or in parentheses, where sort:FIELD would not mean anything
+  def __parse_nested(self, parse):
+    self.__nesting += 1
+    clause = parse()
+    self.__nesting -= 1
+    return clause
+
+  # returns None if there are no clauses, e.g. for a query of only sort:FIELD
+  def __parse_or(self):
+    sort_count = self.__sort_count
+    clauses = [self.__parse_and()]
+    while self.__peek() == "or":
+      self.pos += 1
+      clauses.append(self.__parse_and())
+    if len(clauses) == 1:
+      return clauses[0]
+    if self.__sort_count != sort_count:
+      self.__error("sort:FIELD cannot be part of 'or'")
+    if any(clause is None for clause in clauses):
+      self.__error("expected a word on each side of 'or'")
+    return QueryOrClause(clauses)
+
+  def __parse_and(self):
+    clauses = []
+    while self.__peek() not in [None, "or", ")"]:
+      if self.__peek() == "and":
+        self.pos += 1
+        continue
+      clause = self.__parse_not()
+      if clause is not None:
+        clauses.append(clause)
+    if len(clauses) == 0:
+      return None
+    return clauses[0] if len(clauses) == 1 else QueryAndClause(clauses)
+
+  # returns None for sort:FIELD, which is not a clause
+  def __parse_not(self):
+    token = self.tokens[self.pos]
+    self.pos += 1
+    if token.lower() == "not":
+      if self.__peek() in [None, "or", "and", ")"]:
+        self.__error("expected a word after 'not'")
+      return QueryNotClause(self.__parse_nested(self.__parse_not))
+    if token == "(":
+      clause = self.__parse_nested(self.__parse_or)
+      if self.__peek() != ")":
+        self.__error("expected ')'")
+      self.pos += 1
+      if clause is None:
+        self.__error("expected a word in parentheses")
+      return clause
+    if token == ")":
+      self.__error("unexpected ')'")
+    if token.startswith("-") and len(token) > 1:
+      return QueryNotClause(self.__parse_nested(lambda: self.__parse_word(token[1:])))
+    return self.__parse_word(token)
+
+  def __parse_word(self, word):
+    if word.startswith("sort:") and len(word) > len("sort:"):
+      if self.__nesting > 0:
+        self.__error("sort:FIELD cannot be negated or in parentheses")
+      self.__sort_count += 1
+      self.sort_field = word[len("sort:"):]
+      return None
+
+    m = self.__compare_re.match(word)
+    if m:
+      key, compare, value = m.group("key"), self.__compare_ops[m.group("op")], m.group("value")
+      if key == "pri":
+        if len(value) != 1 or value not in string.ascii_uppercase + "_":
+          self.__error("%s is not a priority" % value)
+        return QueryPriorityClause(compare, value)
+      return QueryCompareClause(key, compare, self.__parse_value(key, value))
+
+    try:
+      return QueryTagClause(Tag.parse(word))
+    except ValueError:
+      return QueryTermClause(word)
+
+  def __parse_value(self, key, value):
+    m = self.__today_re.match(value)
+    if m:
+      return self.today + timedelta(days = int(m.group("days") or 0))
+    try:
+      return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+      pass
+    if key in ["created", "done", "t", "due"]:
+      self.__error("%s is not a date" % value)
+    try:
+      return int(value)
+    except ValueError:
+      return value
+
+
+class QueryTaskSlice(TaskSlice):
+  def __init__(self, env, text, context = None):
+    TaskSlice.__init__(self, env, context)
+    self.text = text
+    parser = QueryParser(text, self.context.today)
+    self.clause = parser.parse() if len(parser.tokens) > 0 else None
+    self.sort_field = parser.sort_field
+
+  def comments(self):
+    return ["Tasks matching query: %s" % self.text if self.clause else "All tasks"]
+
+  def matches(self, task):
+    return self.clause is None or self.clause.matches(task)
+
+  def candidate_ids(self, index):
+    return self.clause.candidate_ids(index) if self.clause else None
+
+  # tasks without the field sort last
+  # the field is of the original task, as apply removes the create date
+  def sort_key(self, sliced_task, original_task):
+    if self.sort_field is None:
+      return sliced_task.line
+    task = original_task
+    if self.sort_field == "pri":
+      value = task.priority.level or "_"
+    elif self.sort_field in ["created", "done", "t", "due"]:
+      value = {"created": task.create_date, "done": task.complete_date, "t": task.start_date, "due": task.due_date}[self.sort_field]
+    else:
+      tag = task.get_key_value_tag(self.sort_field)
+      value = tag.value if tag else None
+    return (value is None, value if value is not None else "", sliced_task.line)
+
+  def apply(self, task):
+    sliced_task = task
+    sliced_task = sliced_task.set_create_date(None)
+    return sliced_task
+
+  def unapply(self, sliced_task, original_task):
+    task = sliced_task
+    task = task.set_create_date(original_task.create_date if original_task else self.context.default_create_date)
+    return task
+
+
+class SliceEditor:
+  __slice_header = "slice: "
+  __checksum_header = "checksum: "
+
+  # tasks may be a subset of the todo file, as long as it includes every task the slice selects,
+  # in which case max_id must be the maximum id in the whole file
+  # page is the (offset, limit) of the tasks to edit, in the order of the slice, where limit None is all the rest
+  # or None to edit every task; the tasks outside the page are left as they are
+  def __init__(self, env, tasks, task_slice, index = None, max_id = None, page = None):
+    self.env = env
+    self.context = task_slice.context
+    self.tasks = tasks
+    self.task_slice = task_slice
+    self.page = page
+    # the comments of the slice are rendered once, for the slice file and the journal
+    self.slice_comments = task_slice.comments()
+    self.max_id = max_id if max_id is not None else max(tasks.keys()) if len(tasks) > 0 else 0
+    self.max_id_len = len(str(self.max_id))
+    self.editable_tasks = self.__get_editable_tasks(tasks, task_slice, self.max_id_len, index)
+    self.selected_count = len(self.editable_tasks)
+    if page is not None:
+      self.editable_tasks = self.__get_page(self.editable_tasks, page)
+    sorted_ids = sorted(self.editable_tasks.keys(), key = lambda id: self.task_slice.sort_key(self.editable_tasks[id], tasks[id]))
+    self.sorted_editable_tasks = {i + 1: self.editable_tasks[id] for i, id in enumerate(sorted_ids)}
+    self.recovered_editable_tasks = self.__recover_task_ids(self.editable_tasks)
+    # the ids of tasks deleted, edited or inserted by the last merge
+    self.changed_ids = set()
+
+  def __get_editable_tasks(self, tasks, task_slice, max_id_len, index):
+    selected_ids = task_slice.selected_ids(index) if index else None
+    if selected_ids is not None:
+      # the columns of the index select the tasks exactly
+      selected_tasks = [(id, tasks[id]) for id in selected_ids]
+    else:
+      # the index only narrows down the tasks, so they must still be matched individually
+      candidate_ids = task_slice.candidate_ids(index) if index else None
+      candidate_tasks = tasks.items() if candidate_ids is None else [(id, tasks[id]) for id in sorted(candidate_ids)]
+      selected_tasks = [(id, task) for id, task in candidate_tasks if task_slice.selects(task)]
+
+    editable_tasks = {}
+    for id, task in selected_tasks:
+      id_tag = KeyValueTag("i", str(id).zfill(max_id_len))
+      editable_task = task_slice.apply(task)
+      editable_task = editable_task.add_tags({id_tag}, trailing = False)
+      editable_tasks[id] = editable_task
+    return editable_tasks
+
+  # a heap picks the first offset + limit tasks, so the tasks after the page are never sorted
+  def __get_page(self, editable_tasks, page):
+    import heapq
+    offset, limit = page
+    key = lambda item: self.task_slice.sort_key(item[1], self.tasks[item[0]])
+    if limit is None:
+      page_items = sorted(editable_tasks.items(), key = key)[offset:]
+    else:
+      page_items = heapq.nsmallest(offset + limit, editable_tasks.items(), key = key)[offset:]
+    return dict(page_items)
+
+  def comments(self):
+    comments = self.slice_comments
+    if self.page is not None:
+      offset = self.page[0]
+      comments = comments + ["Page of tasks %d-%d of %d" % (offset + 1, offset + len(self.editable_tasks), self.selected_count)]
+    return comments
+
+  def __recover_task_ids(self, edited_tasks):
+    recovered_edited_tasks = {}
+    next_id = self.max_id + 1
+    for task in edited_tasks.values():
+      id = None
+      id_tag, task = task.pop_key_value_tag("i")
+      if id_tag:
+        try:
+          tmpid = int(id_tag.value)
+          if tmpid in self.editable_tasks: # safety check
+            id = tmpid
+          else:
+            log.warning("Ignoring unknown id: %s" % id_tag)
+        except ValueError:
+          log.warning("Ignoring invalid id: %s" % id_tag)
+      if id is None:
+        id = next_id
+        next_id += 1
+      recovered_edited_tasks[id] = task
+    return recovered_edited_tasks
+
+  def __merge_edited_tasks(self, edited_tasks):
+    recovered_edited_tasks = self.__recover_task_ids(edited_tasks)
+    merged_tasks = self.tasks.copy()
+    self.changed_ids = set()
+
+    for id in self.editable_tasks.keys() - recovered_edited_tasks.keys():
+      existing_task = merged_tasks[id]
+      self.env.print_diff(id, self.max_id_len, existing_task, None)
+      del merged_tasks[id]
+      self.changed_ids.add(id)
+
+    for id, edited_task in recovered_edited_tasks.items():
+      # don't write changes that are only due to normalization
+      is_new = id not in self.recovered_editable_tasks
+      is_edited = not is_new and edited_task != self.recovered_editable_tasks[id]
+      if is_new or is_edited:
+        existing_task = merged_tasks[id] if is_edited else None
+
+        task = self.task_slice.unapply(edited_task, existing_task)
+
+        # normalize tag order etc
+        task = task.normalize(self.context.today)
+
+        is_edited_after_normalize = task != existing_task
+        if is_edited_after_normalize:
+            self.env.print_diff(id, self.max_id_len, existing_task, task)
+            merged_tasks[id] = task
+            self.changed_ids.add(id)
+
+    return merged_tasks
+
+  def __edit(self, tasks):
+    # we want the file to be named todo.txt for compatibility with syntax-highlighting editors
+    with self.env.create_temp_dir() as temp_dir_path:
+      temp_todo_path = os.path.join(temp_dir_path, "todo.txt")
+      Task.save_all(self.env, tasks, temp_todo_path, self.context.preserve_line_numbers, comments = self.comments())
+      self.env.subprocess_check_call(self.env.editor_path(), [temp_todo_path])
+      return Task.load_all(self.env, temp_todo_path, allow_comments = True)
+
+  def edit_and_merge(self):
+    edited_tasks = self.__edit(self.sorted_editable_tasks)
+    return self.merge(edited_tasks)
+
+  # writes the slice to path for editing elsewhere, e.g. by a script
+  # the header identifies the slice, given by the args that built it, and the checksum of its tasks
+  def export(self, path, slice_args):
+    import shlex
+    header = [self.__slice_header + shlex.join(slice_args), self.__checksum_header + self.checksum()]
+    Task.save_all(self.env, self.sorted_editable_tasks, path, self.context.preserve_line_numbers, comments = header + self.comments())
+
+  # returns the slice args and checksum in the header of lines written by export, or None if there is no header
+  @classmethod
+  def read_export_header(cls, lines):
+    import shlex
+    headers = {}
+    for line in lines:
+      if not line.startswith("#"):
+        break
+      for header in [cls.__slice_header, cls.__checksum_header]:
+        if line.startswith("# " + header):
+          headers[header] = line[len("# " + header):]
+    if len(headers) < 2 or len(headers[cls.__slice_header].strip()) == 0:
+      return None
+    return shlex.split(headers[cls.__slice_header]), headers[cls.__checksum_header]
+
+  # merges tasks edited elsewhere, e.g. loaded from a file written by export
+  def merge(self, edited_tasks):
+    try:
+      merged_tasks = self.__merge_edited_tasks(edited_tasks)
+    finally:
+      self.env.flush_diffs()
+    return merged_tasks
+
+  # identifies the tasks in the slice by their ids and lines
+  # if this changes between export and merge, the slice is out of date and the ids in it may be wrong
+  # tasks added to the todo file meanwhile do not change it, as they are not in the slice
+  def checksum(self):
+    import hashlib
+    digest = hashlib.sha1()
+    for id in sorted(self.editable_tasks.keys()):
+      digest.update(("%d %s\n" % (id, self.tasks[id].line)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# parses lines into tasks, reusing what lines parsed into before, so when a file changes only its new lines are parsed
+# lines are keyed by their content rather than their position, so inserted, removed and moved lines are reused too
+# previous maps lines to what they were parsed into, which may be records (for the task cache) or tasks (for a TaskStore),
+# with to_task and from_task converting between them
+class IncrementalParser:
+  def __init__(self, previous = {}, to_task = lambda task: task, from_task = lambda task: task):
+    self.__previous = previous
+    self.__to_task = to_task
+    self.__from_task = from_task
+    # maps the lines parsed so far to what they parsed into, to be passed as previous next time
+    self.parsed = {}
+    self.parse_count = 0
+
+  def has_previous(self):
+    return len(self.__previous) > 0
+
+  def parse(self, line):
+    parsed = self.parsed.get(line)
+    if parsed is None:
+      parsed = self.__previous.get(line)
+    if parsed is not None:
+      self.parsed[line] = parsed
+      return self.__to_task(parsed)
+
+    self.parse_count += 1
+    task = Task.parse(line)
+    self.parsed[line] = self.__from_task(task)
+    return task
+
+
+# all the tasks of a todo file, kept in memory by the slice server between requests
+# the file is checked for changes before each request, and only new lines are parsed
+class TaskStore:
+  def __init__(self, env, path):
+    self.env = env
+    self.path = path
+    self.lines = []
+    self.tasks = {}
+    self.max_id = 0
+    self.index = TaskIndex(self.tasks)
+    self.__modification_key = None
+
+  def refresh(self):
+    modification_key = self.env.modification_key(self.path)
+    if modification_key is not None and modification_key == self.__modification_key:
+      return
+
+    lines = self.env.read_lines(self.path)
+    if any(line.startswith("#") for line in lines):
+      log.error("Found task starting with '#' which could be confused with a comment.")
+      sys.exit(1)
+
+    # without preserved line numbers, deleting a task moves every later one, but they are still not parsed again
+    parser = IncrementalParser({self.lines[id - 1]: task for id, task in self.tasks.items()})
+    for i in range(max(len(lines), len(self.lines))):
+      line = lines[i] if i < len(lines) else ""
+      if i < len(self.lines) and line == self.lines[i]:
+        continue
+      id = i + 1
+      old_task = self.tasks.pop(id, None)
+      new_task = parser.parse(line) if len(line) > 0 else None
+      if new_task is not None:
+        self.tasks[id] = new_task
+      self.index.update(id, old_task, new_task)
+
+    self.lines = lines
+    self.max_id = len(lines)
+    while self.max_id > 0 and len(lines[self.max_id - 1]) == 0:
+      self.max_id -= 1
+    self.__modification_key = modification_key
+
+  def editor(self, task_slice, page = None):
+    self.refresh()
+    return SliceEditor(self.env, self.tasks, task_slice, index = self.index, max_id = self.max_id, page = page)
+
+  def save(self, editor, merged_tasks):
+    if len(editor.changed_ids) == 0:
+      return
+    changed_tasks = {id: merged_tasks[id] for id in editor.changed_ids if id in merged_tasks}
+    other_lines = {} if editor.context.preserve_line_numbers else {
+        id: line for id, line in enumerate(self.lines, 1) if len(line) > 0 and id not in editor.changed_ids}
+    Task.save_changes(self.env, [(self.path, self.lines, self.__modification_key, changed_tasks, editor.changed_ids, other_lines)],
+        editor.slice_comments, editor.context.preserve_line_numbers)
+    # the next refresh reads the file again, but only parses the lines that were saved
+    self.__modification_key = None
+
+
+# the tasks of one or more todo files, such as todo.txt and done.txt, in a single id space
+# the tasks of the first file keep their line numbers as ids, and those of each later file are offset by the next power of ten
+# past the ids before them, so the line number still shows in the id, e.g. with 350 lines in todo.txt, i:1007 is line 7 of done.txt
+# ids past those of the last file are new tasks, which are appended to the first file
+# each file is streamed through Task.load_matching, so only the tasks that the slice selects are kept in memory
+# and the parsed tasks of each file are cached separately; only the files whose tasks change are written
+class TaskFiles:
+  def __init__(self, env, paths):
+    self.env = env
+    self.paths = paths
+    self.__stack = contextlib.ExitStack()
+    self.__offsets = []
+    self.__max_ids = []
+    self.__other_lines = []
+    self.__loaded_lines = []
+    self.__modification_keys = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return self.__stack.__exit__(*exc_info)
+
+  # the other lines of each file are only needed if it must be rewritten, so each file stays open until exit
+  def editor(self, task_slice, page = None):
+    tasks = {}
+    offset = 0
+    for path in self.paths:
+      # the key is taken first, so a change while the lines are read is seen when saving
+      self.__modification_keys.append(self.env.modification_key(path))
+      lines = self.__stack.enter_context(self.env.open_lines(path))
+      self.__loaded_lines.append(lines)
+      file_tasks, other_lines, max_id = Task.load_matching(self.env, path, task_slice.selects,
+          keep_other_lines = not task_slice.context.preserve_line_numbers, cached = True, lines = lines)
+      tasks.update((offset + id, task) for id, task in file_tasks.items())
+      self.__offsets.append(offset)
+      self.__max_ids.append(max_id)
+      self.__other_lines.append(other_lines)
+      offset = 10 ** len(str(offset + max_id))
+    return SliceEditor(self.env, tasks, task_slice, max_id = self.__offsets[-1] + self.__max_ids[-1], page = page)
+
+  # returns the index of the file of the task with the given id, and its line number in that file
+  def locate(self, id):
+    last_id = self.__offsets[-1] + self.__max_ids[-1]
+    if id > last_id:
+      return 0, self.__max_ids[0] + id - last_id
+    for i in reversed(range(len(self.paths))):
+      if id > self.__offsets[i]:
+        return i, id - self.__offsets[i]
+
+  def save(self, editor, merged_tasks):
+    changed_ids = [set() for path in self.paths]
+    for id in editor.changed_ids:
+      i, line_id = self.locate(id)
+      changed_ids[i].add(line_id)
+    file_tasks = [{} for path in self.paths]
+    for id, task in merged_tasks.items():
+      i, line_id = self.locate(id)
+      file_tasks[i][line_id] = task
+    Task.save_changes(self.env, [
+        (path, self.__loaded_lines[i], self.__modification_keys[i], file_tasks[i], changed_ids[i], self.__other_lines[i])
+        for i, path in enumerate(self.paths) if len(changed_ids[i]) > 0], editor.slice_comments, editor.context.preserve_line_numbers)
+
+
+# times and counts calls to the hot paths of slice, and counts the tasks created
+# the functions are wrapped for the duration of a run rather than checking whether this is enabled on every call,
+# so this costs nothing unless enabled
+class Instrumentation:
+  __targets = [
+    (Task, "load_all"),
+    (Task, "load_matching"),
+    (Task, "parse"),
+    (Tag, "tokenize"),
+    (Task, "normalize"),
+    (Task, "save_all"),
+    (SliceEditor, "_SliceEditor__get_editable_tasks"),
+    (SliceEditor, "_SliceEditor__recover_task_ids"),
+    (SliceEditor, "_SliceEditor__merge_edited_tasks"),
+  ]
+
+  def __init__(self):
+    # maps names to [calls, seconds], where seconds includes the time in any other instrumented function called
+    self.stats = {}
+    self.task_count = 0
+    self.__originals = []
+
+  def install(self, env):
+    for cls, attr in self.__targets:
+      original = cls.__dict__[attr]
+      name = "%s.%s" % (cls.__name__, attr.replace("_%s" % cls.__name__, ""))
+      if isinstance(original, classmethod):
+        wrapper = classmethod(self.__timed(name, original.__func__))
+      else:
+        wrapper = self.__timed(name, original)
+      self.__originals.append((cls, attr, original))
+      setattr(cls, attr, wrapper)
+
+    original_init = Task.__init__
+    def counted_init(task, *args, **kwargs):
+      self.task_count += 1
+      original_init(task, *args, **kwargs)
+    self.__originals.append((Task, "__init__", original_init))
+    Task.__init__ = counted_init
+
+    # the editor is timed on the env, as that is what runs it
+    self.__original_env_call = env.__dict__.get("subprocess_check_call")
+    if hasattr(env, "subprocess_check_call"):
+      env.subprocess_check_call = self.__timed("editor", env.subprocess_check_call)
+
+  def uninstall(self, env):
+    for cls, attr, original in reversed(self.__originals):
+      setattr(cls, attr, original)
+    self.__originals = []
+    if self.__original_env_call is not None:
+      env.subprocess_check_call = self.__original_env_call
+    elif "subprocess_check_call" in env.__dict__:
+      del env.subprocess_check_call
+
+  def __timed(self, name, function):
+    import time
+    stats = self.stats.setdefault(name, [0, 0.0])
+    perf_counter = time.perf_counter
+    def wrapper(*args, **kwargs):
+      start = perf_counter()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        stats[0] += 1
+        stats[1] += perf_counter() - start
+    return wrapper
+
+  def report(self):
+    return {
+        "functions": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in self.stats.items()},
+        "task_allocations": self.task_count,
+        }
+
+  def summary(self):
+    lines = ["%-40s %10s %12s" % ("function", "calls", "ms")]
+    for name, (calls, seconds) in sorted(self.stats.items(), key = lambda item: item[1][1], reverse = True):
+      lines.append("%-40s %10d %12.3f" % (name, calls, seconds * 1000))
+    lines.append("%-40s %10d" % ("Task allocations", self.task_count))
+    return "\n".join(lines)
+
+
+# instruments the run in the context if TODOTXT_SLICE_STATS is set, writing a summary to stderr if it is 1,
+# and otherwise writing JSON to the file it names
+# the run is profiled too if TODOTXT_SLICE_PROFILE is set, dumping the profile to the file it names
+# like the other flags, either is off if it is empty or 0
+@contextlib.contextmanager
+def instrumented(env):
+  stats_path = env.slice_stats()
+  profile_path = env.slice_profile()
+  instrumentation = Instrumentation() if stats_path not in ["", "0"] else None
+  profile = None
+  if profile_path not in ["", "0"]:
+    import cProfile
+    profile = cProfile.Profile()
+
+  if instrumentation is not None:
+    instrumentation.install(env)
+  if profile is not None:
+    profile.enable()
+  try:
+    yield
+  finally:
+    if profile is not None:
+      profile.disable()
+      profile.dump_stats(profile_path)
+    if instrumentation is not None:
+      instrumentation.uninstall(env)
+      if stats_path == "1":
+        print(instrumentation.summary(), file = sys.stderr)
+      else:
+        import json
+        with open(stats_path, "w", encoding = "utf-8") as f:
+          json.dump(instrumentation.report(), f, indent = 2)
+
+
+def usage():
+  # TODO: detect script name
+  print("  slice <command> [<args>]")
+  print("    Opens a 'slice' of your tasks in $EDITOR.")
+  print("    After editing, changes to the slice will be merged back into todo.txt,")
+  print("    and a colorized diff will be printed to the console.")
+  print()
+  print("    Note: In order to merge changes to the slice back into todo.txt, each task in the")
+  print("          slice is 'tagged' with its line number. The first task is tagged with 'i:1',")
+  print("          the second 'i:2', etc. Because this uses the standard key:value tag format, the")
+  print("          slice is still a valid todo file, and editor plugins will continue to work.")
+  print()
+  print("    Note: The -t, -n and -x options of todo.sh are supported.")
+  print("          These should be placed before 'slice'.")
+  print()
+  print("    Note: Set TODOTXT_SLICE_CACHE=1 to cache parsed tasks in $TODO_DIR/.slice-cache.")
+  print("          This speeds up slicing a large todo.txt that has not changed since the last run.")
+  print()
+  print("    Note: Set TODOTXT_SLICE_JOBS=<n> to parse a large todo.txt in <n> processes.")
+  print()
+  print("    Note: Set TODOTXT_SLICE_STATS=1 to print the time spent in each step of slicing to stderr,")
+  print("          or TODOTXT_SLICE_STATS=<file> to write it to <file> as JSON.")
+  print("          Set TODOTXT_SLICE_PROFILE=<file> to write a cProfile profile to <file>. Either is off if 0.")
+  print()
+  print("    export [-o FILE] <command> [<args>]")
+  print("      Writes the slice to FILE, or to stdout, rather than opening it in $EDITOR.")
+  print("      The slice starts with a header identifying the slice and the tasks in it.")
+  print()
+  print("    apply [FILE]")
+  print("      Merges a slice written by 'export' and since edited back into todo.txt,")
+  print("      reading it from FILE, or from stdin.")
+  print("      Fails if the tasks in the slice have changed in todo.txt since it was written.")
+  print()
+  print("    serve [SOCKET]")
+  print("      Serves 'export' and 'apply' on the unix socket SOCKET, or $TODOTXT_SLICE_SOCKET.")
+  print("      The tasks are kept in memory between requests, and only changed lines are parsed again.")
+  print("      When TODOTXT_SLICE_SOCKET is set, 'export' and 'apply' are sent to the server.")
+  print("      The server stops on Ctrl-C or SIGTERM, and will not start if another one is serving SOCKET.")
+  print()
+  print("    undo [N]")
+  print("      Reverts the changes saved by the last slice, or by change N in the log.")
+  print("      Tasks that have changed again since are left as they are. Undoing an undo redoes it.")
+  print()
+  print("    log [N]")
+  print("      Lists the changes saved by each slice, or shows the changes of change N.")
+  print("      Changes are journaled in $TODO_DIR/.slice-journal, unless TODOTXT_SLICE_JOURNAL=0.")
+  print("      It keeps the last TODOTXT_SLICE_JOURNAL_SIZE changes (100 by default).")
+  print()
+  print("    --limit N [--offset M] <command> [<args>]")
+  print("      Opens only the first N tasks of the slice, in the order it sorts them, after skipping M.")
+  print("      The tasks outside the page are left as they are, so a large slice can be edited a page")
+  print("      at a time. Either option may be given alone, and they may also follow 'export'.")
+  print()
+  print("    done <command> [<args>]")
+  print("      Opens the slice of the tasks in done.txt as well as todo.txt, including completed tasks.")
+  print("      The ids of the tasks in done.txt start at the next power of ten after those in todo.txt,")
+  print("      e.g. 'i:1007' for the 7th task in done.txt when todo.txt has fewer than 1000 lines.")
+  print("      New tasks are added to todo.txt, and only the files whose tasks change are written.")
+  print("      'done' may also follow 'export'.")
+  print()
+  print("    all")
+  print("      Opens all tasks.")
+  print()
+  print("    future")
+  print("      Opens tasks with a start date (t:<date>) in the future, sorted by start date.")
+  print()
+  print("    terms [TERM...]")
+  print("      Opens tasks matching all TERM(s).")
+  print("      TERM(s) preceded by a minus sign (i.e. -TERM) are excluded rather than included.")
+  print("      If no TERM(s) are supplied, all tasks will be opened.")
+  print()
+  print("    tags [PRIORITY] [TAG...]")
+  print("      Opens tasks matching PRIORITY and/or TAG(s).")
+  print("      After editing, PRIORITY and TAG(s) will be applied to all edited tasks.")
+  print("      If neither PRIORITY nor TAG(s) are supplied, all tasks will be opened.")
+  print()
+  print("      PRIORITY must be a letter, A-Z, or an underscore, indicating an unprioritized task.")
+  print("      TAG(s) can be @contexts, +projects or custom key:value extensions.")
+  print()
+  print("      'tags' differs from 'terms' in that:")
+  print("      - PRIORITY and TAG(s) will be hidden during editing")
+  print("      - PRIORITY and TAG(s) will be automatically applied to all edited tasks")
+  print("      - 'tags' can only match PRIORITY and TAG(s), whereas 'terms' can match any text")
+  print("      - 'tags' can only perform positive matches, whereas 'terms' can exclude terms")
+  print()
+  print("    query [WORD...]")
+  print("      Opens tasks matching all WORD(s), or either side of 'or'. Each WORD is one of:")
+  print("      - @context, +project or key:value, matching tasks with the tag")
+  print("      - pri<op>LEVEL, comparing the priority, where '_' (no priority) comes after 'Z'")
+  print("      - created, done, t (start) or due<op>DATE, comparing dates, where DATE may be")
+  print("        YYYY-MM-DD, today, today+N or today-N")
+  print("      - key<op>VALUE, comparing the value of a key:value tag as a date, number or text")
+  print("      - sort:FIELD, sorting the tasks by pri, created, done, t, due or a key")
+  print("      - any other TERM, matching tasks that contain it")
+  print("      where <op> is one of =, !=, <, <=, > or >=.")
+  print("      'not WORD' or -WORD excludes rather than includes, and WORD(s) can be grouped")
+  print("      with parentheses, e.g. 'slice query \"(pri<=B or due<=today+7) -@waiting sort:due\"'.")
+  print("      The cheapest WORD(s) are checked first, and the index narrows down the tasks to check.")
+  print()
+  print("    review")
+  print("      Opens tasks for review:")
+  print("      - after they have reached a certain age (depends on the priority - see below)")
+  print("      - when their start date (t:<date>) expires")
+  print("      - if they don't have a creation date")
+  print()
+  print("      Reviews can be dismissed by setting a new priority, setting a start date in the")
+  print("      future, or completing the task.")
+  print()
+  print("      After review the task will have its creation date reset to the current date.")
+  print()
+  print("      The review age for each priority must be defined in the environment variable")
+  print("      TODOTXT_SLICE_REVIEW_INTERVALS, which should consist of <priority>:<interval>")
+  print("      pairs separated by commas.")
+  print()
+  print("      An underscore can be used to define an interval for unprioritized tasks.")
+  print()
+  print("      For example, TODOTXT_SLICE_REVIEW_INTERVALS='_:0,A:1,B:7,C:56,Z:182' means:")
+  print("      - unprioritized tasks should be reviewed immediately")
+  print("      - 'A' tasks should be reviewed after 1 day")
+  print("      - 'B' tasks should be reviewed after 7 days")
+  print("      - 'C' tasks should be reviewed after 56 days")
+  print("      - 'Z' tasks should be reviewed after 182 days")
+  print()
+
+
+def build_all_slice(env, args, context):
+  return AllTaskSlice(env, context)
+
+
+def build_future_slice(env, args, context):
+  return FutureTaskSlice(env, context)
+
+
+def build_terms_slice(env, args, context):
+  inc_terms = []
+  exc_terms = []
+
+  for term in args:
+    if term.startswith("-"):
+      exc_terms.append(term[1:])
+    else:
+      inc_terms.append(term)
+
+  return TermsTaskSlice(env, inc_terms, exc_terms, context)
+
+
+def build_tags_slice(env, args, context):
+  priority = None
+  tags = set()
+  argstr = " ".join(args)
+
+  if len(args) > 0:
+    priority_level = args[0]
+    try:
+      priority = Priority.parse("(%s)" % priority_level)
+      args.pop(0)
+    except ValueError:
+      # try parsing as a tag instead
+      pass
+
+  while len(args) > 0:
+    arg = args.pop()
+    try:
+      tag = Tag.parse(arg)
+      tags.add(tag)
+    except ValueError:
+      log.warning("Error parsing args '%s': expected [PRIORITY] [TAG...]" % argstr)
+      sys.exit(1)
+
+  return TagsTaskSlice(env, priority, tags, context)
+
+
+def build_review_slice(env, args, context):
+  priority_to_interval = {}
+
+  slice_review_intervals = env.slice_review_intervals()
+  priority_interval_strs = slice_review_intervals.split(",") if len(slice_review_intervals) > 0 else []
+  for priority_interval_str in priority_interval_strs:
+    pair = priority_interval_str.split(":")
+    if len(pair) != 2:
+      log.warning("Error parsing TODOTXT_SLICE_REVIEW_INTERVALS='%s': expected <priority>:<interval> pairs separated by commas" % slice_review_intervals)
+      sys.exit(1)
+
+    [priority_level, interval_str] = pair
+
+    try:
+      priority = Priority.parse("(%s)" % priority_level)
+    except ValueError:
+      log.warning("Error parsing TODOTXT_SLICE_REVIEW_INTERVALS='%s': %s is not a priority" % (slice_review_intervals, priority_level))
+      sys.exit(1)
+
+    try:
+      interval = int(interval_str)
+    except ValueError:
+      log.warning("Error parsing TODOTXT_SLICE_REVIEW_INTERVALS='%s': %s is not an integer" % (slice_review_intervals, interval_str))
+      sys.exit(1)
+
+    priority_to_interval[priority] = timedelta(days = interval)
+
+  return ReviewTaskSlice(env, slice_review_intervals, priority_to_interval, context)
+
+
+def build_query_slice(env, args, context):
+  return QueryTaskSlice(env, " ".join(args), context)
+
+
+# the context is resolved from env if it is not given, as for each request to the slice server
+def build_slice(env, name, args, context = None):
+  slices = {
+    "all": build_all_slice,
+    "future": build_future_slice,
+    "terms": build_terms_slice,
+    "tags": build_tags_slice,
+    "review": build_review_slice,
+    "query": build_query_slice,
+  }
+
+  if name not in slices:
+    usage()
+    sys.exit(1)
+
+  return slices[name](env, args, context)
+
+
+# returns the todo files that the args cover, the args of the slice itself, and the context to run the slice in
+# 'done' before the slice covers done.txt as well as todo.txt, and shows completed tasks as if the filter were disabled
+def parse_files_args(env, args, context):
+  if len(args) > 0 and args[0] == "done":
+    context = (context if context is not None else RunContext.resolve(env))._replace(disable_filter = True)
+    return [env.todo_file_path(), env.done_file_path()], args[1:], context
+  return [env.todo_file_path()], args, context
+
+
+# returns the page given by --limit N and --offset N at the start of args, as SliceEditor takes it, and the rest of args
+def parse_page_args(args):
+  options = {"--offset": 0, "--limit": None}
+  while len(args) > 0 and args[0] in options:
+    value = args[1] if len(args) > 1 else ""
+    if not value.isdigit():
+      log.error("Expected a number after %s: %s" % (args[0], value))
+      sys.exit(1)
+    options[args[0]] = int(value)
+    args = args[2:]
+  if options["--offset"] == 0 and options["--limit"] is None:
+    return None, args
+  return (options["--offset"], options["--limit"]), args
+
+
+# builds the slice given by args, and loads it into an editor from the store, or else from the todo files that it covers
+# returns the editor, and the store or files to save its merged tasks with, which are open until stack exits
+def open_slice(env, args, stack, store = None, context = None):
+  page, args = parse_page_args(args)
+  paths, slice_args, context = parse_files_args(env, args, context)
+  if len(slice_args) < 1:
+    usage()
+    sys.exit(1)
+
+  task_slice = build_slice(env, slice_args[0], slice_args[1:], context)
+
+  # the store only holds todo.txt
+  if store is None or len(paths) > 1:
+    store = stack.enter_context(TaskFiles(env, paths))
+  return store.editor(task_slice, page), store
+
+
+# with a store, the tasks are taken from it rather than loaded, as the slice server does
+def export_slice(env, args, store = None, context = None):
+  path = "-"
+  if len(args) >= 2 and args[0] == "-o":
+    path = args[1]
+    args = args[2:]
+
+  if len(args) < 1:
+    usage()
+    sys.exit(1)
+
+  if store is None and len(env.slice_socket()) > 0:
+    output = forward_to_server(env, "export", args, "")
+    env.write_lines(path, output.splitlines())
+    return
+
+  with contextlib.ExitStack() as stack:
+    editor, store = open_slice(env, args, stack, store, context)
+    editor.export(path, args)
+
+
+def apply_slice(env, args, store = None, context = None):
+  if len(args) > 1:
+    usage()
+    sys.exit(1)
+
+  path = args[0] if len(args) > 0 else "-"
+  edited_lines = env.read_lines(path)
+
+  if store is None and len(env.slice_socket()) > 0:
+    output = forward_to_server(env, "apply", [], "".join(line + "\n" for line in edited_lines))
+    env.write_lines("-", output.splitlines())
+    return
+
+  header = SliceEditor.read_export_header(edited_lines)
+  if header is None:
+    log.error("Expected a slice written by 'slice export', which starts with its slice and checksum.")
+    sys.exit(1)
+  slice_args, checksum = header
+
+  with contextlib.ExitStack() as stack:
+    editor, store = open_slice(env, slice_args, stack, store, context)
+
+    if editor.checksum() != checksum:
+      log.error("The tasks in the slice have changed in todo.txt since it was exported. Export it again.")
+      sys.exit(1)
+
+    edited_tasks = dict(Task.iter_all(env, path, allow_comments = True, lines = edited_lines))
+    merged_tasks = editor.merge(edited_tasks)
+    store.save(editor, merged_tasks)
+
+
+# appends the changes of a merge to the journal, before they are saved, so that 'slice undo' can revert them
+# changes maps the path of each file to the (line number, line before, line after) of each change, where None is no line
+def journal_changes(env, comments, changes, undoes = None):
+  if len(changes) == 0:
+    return
+  entry = {"time": datetime.now().isoformat(timespec = "seconds"), "slice": "; ".join(comments), "files": changes}
+  if undoes is not None:
+    entry["undoes"] = undoes
+  env.append_journal(entry)
+
+
+# returns the entries kept when the first dropped entries of the journal are dropped, numbered from 1 again, as 'slice log' and 'slice undo' number them
+# an undo of an entry that was dropped refers to no entry, so that it is still not undone itself
+def trim_journal(entries, dropped):
+  trimmed = []
+  for entry in entries:
+    if "undoes" in entry:
+      undoes = max(entry["undoes"] - dropped, 0)
+      entry = dict(entry, undoes = undoes, slice = "undo %d" % undoes if undoes > 0 else "undo")
+    trimmed.append(entry)
+  return trimmed
+
+
+# returns the lines with the given changes reverted, and the changes that reverting made, as journal_changes takes them
+# lines that were added or edited are found by their content, in case other lines have moved since
+# those that have changed since are left as they are, and deleted lines are restored where they were
+def revert_changes(lines, changes, preserve_line_numbers):
+  lines = list(lines)
+  reverted = []
+
+  for line_id, before, after in changes:
+    if after is None:
+      continue
+    i = line_id - 1 if line_id <= len(lines) and lines[line_id - 1] == after else next((i for i, line in enumerate(lines) if line == after), None)
+    if i is None:
+      log.warning("Cannot undo the change to line %d, as it has changed since: %s" % (line_id, after))
+      continue
+    lines[i] = before
+    reverted.append((i + 1, after, before))
+
+  for line_id, before, after in sorted(change for change in changes if change[2] is None):
+    if preserve_line_numbers and line_id <= len(lines) and lines[line_id - 1] == "":
+      lines[line_id - 1] = before
+    else:
+      line_id = min(line_id, len(lines) + 1)
+      lines.insert(line_id - 1, before)
+    reverted.append((line_id, None, before))
+
+  # lines that were added are removed, as they would have been by deleting their tasks
+  lines = [line if line is not None else "" for line in lines if line is not None or preserve_line_numbers]
+  while len(lines) > 0 and lines[-1] == "":
+    lines.pop()
+  return lines, reverted
+
+
+# reverts the changes of journal entry N, or of the last entry that has not been undone
+# undoing an undo applies the changes it reverted again
+def undo_changes(env, args):
+  if len(args) > 1:
+    usage()
+    sys.exit(1)
+
+  entries = env.read_journal()
+  undone = {entry["undoes"] for entry in entries if "undoes" in entry}
+  if len(args) > 0:
+    try:
+      number = int(args[0])
+    except ValueError:
+      number = 0
+    if not 1 <= number <= len(entries):
+      log.error("There is no change %s in the journal. See 'slice log'." % args[0])
+      sys.exit(1)
+  else:
+    numbers = [number for number, entry in enumerate(entries, 1) if "undoes" not in entry and number not in undone]
+    if len(numbers) == 0:
+      log.error("Nothing to undo.")
+      sys.exit(1)
+    number = numbers[-1]
+
+  entry = entries[number - 1]
+  with contextlib.ExitStack() as stack:
+    reverted_lines = {}
+    changes = {}
+    for path, file_changes in entry["files"].items():
+      stack.enter_context(env.lock_file(path))
+      reverted_lines[path], changes[path] = revert_changes(env.read_lines(path), file_changes, env.preserve_line_numbers())
+
+    journal_changes(env, ["undo %d" % number], changes, undoes = number)
+    for path, lines in reverted_lines.items():
+      env.write_lines(path, lines)
+
+  for path, file_changes in changes.items():
+    max_id_len = len(str(max([line_id for line_id, before, after in file_changes], default = 0)))
+    for line_id, before, after in file_changes:
+      env.print_diff(line_id, max_id_len, Task.parse(before) if before else None, Task.parse(after) if after else None)
+  env.flush_diffs()
+
+
+# lists the entries of the journal, or shows the changes of journal entry N
+def show_log(env, args):
+  if len(args) > 1:
+    usage()
+    sys.exit(1)
+
+  entries = env.read_journal()
+  if len(args) == 0:
+    undone_by = {entry["undoes"]: number for number, entry in enumerate(entries, 1) if "undoes" in entry}
+    lines = []
+    for number, entry in enumerate(entries, 1):
+      changes = [change for file_changes in entry["files"].values() for change in file_changes]
+      counts = ", ".join("%d %s" % (count, name) for count, name in [
+          (sum(1 for line_id, before, after in changes if before is not None and after is not None), "edited"),
+          (sum(1 for line_id, before, after in changes if before is None), "added"),
+          (sum(1 for line_id, before, after in changes if after is None), "deleted"),
+          ] if count > 0)
+      undone = " (undone by %d)" % undone_by[number] if number in undone_by else ""
+      lines.append("%d  %s  %s: %s%s" % (number, entry["time"].replace("T", " "), entry["slice"], counts, undone))
+    env.write_lines("-", lines)
+    return
+
+  try:
+    number = int(args[0])
+  except ValueError:
+    number = 0
+  if not 1 <= number <= len(entries):
+    log.error("There is no change %s in the journal. See 'slice log'." % args[0])
+    sys.exit(1)
+  for path, file_changes in entries[number - 1]["files"].items():
+    env.write_lines("-", [path])
+    max_id_len = len(str(max([line_id for line_id, before, after in file_changes], default = 0)))
+    for line_id, before, after in file_changes:
+      env.print_diff(line_id, max_id_len, Task.parse(before) if before else None, Task.parse(after) if after else None)
+    env.flush_diffs()
+
+
+# serves export and apply requests on a unix socket, so that scripts running slice many times
+# only pay for loading the todo file once, and for parsing the lines that change between requests
+# each request and response is a line of JSON
+class SliceServer:
+  def __init__(self, env, socket_path):
+    self.env = env
+    self.socket_path = socket_path
+    self.store = TaskStore(env, env.todo_file_path())
+
+  # returns a socket listening on the socket path, replacing a socket left behind by a server that is no longer running
+  # exits if a server is still running there, rather than taking its socket over
+  def listen(self):
+    import socket
+    if os.path.exists(self.socket_path):
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+          client.connect(self.socket_path)
+        except OSError:
+          os.unlink(self.socket_path)
+        else:
+          log.error("A slice server is already running at %s" % self.socket_path)
+          sys.exit(1)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      server.bind(self.socket_path)
+      server.listen()
+    except BaseException:
+      server.close()
+      raise
+    return server
+
+  # the socket is removed when the server stops, including when a service manager stops it with SIGTERM
+  def serve_forever(self):
+    import json
+    import signal
+    import threading
+    server = self.listen()
+    # SIGTERM stops the server as Ctrl-C does, which handle does not catch as it would SystemExit
+    def stop(signum, frame):
+      raise KeyboardInterrupt
+    if threading.current_thread() is threading.main_thread():
+      signal.signal(signal.SIGTERM, stop)
+    try:
+      while True:
+        connection, address = server.accept()
+        # requests are handled one at a time, so that applies never overlap
+        # a client that sends a bad request or goes away only ends its own connection
+        # the responses are sent unbuffered, so closing the connection never raises, e.g. while stopping
+        try:
+          with connection, connection.makefile("rb") as f:
+            for request_line in f:
+              try:
+                request = json.loads(request_line)
+                if not isinstance(request, dict):
+                  raise ValueError("expected an object")
+              except ValueError as e:
+                response = {"error": "Invalid request: %s" % e}
+              else:
+                response = self.handle(request)
+              connection.sendall(json.dumps(response).encode("utf-8") + b"\n")
+        except OSError as e:
+          log.warning("Lost connection to a slice client: %s" % e)
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.close()
+      os.unlink(self.socket_path)
+
+  # runs the command of the request as export_slice or apply_slice would, with input as stdin
+  # returns its exit status and stdout, and the messages it logged
+  def handle(self, request):
+    import io
+    self.env.stdin = io.StringIO(request.get("input", ""))
+    self.env.stdout = io.StringIO()
+    status = 0
+    # usage is printed rather than written to env.stdout
+    with capture_log(logging.WARNING) as records, contextlib.redirect_stdout(self.env.stdout):
+      try:
+        commands = {"export": export_slice, "apply": apply_slice}
+        if request.get("command") not in commands:
+          log.error("Unknown command: %s" % request.get("command"))
+          sys.exit(1)
+        commands[request["command"]](self.env, list(request.get("args", [])), self.store)
+      except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+      except Exception as e:
+        log.exception("Failed to handle request: %s" % e)
+        status = 1
+    return {
+        "status": status,
+        "output": self.env.stdout.getvalue(),
+        "messages": [(record.levelno, record.getMessage()) for record in records],
+        }
+
+
+# collects the records logged while in the context
+@contextlib.contextmanager
+def capture_log(level):
+  records = []
+  handler = logging.Handler(level)
+  handler.emit = records.append
+  log.addHandler(handler)
+  try:
+    yield records
+  finally:
+    log.removeHandler(handler)
+
+
+# sends a command to the slice server, logging its messages and exiting if it failed
+# returns the output of the command, which is written to stdout if it failed (e.g. usage)
+def forward_to_server(env, command, args, input):
+  socket_path = env.slice_socket()
+  import json
+  import socket
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+    try:
+      client.connect(socket_path)
+    except OSError as e:
+      log.error("Could not connect to the slice server at %s: %s" % (socket_path, e))
+      sys.exit(1)
+    with client.makefile("rwb") as f:
+      f.write(json.dumps({"command": command, "args": args, "input": input}).encode("utf-8") + b"\n")
+      f.flush()
+      response = json.loads(f.readline())
+  if "error" in response:
+    log.error("The slice server could not handle the request: %s" % response["error"])
+    sys.exit(1)
+  for level, message in response["messages"]:
+    log.log(level, message)
+  if response["status"] != 0:
+    env.write_lines("-", response["output"].splitlines())
+    sys.exit(response["status"])
+  return response["output"]
+
+
+def serve(env, args):
+  socket_path = args[0] if len(args) > 0 else env.slice_socket()
+  if len(args) > 1 or len(socket_path) == 0:
+    usage()
+    sys.exit(1)
+  SliceServer(env, socket_path).serve_forever()
+
+
+def main(env, args):
+  if len(args) < 2:
+    usage()
+    sys.exit(1)
+
+  action_name = args[1]
+  action_args = args[2:]
+
+  if action_name == "usage":
+    usage()
+    sys.exit(0)
+
+  if len(action_args) < 1:
+    usage()
+    sys.exit(1)
+
+  with instrumented(env):
+    run_action(env, action_args)
+
+
+def run_action(env, action_args):
+  # the server resolves a context for each request instead, as it runs for longer than a day
+  if action_args[0] == "serve":
+    serve(env, action_args[1:])
+    return
+
+  if action_args[0] == "undo":
+    undo_changes(env, action_args[1:])
+    return
+  if action_args[0] == "log":
+    show_log(env, action_args[1:])
+    return
+
+  context = RunContext.resolve(env)
+
+  # export and apply split editing into two steps, so scripts can edit slices without an editor
+  if action_args[0] == "export":
+    export_slice(env, action_args[1:], context = context)
+    return
+  if action_args[0] == "apply":
+    apply_slice(env, action_args[1:], context = context)
+    return
+
+  with contextlib.ExitStack() as stack:
+    editor, files = open_slice(env, action_args, stack, context = context)
+    merged_tasks = editor.edit_and_merge()
+    files.save(editor, merged_tasks)
+
+
+# the entry point of the slice launcher
+def run():
+  h = logging.StreamHandler(sys.stderr)
+  h.setLevel(logging.WARN)
+  log.addHandler(h)
+  main(TodoEnv(), sys.argv)
+
+
+if __name__ == "__main__":
+  run()
+
@@ -1,17 +1,23 @@
 #!/usr/bin/env python3
 from contextlib import contextmanager
-from datetime import date
-import imp
+from datetime import date, datetime
+import importlib.util
 import logging
+import operator
 import os.path
+import re
+import tempfile
 import unittest
+from unittest import mock
+
+import slice
 
-slice = imp.load_source("slice", "slice")
 AbstractTodoEnv = slice.AbstractTodoEnv
 Tag = slice.Tag
 ContextTag = slice.ContextTag
 ProjectTag = slice.ProjectTag
 KeyValueTag = slice.KeyValueTag
+Task = slice.Task
 
 
 @contextmanager
@@ -120,6 +126,19 @@ class VirtualTodoEnv(AbstractTodoEnv, unittest.TestCase):
       self.assertFalse(self.__todo_file_path_written, msg = "Expected todo file to be untouched")
 
 
+class ColorDiffTest(unittest.TestCase):
+  def test_diff_shows_both_lines(self):
+    for a, b in [("", "(A) a @c"), ("a @c", ""), ("x 2000-01-01 a  b @c", "x 2000-01-02 a b +p @c")]:
+      expected = ["1 " + line for line in [a, b] if len(line) > 0] + ["", ""]
+      self.assertEqual(expected, re.sub("\033\\[[0-9]+m", "", slice.ColorDiff.diff("1 ", a, b)).split("\n"))
+
+  def test_diff_colors_changed_characters(self):
+    red, green, default = "\033[31m", "\033[32m", "\033[0m"
+    a_line, b_line, _, _ = slice.ColorDiff.diff("", "a t:2000-01-01 b", "a t:2000-01-02 c b").split("\n")
+    self.assertIn("t:2000-01-0%s1%s b" % (red, default), a_line)
+    self.assertIn("t:2000-01-0%s2 c%s b" % (green, default), b_line)
+
+
 class TagTest(unittest.TestCase):
   def test_join_tokens(self):
     a = ContextTag("a")
@@ -156,6 +175,8 @@ class TagTest(unittest.TestCase):
   def __test_join_tokens(self, tokens, expected):
     result = Tag.join_tokens(tokens)
     self.assertEqual(expected, result, msg = "Expected Tag.join_tokens(%s) to equal '%s'" % (tokens, expected))
+    normalized = Tag.normalize_tokens(tokens)
+    self.assertEqual(Tag.tokenize(expected), normalized, msg = "Expected Tag.normalize_tokens(%s) to equal Tag.tokenize('%s')" % (tokens, expected))
 
   def test_sort_edge_tags(self):
     c = ContextTag("c")
@@ -188,6 +209,291 @@ class TagTest(unittest.TestCase):
     result = Tag.sort_edge_tags(tokens, trailing)
     self.assertEqual(expected, result, msg = "Expected Tag.sort_edge_tags(%s) to equal '%s'" % (tokens, expected))
 
+  def test_tokenize(self):
+    c = ContextTag("c")
+    p = ProjectTag("p")
+    self.assertEqual([], Tag.tokenize(""))
+    self.assertEqual([" \t "], Tag.tokenize(" \t "))
+    self.assertEqual([c, " x ", p], Tag.tokenize("@c x +p"))
+    self.assertEqual([" ", KeyValueTag("a", "b:c"), " "], Tag.tokenize(" a:b:c "))
+    self.assertEqual([KeyValueTag("http://x", "y")], Tag.tokenize("http://x:y"))
+    self.assertEqual(["@ + k: :v http://x x@y"], Tag.tokenize("@ + k: :v http://x x@y"))
+    self.assertEqual([ContextTag("a:b"), "\u00a0", ProjectTag("+")], Tag.tokenize("@a:b\u00a0++"))
+
+  # compares tokenize with the regex that defines tags, over random strings of the characters that matter
+  def test_tokenize_matches_regex(self):
+    import random
+    rng = random.Random(0)
+    alphabet = ["@", "+", ":", "/", "//", "a", "b", " ", "\t", "\u00a0", "\u3000"]
+    for _ in range(20000):
+      raw = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+      self.assertEqual(Tag.tokenize_with_regex(raw), Tag.tokenize(raw), msg = "Tokens of %r" % raw)
+
+  def test_parse(self):
+    self.assertEqual(ContextTag("c"), Tag.parse("@c"))
+    self.assertEqual(KeyValueTag("a", "b:c"), Tag.parse("a:b:c"))
+    for raw in ["", "@", "x", "@c d", " @c", "k:", "k://x"]:
+      with self.assertRaises(ValueError, msg = raw):
+        Tag.parse(raw)
+
+
+class TaskTest(unittest.TestCase):
+  def test_derived_data(self):
+    task = Task.parse("(A) 2000-01-01 x @c +p t:2000-01-02 due:2000-01-03")
+    self.assertEqual({ContextTag("c"), ProjectTag("p"), KeyValueTag("t", "2000-01-02"), KeyValueTag("due", "2000-01-03")}, task.tags)
+    self.assertEqual(date(2000, 1, 2), task.start_date)
+    self.assertEqual(date(2000, 1, 3), task.due_date)
+
+  def test_derived_data_without_tags(self):
+    task = Task.parse("x 2000-01-01 http://example.com")
+    self.assertEqual(set(), task.tags)
+    self.assertIsNone(task.start_date)
+    self.assertIsNone(task.due_date)
+
+  def test_from_tokens(self):
+    tokens = ["\tx  ", ContextTag("c"), " ", " ", KeyValueTag("t", "2000-01-02"), "y "]
+    task = Task.from_tokens(tokens, slice.Priority("A"), date(2000, 1, 1), None)
+    self.assertEqual(Task.parse("(A) 2000-01-01 x  @c t:2000-01-02 y"), task)
+    self.assertEqual(Tag.tokenize(task.title), task.tokens)
+    self.assertEqual(date(2000, 1, 2), task.start_date)
+
+  def test_record_round_trip(self):
+    for line in ["x 2000-01-02 (A) 2000-01-01 x @c +p t:2000-01-02 due:2000-01-03", "(_) y", "z http://example.com"]:
+      task = Task.parse(line)
+      record_task = Task.from_record(task.to_record())
+      self.assertEqual(task, record_task)
+      self.assertEqual(task.tokens, record_task.tokens)
+      self.assertEqual(task.priority.explicit, record_task.priority.explicit)
+      self.assertEqual(task.start_date, record_task.start_date)
+      self.assertEqual(task.due_date, record_task.due_date)
+
+  def test_priorities_and_tags_shared(self):
+    a = Task.parse("(A) a @c k:v")
+    b = Task.parse("(A) b @c k:v")
+    self.assertIs(a.priority, b.priority)
+    self.assertIs(slice.Priority("A"), a.priority)
+    self.assertIsNot(slice.Priority(None), slice.Priority(None, True))
+    for tag_a, tag_b in zip(sorted(a.tags, key = str), sorted(b.tags, key = str)):
+      self.assertIs(tag_a, tag_b)
+
+  def test_shared_tags_bounded(self):
+    with mock.patch.object(Tag, "_Tag__shared_tags", {}), mock.patch.object(Tag, "_Tag__max_shared_tags", 2):
+      for line in ["a @a +b", "b @c", "c @d +e"]:
+        self.assertEqual(sorted(line.split()[1:]), sorted(str(tag) for tag in Task.parse(line).tags))
+        self.assertLessEqual(len(Tag._Tag__shared_tags), 2)
+      # the tags seen since the others were forgotten are still shared
+      self.assertIs(next(iter(Task.parse("d +e").tags)), next(iter(Task.parse("e +e").tags)))
+
+  def test_invalid_key_value_date(self):
+    task = Task.parse("x t:2000-13-01")
+    self.assertIsNone(task.start_date)
+
+  # dates are parsed without strptime, but must validate identically
+  def test_key_value_date_parsed_like_strptime(self):
+    for date_str in ["2000-01-02", "2000-1-2", "2000-02-30", "2000-00-01", "0000-01-01", "0999-12-31", "2000-01-0x", "20000-01-01", "2000-01-01x", "2000/01/01", "+200-01-01", "2000-+1-01", "２０００-01-01"]:
+      try:
+        expected = datetime.strptime(date_str, "%Y-%m-%d").date()
+      except ValueError:
+        expected = None
+      task = Task.parse("x t:%s" % date_str)
+      self.assertEqual(expected, task.start_date, msg = "Expected t:%s to be parsed as %s" % (date_str, expected))
+
+  def test_records_only_made_when_caching(self):
+    with tempfile.TemporaryDirectory() as dir_path:
+      path = os.path.join(dir_path, "todo.txt")
+      with open(path, "wb") as f:
+        f.write(b"a\n(A) b @c\n")
+      environ = {"TODO_DIR": dir_path, "TODO_FILE": path, "DONE_FILE": os.path.join(dir_path, "done.txt")}
+      for cache, expect_records in [("0", False), ("1", True)]:
+        with mock.patch.dict(os.environ, dict(environ, TODOTXT_SLICE_CACHE = cache)):
+          env = slice.TodoEnv()
+          with mock.patch.object(Task, "to_record", autospec = True, side_effect = Task.to_record) as to_record:
+            tasks, other_lines, max_id = Task.load_matching(env, path, lambda task: True, False, cached = True)
+          self.assertEqual(2, len(tasks))
+          self.assertEqual(expect_records, to_record.called)
+          self.assertEqual(expect_records, os.path.exists(os.path.join(dir_path, ".slice-cache")))
+
+  def test_cache_of_file_replaced_while_loading(self):
+    with tempfile.TemporaryDirectory() as dir_path:
+      path = os.path.join(dir_path, "todo.txt")
+      with open(path, "w") as f:
+        f.write("old a\nold b\n")
+      environ = {"TODO_DIR": dir_path, "TODO_FILE": path, "DONE_FILE": os.path.join(dir_path, "done.txt"), "TODOTXT_SLICE_CACHE": "1"}
+      with mock.patch.dict(os.environ, environ):
+        env = slice.TodoEnv()
+        with env.open_lines(path) as lines:
+          with open(path + ".new", "w") as f:
+            f.write("new a\nnew b\n")
+          os.replace(path + ".new", path)
+          tasks, other_lines, max_id = Task.load_matching(env, path, lambda task: True, False, cached = True, lines = lines)
+          self.assertEqual(["old a", "old b"], [task.line for task in tasks.values()])
+        # the cache is of the old lines, so is not used for the new ones
+        self.assertEqual(["new a", "new b"], [task.line for task in Task.load_all(env, path, cached = True).values()])
+
+  def test_parse_in_parallel_only_if_file_unchanged(self):
+    with tempfile.TemporaryDirectory() as dir_path:
+      path = os.path.join(dir_path, "todo.txt")
+      with open(path, "w") as f:
+        f.write("old a\nold b\n")
+      with mock.patch.dict(os.environ, {"TODOTXT_SLICE_JOBS": "2"}), mock.patch.object(slice.TodoEnv, "_TodoEnv__min_lines_to_parse_in_parallel", 1):
+        env = slice.TodoEnv()
+        with env.open_lines(path) as lines:
+          self.assertEqual([(1, Task.parse("old a").to_record()), (2, Task.parse("old b").to_record())], env.parse_records_in_parallel(path, lines, False))
+          with open(path + ".new", "w") as f:
+            f.write("new a\nnew b\n")
+          os.replace(path + ".new", path)
+          self.assertIsNone(env.parse_records_in_parallel(path, lines, False))
+
+  def test_parse_records_of_byte_range(self):
+    with tempfile.TemporaryDirectory() as dir_path:
+      path = os.path.join(dir_path, "todo.txt")
+      with open(path, "wb") as f:
+        f.write(b"a\r\n(A) b @c\n\nd t:2000-01-01\n# e\n")
+      expected = [(2, Task.parse("(A) b @c").to_record()), (4, Task.parse("d t:2000-01-01").to_record())]
+      self.assertEqual(expected, Task.parse_records(path, 2, 3, 27, allow_comments = False))
+      self.assertEqual(expected, Task.parse_records(path, 2, 3, 31, allow_comments = True))
+      self.assertIsNone(Task.parse_records(path, 2, 3, 31, allow_comments = False))
+
+
+class TaskIndexTest(unittest.TestCase):
+  todo = ["(A) a @c +p", "(B) b @c", "c +p k:v", "x 2000-01-01 (A) d @c", "Abc @d", "http://example.com/abc"]
+
+  def test_candidate_ids(self):
+    index = slice.TaskIndex(self.__load_tasks())
+    self.assertEqual({1, 2, 4}, index.ids_with_tag(ContextTag("c")))
+    self.assertEqual({3, 5, 6}, index.ids_with_level(None))
+    self.assertEqual({5, 6}, index.ids_maybe_containing("ABC"))
+    self.assertIsNone(index.ids_maybe_containing("ab"))
+    self.assertEqual({1, 4}, slice.TaskIndex.intersect([index.ids_with_tag(ContextTag("c")), index.ids_with_level("A"), None]))
+
+  def test_index_does_not_change_slice(self):
+    env = VirtualTodoEnv(True, self.todo, [], [], self.todo, True, {}, set())
+    tasks = self.__load_tasks()
+    index = slice.TaskIndex(tasks)
+    for name, args in [("all", []), ("terms", ["abc"]), ("terms", ["a", "-c"]), ("tags", ["@c"]), ("tags", ["A", "+p"]), ("tags", ["_"]),
+        ("query", ["pri<=B", "or", "+p"]), ("query", ["abc", "-@c"]), ("query", ["not", "(@c", "or", "k:v)"])]:
+      task_slice = slice.build_slice(env, name, args[:])
+      expected = slice.SliceEditor(env, tasks, task_slice).editable_tasks
+      result = slice.SliceEditor(env, tasks, task_slice, index = index).editable_tasks
+      self.assertEqual(expected, result, msg = "Expected index to not change slice: %s %s" % (name, args))
+
+  def test_query_planner(self):
+    env = VirtualTodoEnv(True, self.todo, [], [], self.todo, True, {}, set())
+    task_slice = slice.build_slice(env, "query", ["k>v", "abc", "@c", "pri=A"])
+    self.assertEqual([slice.QueryPriorityClause, slice.QueryTagClause, slice.QueryTermClause, slice.QueryCompareClause], [type(clause) for clause in task_slice.clause.clauses])
+    self.assertEqual(set(), task_slice.candidate_ids(slice.TaskIndex(self.__load_tasks())))
+    task_slice = slice.build_slice(env, "query", ["pri<B", "or", "@d"])
+    self.assertEqual({1, 4, 5}, task_slice.candidate_ids(slice.TaskIndex(self.__load_tasks())))
+
+  def test_update(self):
+    tasks = self.__load_tasks()
+    index = slice.TaskIndex(tasks)
+    self.assertEqual({1, 2, 4}, index.ids_with_tag(ContextTag("c")))
+    self.assertEqual({5, 6}, index.ids_maybe_containing("abc"))
+    old_task = tasks.pop(2)
+    index.update(2, old_task, None)
+    tasks[7] = Task.parse("abcd @c")
+    index.update(7, None, tasks[7])
+    self.assertEqual({1, 4, 7}, index.ids_with_tag(ContextTag("c")))
+    self.assertEqual({5, 6, 7}, index.ids_maybe_containing("abc"))
+    self.assertEqual({1, 3, 4, 5, 6, 7}, index.ids_with_level(None) | index.ids_with_level("A"))
+
+  # compares the slices selected by the columns, with and without NumPy, with those matched task by task
+  def test_columns_select_like_tasks(self):
+    import random
+    rng = random.Random(0)
+    days = ["1999-12-01", "1999-12-25", "1999-12-31", "2000-01-01", "2000-01-02", "2000-02-01"]
+    def random_line():
+      parts = []
+      if rng.random() < 0.2:
+        parts.append("x " + rng.choice(days))
+      parts.append(rng.choice(["", "(A)", "(B)", "(C)", "(_)"]))
+      parts.append(rng.choice(["", rng.choice(days)]))
+      parts.append("task")
+      for tag in ["@c", "+p", "t:" + rng.choice(days + ["bad"]), "due:" + rng.choice(days)]:
+        if rng.random() < 0.3:
+          parts.append(tag)
+      return " ".join(part for part in parts if part)
+    todo = [random_line() if rng.random() < 0.9 else "" for i in range(300)]
+    slices = [("all", []), ("future", []), ("review", []), ("tags", ["@c"]), ("tags", ["A", "+p", "@c"]), ("tags", ["_"]), ("terms", ["task"])]
+
+    for disable_filter in ["0", "1"]:
+      export = {"TODOTXT_DISABLE_FILTER": disable_filter, "TODOTXT_SLICE_REVIEW_INTERVALS": "A:1,B:10,_:5"}
+      env = VirtualTodoEnv(True, todo, [], [], todo, True, export, set())
+      for use_numpy in [True, False]:
+        tasks = {id: Task.parse(line) for id, line in enumerate(todo, 1) if line}
+        index = slice.TaskIndex(tasks, use_numpy = use_numpy)
+        for step in range(2):
+          for name, args in slices:
+            task_slice = slice.build_slice(env, name, args[:])
+            with self.assertLogs("slice", logging.WARNING) as expected_logs:
+              slice.log.warning("-")
+              expected = slice.SliceEditor(env, tasks, task_slice).editable_tasks
+            with self.assertLogs("slice", logging.WARNING) as result_logs:
+              slice.log.warning("-")
+              result = slice.SliceEditor(env, tasks, task_slice, index = index).editable_tasks
+            msg = "Expected columns to not change slice: %s %s (disable filter %s, numpy %s, step %d)" % (name, args, disable_filter, use_numpy, step)
+            self.assertEqual(expected, result, msg = msg)
+            self.assertEqual(sorted(expected_logs.output), sorted(result_logs.output), msg = msg)
+          # the columns are updated along with the index
+          for id in rng.sample(range(1, 400), 50):
+            old_task = tasks.pop(id, None)
+            new_task = Task.parse(random_line()) if rng.random() < 0.8 else None
+            if new_task is not None:
+              tasks[id] = new_task
+            index.update(id, old_task, new_task)
+
+  # test_columns_select_like_tasks falls back to the pure Python columns without NumPy, so this checks NumPy is used where installed
+  @unittest.skipUnless(importlib.util.find_spec("numpy") is not None, "NumPy is not installed")
+  def test_numpy_columns_select_like_python_columns(self):
+    import numpy
+    todo = ["(A) 1999-12-01 a t:2000-01-02", "(B) b due:2000-01-01", "x 2000-01-01 1999-12-31 c", "", "2000-01-02 d", "(C) e"]
+    tasks = {id: Task.parse(line) for id, line in enumerate(todo, 1) if line}
+    numpy_columns = slice.TaskColumns(tasks)
+    python_columns = slice.TaskColumns(tasks, use_numpy = False)
+    today = date(2000, 1, 1).toordinal()
+    cutoffs = [today - level for level in range(slice.TaskColumns.level_code("Z") + 1)]
+    for select in [
+        lambda columns: columns.where("complete_dates", operator.ne, 0),
+        lambda columns: columns.where("start_dates", operator.gt, today),
+        lambda columns: columns.where("create_dates", operator.le, cutoffs),
+        lambda columns: columns.with_levels([0, 1]),
+        lambda columns: columns.with_ids([2, 5]),
+        lambda columns: columns.any([columns.with_levels([2]), columns.invert(columns.with_ids([1, 2]))]),
+        lambda columns: columns.everything(),
+        ]:
+      mask = select(numpy_columns)
+      self.assertIsInstance(mask, numpy.ndarray)
+      self.assertEqual(python_columns.ids(select(python_columns)), numpy_columns.ids(mask))
+
+  def __load_tasks(self):
+    return {i + 1: Task.parse(line) for i, line in enumerate(self.todo)}
+
+
+class LineTableTest(unittest.TestCase):
+  def test_lines_split_like_read_lines(self):
+    for data in [b"", b"\n", b"a", b"a\nb", b"a\nb\n", b"a\r\n\r\nb\r\n", b"\xc3\xa9 a\n\n"]:
+      lines = slice.LineTable.build(data)
+      self.assertEqual(data.decode("utf-8").splitlines(), list(lines), msg = "Expected lines of %s" % data)
+
+  def test_spans_exclude_line_endings(self):
+    lines = slice.LineTable.build(b"ab\r\n\ncd")
+    self.assertEqual([(0, 2), (4, 4), (5, 7)], [lines.span(i) for i in range(len(lines))])
+    self.assertEqual(b"cd", lines.raw(2))
+
+  def test_other_line_boundaries_not_supported(self):
+    for data in [b"a\rb", b"a\x0cb", b"a\xe2\x80\xa8b"]:
+      self.assertIsNone(slice.LineTable.build(data))
+
+  def test_line_selection(self):
+    selection = slice.LineSelection(["a", "b", "c"])
+    selection.add(3)
+    selection.add(1)
+    self.assertEqual([1, 3], list(selection.keys()))
+    self.assertEqual("c", selection[3])
+    self.assertNotIn(2, selection)
+    self.assertRaises(KeyError, lambda: selection[2])
+
 
 class AbstractSliceTest:
   action_name = "slice"
@@ -526,6 +832,23 @@ class AbstractSliceAllTest(AbstractSliceTest):
         export = {"TODOTXT_PRESERVE_LINE_NUMBERS": "0"}
         )
 
+  def test_untouched_task_not_rewritten(self):
+    self.run_test(
+        todo0 = ["(A)  a", "b"],
+        edit0 = ["(A) i:1 a", "i:2 b"],
+        edit1 = ["(A) i:1 a", "i:2 c"],
+        todo1 = ["(A)  a", "c"]
+        )
+
+  def test_untouched_task_rewritten_when_not_preserving_line_numbers(self):
+    self.run_test(
+        todo0 = ["(A)  a", "b"],
+        edit0 = ["(A) i:1 a", "i:2 b"],
+        edit1 = ["(A) i:1 a", "i:2 c"],
+        todo1 = ["(A) a", "c"],
+        export = {"TODOTXT_PRESERVE_LINE_NUMBERS": "0"}
+        )
+
   def test_leading_tag_order_not_normalized_if_no_other_edits(self):
     self.run_test(
         todo0 = ["k:v +p @c x"],
@@ -681,6 +1004,79 @@ class SliceTermsTest(AbstractSliceAllTest, unittest.TestCase):
         )
 
 
+class SliceQueryTest(AbstractSliceAllTest, unittest.TestCase):
+  slice_name = "query"
+  export = {}
+
+  def test_comment_header(self):
+    self.run_test(
+        slice_args = ["x", "or", "@c"],
+        todo0 = [],
+        edit0 = ["# Tasks matching query: x or @c", ""],
+        edit1 = [],
+        todo1 = [],
+        strip_edit0_comments = False
+        )
+
+  def test_match_tags_terms_and_priority(self):
+    self.run_test(
+        slice_args = ["pri<=B", "@c", "-x"],
+        todo0 = ["(A) a @c", "(B) b @c x", "(C) c @c", "d @c", "(A) e"],
+        edit0 = ["(A) i:1 a @c"]
+        )
+
+  def test_match_or_and_parentheses(self):
+    self.run_test(
+        slice_args = ["(pri=_", "or", "+p)", "and", "not", "one"],
+        todo0 = ["(A) one +p", "(A) two +p", "three", "one", "(B) four"],
+        edit0 = ["(A) i:2 two +p", "i:3 three"]
+        )
+
+  def test_match_dates_relative_to_today(self):
+    self.run_test(
+        slice_args = ["due<=today+1", "created>=1999-12-31"],
+        todo0 = ["1999-12-31 a due:2000-01-02", "1999-12-30 b due:2000-01-01", "2000-01-01 c due:2000-01-03", "2000-01-01 d"],
+        edit0 = ["i:1 a due:2000-01-02"]
+        )
+
+  def test_match_key_value_as_number(self):
+    self.run_test(
+        slice_args = ["est>=5"],
+        todo0 = ["a est:10", "b est:3", "c est:x", "d"],
+        edit0 = ["i:1 a est:10"]
+        )
+
+  def test_sorted_by_field(self):
+    self.run_test(
+        slice_args = ["sort:due"],
+        todo0 = ["a", "b due:2000-01-03", "c due:2000-01-02"],
+        edit0 = ["i:3 c due:2000-01-02", "i:2 b due:2000-01-03", "i:1 a"]
+        )
+
+  def test_sorted_by_create_date(self):
+    self.run_test(
+        slice_args = ["sort:created"],
+        todo0 = ["a", "1999-12-31 b", "1999-12-30 c"],
+        edit0 = ["i:3 c", "i:2 b", "i:1 a"]
+        )
+
+  def test_parse_error(self):
+    for args in [["(a", "or"], ["-sort:due"], ["not", "sort:due"], ["(sort:due)"], ["()"], ["a", "()"], ["b", "or", "sort:due"], ["or", "b"], ["b", "or"]]:
+      self.run_test(
+          slice_args = args,
+          expect_clean_exit = False,
+          expect_warnings = True,
+          todo0 = []
+          )
+
+  def test_sort_with_group(self):
+    self.run_test(
+        slice_args = ["sort:due", "(a", "or", "b)"],
+        todo0 = ["a", "b due:2000-01-03", "c due:2000-01-02"],
+        edit0 = ["i:2 b due:2000-01-03", "i:1 a"]
+        )
+
+
 class SliceTagsTest(AbstractSliceAllTest, unittest.TestCase):
   slice_name = "tags"
   export = {}
@@ -817,6 +1213,26 @@ class SliceTagsTest(AbstractSliceAllTest, unittest.TestCase):
         todo1 = ["x", "(A) y @c +p k:v", "(A) a +q"]
         )
 
+  def test_edit_task_with_unsliced_tasks_not_preserving_line_numbers(self):
+    self.run_test(
+        slice_args = ["@c"],
+        todo0 = ["x", "", "a @c", "y"],
+        edit0 = ["i:3 a"],
+        edit1 = ["i:3 b"],
+        todo1 = ["x", "b @c", "y"],
+        export = {"TODOTXT_PRESERVE_LINE_NUMBERS": "0"}
+        )
+
+  def test_unsliced_tasks_written_verbatim_when_not_preserving_line_numbers(self):
+    self.run_test(
+        slice_args = ["@c"],
+        todo0 = ["(A)  x", "a @c", "x 2000-01-01  y"],
+        edit0 = ["i:2 a"],
+        edit1 = ["i:2 b"],
+        todo1 = ["(A)  x", "b @c", "x 2000-01-01  y"],
+        export = {"TODOTXT_PRESERVE_LINE_NUMBERS": "0"}
+        )
+
   # regression test
   def test_edit_task_explicitly_readding_hidden_tag(self):
     self.run_test(
@@ -1045,6 +1461,577 @@ class SliceFutureTest(AbstractSliceTest, unittest.TestCase):
         )
 
 
+# holds files in memory, so that slices can be exported and applied in separate runs
+class FilesTodoEnv(AbstractTodoEnv):
+  def __init__(self, todo, done = []):
+    AbstractTodoEnv.__init__(self, {
+        "TODO_DIR": "TODO",
+        "TODO_FILE": "TODO/todo.txt",
+        "DONE_FILE": "TODO/done.txt",
+        "EDITOR": "EDITOR",
+        "TODOTXT_DATE_ON_ADD": "0",
+        "TODOTXT_PRESERVE_LINE_NUMBERS": "1",
+        "TODOTXT_DISABLE_FILTER": "0",
+        })
+    self.files = {"TODO/todo.txt": todo, "TODO/done.txt": done}
+    self.journal = []
+
+  def today(self):
+    return date(2000, 1, 1)
+
+  def read_lines(self, path):
+    return self.files[path]
+
+  def write_lines(self, path, lines):
+    self.files[path] = list(lines)
+
+  def print_diff(self, id, max_id_len, task_a, task_b):
+    pass
+
+  # the entries are stored as JSON would return them
+  def append_journal(self, entry):
+    import json
+    self.journal.append(json.loads(json.dumps(entry)))
+
+  def read_journal(self):
+    return self.journal
+
+
+# a TodoEnv of a todo.txt with the given bytes in a temporary directory, for the tests of reading and writing real files
+# the environment that todo.sh would set is patched in while it is used, with the given settings added to it
+@contextmanager
+def disk_todo_env(todo = b"", **environ):
+  with tempfile.TemporaryDirectory() as dir_path:
+    path = os.path.join(dir_path, "todo.txt")
+    with open(path, "wb") as f:
+      f.write(todo)
+    environ = dict({"TODO_DIR": dir_path, "TODO_FILE": path, "DONE_FILE": os.path.join(dir_path, "done.txt"), "EDITOR": "true",
+        "TODOTXT_DATE_ON_ADD": "0", "TODOTXT_PRESERVE_LINE_NUMBERS": "1", "TODOTXT_DISABLE_FILTER": "0"}, **environ)
+    with mock.patch.dict(os.environ, environ):
+      env = slice.TodoEnv()
+      env.print_diff = lambda id, max_id_len, task_a, task_b: None
+      yield env
+
+
+class SliceExportApplyTest(unittest.TestCase):
+  def test_export_and_apply(self):
+    env = FilesTodoEnv(["a +p", "b", "c +p"])
+    slice.main(env, ["dummy.py", "slice", "export", "-o", "slice.txt", "tags", "+p"])
+    exported = env.files["slice.txt"]
+    self.assertEqual("# slice: tags +p", exported[0])
+    self.assertTrue(exported[1].startswith("# checksum: "))
+    self.assertEqual(["i:1 a", "i:3 c"], [line for line in exported if not line.startswith("#") and line != ""])
+
+    env.files["edited.txt"] = exported[:-2] + ["i:3 d", "e"]
+    slice.main(env, ["dummy.py", "slice", "apply", "edited.txt"])
+    self.assertEqual(["", "b", "d +p", "e +p"], env.files["TODO/todo.txt"])
+
+  def test_apply_fails_if_slice_changed(self):
+    env = FilesTodoEnv(["a +p", "b"])
+    slice.main(env, ["dummy.py", "slice", "export", "-o", "slice.txt", "tags", "+p"])
+    env.files["TODO/todo.txt"] = ["a +p", "b +p"]
+    with capture(logging.getLogger("slice"), logging.WARN) as warnings:
+      with self.assertRaises(SystemExit):
+        slice.main(env, ["dummy.py", "slice", "apply", "slice.txt"])
+    self.assertEqual(1, len(warnings))
+    self.assertEqual(["a +p", "b +p"], env.files["TODO/todo.txt"])
+
+  def test_apply_after_unrelated_line_added(self):
+    env = FilesTodoEnv(["a +p", "b"])
+    slice.main(env, ["dummy.py", "slice", "export", "-o", "slice.txt", "tags", "+p"])
+    env.files["TODO/todo.txt"] = ["a +p", "b", "c"]
+    env.files["edited.txt"] = [line for line in env.files["slice.txt"] if line.startswith("#")] + ["i:1 a2", "d"]
+    slice.main(env, ["dummy.py", "slice", "apply", "edited.txt"])
+    self.assertEqual(["a2 +p", "b", "c", "d +p"], env.files["TODO/todo.txt"])
+
+  def test_apply_fails_without_header(self):
+    env = FilesTodoEnv(["a"])
+    env.files["edited.txt"] = ["i:1 b"]
+    with capture(logging.getLogger("slice"), logging.WARN) as warnings:
+      with self.assertRaises(SystemExit):
+        slice.main(env, ["dummy.py", "slice", "apply", "edited.txt"])
+    self.assertEqual(1, len(warnings))
+    self.assertEqual(["a"], env.files["TODO/todo.txt"])
+
+
+class SlicePageTest(unittest.TestCase):
+  def test_export_and_apply_page(self):
+    env = FilesTodoEnv(["e", "b", "d", "a", "c"])
+    slice.main(env, ["dummy.py", "slice", "export", "-o", "slice.txt", "--limit", "2", "--offset", "1", "all"])
+    exported = env.files["slice.txt"]
+    self.assertEqual("# slice: --limit 2 --offset 1 all", exported[0])
+    self.assertEqual(["# Page of tasks 2-3 of 5", ""], exported[-4:-2])
+    self.assertEqual(["i:2 b", "i:3 d"], exported[-2:])
+
+    # d, in the page, is deleted, but the tasks outside the page are not
+    env.files["edited.txt"] = exported[:-2] + ["i:2 b2", "f"]
+    slice.main(env, ["dummy.py", "slice", "apply", "edited.txt"])
+    self.assertEqual(["e", "b2", "", "a", "c", "f"], env.files["TODO/todo.txt"])
+
+  def test_page_matches_sorted_slice(self):
+    env = FilesTodoEnv(["(%s) 1999-12-%02d task %d t:2000-01-%02d" % ("ABC"[i % 3], 31 - i % 7, i, 2 + i % 20) for i in range(50)])
+    for args in [["future"], ["all"], ["query", "sort:t"], ["query", "sort:created"]]:
+      with slice.TaskFiles(env, ["TODO/todo.txt"]) as files:
+        expected = list(files.editor(slice.build_slice(env, args[0], args[1:])).sorted_editable_tasks.values())
+      for offset, limit in [(0, 10), (45, 10), (7, None), (60, 5)]:
+        with slice.TaskFiles(env, ["TODO/todo.txt"]) as files:
+          editor = files.editor(slice.build_slice(env, args[0], args[1:]), page = (offset, limit))
+          self.assertEqual(expected[offset:offset + limit if limit else None], list(editor.sorted_editable_tasks.values()))
+
+  def test_page_sorted_by_create_date(self):
+    env = FilesTodoEnv(["1999-12-%02d task %d" % (31 - i, i) for i in range(5)])
+    with slice.TaskFiles(env, ["TODO/todo.txt"]) as files:
+      editor = files.editor(slice.build_slice(env, "query", ["sort:created"]), page = (1, 2))
+    self.assertEqual(["i:4 task 3", "i:3 task 2"], [task.line for task in editor.sorted_editable_tasks.values()])
+
+  def test_invalid_limit(self):
+    env = FilesTodoEnv(["a"])
+    with capture(logging.getLogger("slice"), logging.WARN) as warnings:
+      with self.assertRaises(SystemExit):
+        slice.main(env, ["dummy.py", "slice", "export", "--limit", "x", "all"])
+    self.assertEqual(1, len(warnings))
+
+
+class TaskFilesTest(unittest.TestCase):
+  def test_export_and_apply_done(self):
+    todo = ["a report", "b", "c report"]
+    done = ["x 1999-01-01 d report", "x 1999-01-02 e"]
+    env = FilesTodoEnv(todo, done)
+    slice.main(env, ["dummy.py", "slice", "export", "-o", "slice.txt", "done", "terms", "report"])
+    exported = env.files["slice.txt"]
+    self.assertEqual("# slice: done terms report", exported[0])
+    # the tasks of done.txt follow those of todo.txt, from the next power of ten
+    self.assertEqual(["i:01 a report", "i:03 c report"], [line for line in exported if line.startswith("i:")])
+    self.assertEqual("x 1999-01-01 i:11 d report", exported[-1])
+
+    # only the file whose tasks changed is written, and new tasks are added to todo.txt
+    env.files["edited.txt"] = exported[:-1] + ["x 1999-01-01 i:11 d report 2", "f report"]
+    slice.main(env, ["dummy.py", "slice", "apply", "edited.txt"])
+    self.assertEqual(["x 1999-01-01 d report 2", "x 1999-01-02 e"], env.files["TODO/done.txt"])
+    self.assertEqual(["a report", "b", "c report", "f report"], env.files["TODO/todo.txt"])
+
+    slice.main(env, ["dummy.py", "slice", "export", "-o", "slice.txt", "done", "terms", "report"])
+    env.files["edited.txt"] = [line for line in env.files["slice.txt"] if not line.startswith("x ")]
+    todo = env.files["TODO/todo.txt"]
+    slice.main(env, ["dummy.py", "slice", "apply", "edited.txt"])
+    self.assertEqual(["", "x 1999-01-02 e"], env.files["TODO/done.txt"])
+    self.assertIs(todo, env.files["TODO/todo.txt"])
+
+  def test_missing_done_file(self):
+    with disk_todo_env(b"a report\nb\n", TODOTXT_SLICE_CACHE = "1", TODOTXT_SLICE_JOURNAL = "0") as env:
+      slice_path = os.path.join(env.todo_dir_path(), "slice.txt")
+      slice.main(env, ["dummy.py", "slice", "export", "-o", slice_path, "done", "terms", "report"])
+      exported = env.read_lines(slice_path)
+      self.assertEqual(["", "i:01 a report"], [line for line in exported if not line.startswith("#")])
+      env.write_lines(slice_path, exported[:-1] + ["i:01 a report 2", "c report"])
+      slice.main(env, ["dummy.py", "slice", "apply", slice_path])
+      self.assertEqual(["a report 2", "b", "c report"], env.read_lines(env.todo_file_path()))
+      self.assertFalse(os.path.exists(env.done_file_path()))
+
+  def test_locate(self):
+    env = FilesTodoEnv(["a"] * 99, ["x b"] * 5)
+    with slice.TaskFiles(env, ["TODO/todo.txt", "TODO/done.txt"]) as files:
+      editor = files.editor(slice.build_slice(env, "terms", []))
+      self.assertEqual(105, editor.max_id)
+      self.assertEqual((0, 99), files.locate(99))
+      self.assertEqual((1, 1), files.locate(101))
+      self.assertEqual((1, 5), files.locate(105))
+      self.assertEqual((0, 101), files.locate(107))
+
+
+class ConcurrentSaveTest(unittest.TestCase):
+  # loads the slice of tasks with "a" from todo, lets concurrent_todo be written meanwhile, then saves the edited slice
+  def __save(self, todo, concurrent_todo, edited, preserve_line_numbers = False):
+    env = FilesTodoEnv(todo)
+    env.preserve_line_numbers = lambda: preserve_line_numbers
+    with slice.TaskFiles(env, ["TODO/todo.txt"]) as files:
+      editor = files.editor(slice.build_slice(env, "terms", ["a"]))
+      env.files["TODO/todo.txt"] = concurrent_todo
+      merged_tasks = editor.merge({id: Task.parse(line) for id, line in enumerate(edited, 1)})
+      files.save(editor, merged_tasks)
+    return env.files["TODO/todo.txt"]
+
+  def test_unchanged_file_saved_as_before(self):
+    self.assertEqual(["a1 x", "b", "a3"], self.__save(["a1", "b", "a3"], ["a1", "b", "a3"], ["i:1 a1 x", "i:3 a3"]))
+
+  def test_lines_added_meanwhile_kept(self):
+    self.assertEqual(["a1 x", "b", "c", "a2"], self.__save(["a1", "b"], ["a1", "b", "c"], ["i:1 a1 x", "a2"]))
+    self.assertEqual(["a1 x", "b", "c", "a2"], self.__save(["a1", "b"], ["a1", "b", "c"], ["i:1 a1 x", "a2"], preserve_line_numbers = True))
+
+  def test_changes_merged_by_line_when_lines_move(self):
+    self.assertEqual(["c", "b", "a3 x"], self.__save(["a1", "b", "a3"], ["c", "b", "a3"], ["i:1 a1", "i:3 a3 x"]))
+    self.assertEqual(["c", "a3 x"], self.__save(["a1", "b", "a3"], ["c", "a1", "a3"], ["i:3 a3 x"]))
+    self.assertEqual(["c", "", "b", "x"], self.__save(["a1", "b", "a3"], ["c", "a1", "b", "a3"], ["x"], preserve_line_numbers = True))
+
+  def test_lines_changed_meanwhile_kept_with_edits(self):
+    with self.assertLogs("slice", logging.WARNING) as logs:
+      self.assertEqual(["a1 y", "b", "a1 x"], self.__save(["a1", "b"], ["a1 y", "b"], ["i:1 a1 x"]))
+    self.assertIn("Task 1 has been changed by someone else", logs.output[0])
+    with self.assertLogs("slice", logging.WARNING):
+      self.assertEqual(["a1 y", "b"], self.__save(["a1", "b"], ["a1 y", "b"], []))
+
+  def test_repeated_lines_matched_in_large_file(self):
+    todo = ["a"] * 150 + ["u%d" % i for i in range(100)]
+    expected = ["b"] + ["a"] * 4 + ["a x"] + ["a"] * 145 + ["u%d" % i for i in range(1, 100)]
+    with capture(logging.getLogger("slice"), logging.WARN) as warnings:
+      self.assertEqual(expected, self.__save(todo, ["b"] + todo[:150] + todo[151:], ["i:%03d a" % id if id != 5 else "i:005 a x" for id in range(1, 151)]))
+    self.assertEqual([], [warning.getMessage() for warning in warnings])
+
+  def test_patch_lines_replaces_file(self):
+    with disk_todo_env(b"a\nb\n") as env:
+      path = env.todo_file_path()
+      with env.open_lines(path) as lines:
+        with env.lock_file(path):
+          env.patch_lines(path, {1: "c"})
+        # the lines already loaded are not changed under a concurrent slice
+        self.assertEqual(["a", "b"], list(lines))
+      self.assertEqual(["c", "b"], env.read_lines(path))
+
+  def test_lines_kept_when_file_rewritten_in_place(self):
+    with disk_todo_env(b"a\nb\n") as env:
+      path = env.todo_file_path()
+      with env.open_lines(path) as lines:
+        # as by an editor or a shell redirect, which truncate the file and write it again
+        for data in [b"", b"c\n", b"longer d\ne\nf\n"]:
+          with open(path, "r+b") as f:
+            f.truncate(0)
+            f.write(data)
+          self.assertEqual(["a", "b"], list(lines))
+          self.assertEqual("b", lines[1])
+
+  def test_merged_into_file_rewritten_in_place(self):
+    with disk_todo_env(b"alpha +p\nbravo\ncharlie +p\n", TODOTXT_SLICE_JOURNAL = "0") as env:
+      path = env.todo_file_path()
+      with slice.TaskFiles(env, [path]) as files:
+        editor = files.editor(slice.build_slice(env, "tags", ["+p"]))
+        with open(path, "r+") as f:
+          f.write("zulu inserted\nalpha +p\nbravo\ncharlie +p\n")
+        with capture(logging.getLogger("slice"), logging.WARN) as warnings:
+          merged_tasks = editor.merge({1: Task.parse("i:1 alpha"), 2: Task.parse("i:3 charlie edited")})
+          files.save(editor, merged_tasks)
+        self.assertEqual([], [warning.getMessage() for warning in warnings])
+      self.assertEqual(["zulu inserted", "alpha +p", "bravo", "charlie edited +p"], env.read_lines(path))
+
+  def test_replace_follows_symlink(self):
+    with disk_todo_env() as env:
+      path = env.todo_file_path()
+      os.mkdir(os.path.join(env.todo_dir_path(), "real"))
+      real_path = os.path.join(env.todo_dir_path(), "real", "todo.txt")
+      with open(real_path, "wb") as f:
+        f.write(b"a\nb\n")
+      os.remove(path)
+      os.symlink(real_path, path)
+      env.write_lines(path, ["c", "b"])
+      env.patch_lines(path, {2: "d"})
+      self.assertTrue(os.path.islink(path))
+      self.assertEqual(["c", "d"], env.read_lines(real_path))
+      self.assertEqual([], [name for name in os.listdir(env.todo_dir_path()) if name.startswith(".")])
+
+class JournalTest(unittest.TestCase):
+  def test_undo_and_redo(self):
+    env = FilesTodoEnv(["a +p", "b", "c +p", "d +p"])
+    slice.main(env, ["dummy.py", "slice", "export", "-o", "slice.txt", "tags", "+p"])
+    env.files["edited.txt"] = [line for line in env.files["slice.txt"] if line.startswith("#")] + ["i:1 a2", "i:4 d", "e"]
+    slice.main(env, ["dummy.py", "slice", "apply", "edited.txt"])
+    applied = ["a2 +p", "b", "", "d +p", "e +p"]
+    self.assertEqual(applied, env.files["TODO/todo.txt"])
+    self.assertEqual([[1, "a +p", "a2 +p"], [3, "c +p", None], [5, None, "e +p"]], env.journal[0]["files"]["TODO/todo.txt"])
+
+    # tasks added meanwhile are kept
+    env.files["TODO/todo.txt"] = applied + ["f"]
+    slice.main(env, ["dummy.py", "slice", "undo"])
+    self.assertEqual(["a +p", "b", "c +p", "d +p", "", "f"], env.files["TODO/todo.txt"])
+    self.assertEqual(1, env.journal[1]["undoes"])
+    with self.assertRaises(SystemExit), self.assertLogs("slice", logging.ERROR):
+      slice.main(env, ["dummy.py", "slice", "undo"])
+
+    slice.main(env, ["dummy.py", "slice", "undo", "2"])
+    self.assertEqual(applied + ["f"], env.files["TODO/todo.txt"])
+
+    output = []
+    env.write_lines = lambda path, lines: output.extend(lines)
+    slice.main(env, ["dummy.py", "slice", "log"])
+    self.assertEqual(3, len(output))
+    self.assertTrue(output[0].startswith("1  "))
+    self.assertTrue(output[0].endswith("Tasks with tags: +p: 1 edited, 1 added, 1 deleted (undone by 2)"), output[0])
+    self.assertTrue(output[1].endswith("undo 1: 1 edited, 1 added, 1 deleted (undone by 3)"), output[1])
+
+  def test_undo_after_conflicting_save(self):
+    env = FilesTodoEnv(["a1", "b", "a2"])
+    with slice.TaskFiles(env, ["TODO/todo.txt"]) as files:
+      editor = files.editor(slice.build_slice(env, "terms", ["a"]))
+      env.files["TODO/todo.txt"] = ["a1 y", "b", "a2 z"]
+      merged_tasks = editor.merge({1: Task.parse("i:1 a1 x")})
+      with self.assertLogs("slice", logging.WARNING):
+        files.save(editor, merged_tasks)
+    self.assertEqual(["a1 y", "b", "a2 z", "a1 x"], env.files["TODO/todo.txt"])
+    self.assertEqual([[4, None, "a1 x"]], env.journal[0]["files"]["TODO/todo.txt"])
+
+    slice.main(env, ["dummy.py", "slice", "undo"])
+    self.assertEqual(["a1 y", "b", "a2 z"], env.files["TODO/todo.txt"])
+
+  def test_revert_changes_after_lines_moved(self):
+    changes = [[1, "a", "a2"], [3, "c", None], [4, None, "e"]]
+    # without preserved line numbers, the deleted line was removed and the added one has moved
+    lines, reverted = slice.revert_changes(["a2", "b", "x", "e"], changes, preserve_line_numbers = False)
+    self.assertEqual(["a", "b", "c", "x"], lines)
+    with self.assertLogs("slice", logging.WARNING):
+      lines, reverted = slice.revert_changes(["a3", "b", "", "e"], changes, preserve_line_numbers = True)
+    self.assertEqual(["a3", "b", "c"], lines)
+    self.assertEqual([(4, "e", None), (3, None, "c")], reverted)
+
+  def test_journal_keeps_last_entries(self):
+    with disk_todo_env(TODOTXT_SLICE_JOURNAL_SIZE = "3") as env:
+      for i in range(1, 5):
+        env.append_journal({"time": "t", "slice": "s%d" % i, "files": {}})
+      self.assertEqual(["s2", "s3", "s4"], [entry["slice"] for entry in env.read_journal()])
+      env.append_journal({"time": "t", "slice": "undo 1", "files": {}, "undoes": 1})
+      env.append_journal({"time": "t", "slice": "undo 2", "files": {}, "undoes": 2})
+      entries = env.read_journal()
+
+    self.assertEqual(["s4", "undo", "undo 1"], [entry["slice"] for entry in entries])
+    self.assertEqual([0, 1], [entry["undoes"] for entry in entries[1:]])
+
+  def test_journal_lock_not_dotted_again(self):
+    with disk_todo_env() as env:
+      env.append_journal({"time": "t", "slice": "s", "files": {}})
+      self.assertEqual([".slice-journal", ".slice-journal.lock"], sorted(name for name in os.listdir(env.todo_dir_path()) if name.startswith(".")))
+
+class RunContextTest(unittest.TestCase):
+  def test_environment_looked_up_once_per_run(self):
+    env = FilesTodoEnv(["a", "b 2001-01-01 t:2001-01-01", "x 1999-01-01 c", "d"])
+    calls = []
+    for name in ["today", "disable_filter", "preserve_line_numbers", "date_on_add"]:
+      lookup = getattr(env, name)
+      setattr(env, name, lambda lookup = lookup, name = name: calls.append(name) or lookup())
+
+    slice.main(env, ["dummy.py", "slice", "export", "-o", "slice.txt", "all"])
+    self.assertEqual(["i:1 a", "i:4 d"], [line for line in env.files["slice.txt"] if line.startswith("i:")])
+    self.assertEqual(["today", "disable_filter", "preserve_line_numbers", "date_on_add"], calls)
+
+    calls.clear()
+    env.files["edited.txt"] = [line for line in env.files["slice.txt"] if line.startswith("#")] + ["i:1 a", "e", "f"]
+    slice.main(env, ["dummy.py", "slice", "apply", "edited.txt"])
+    self.assertEqual(["a", "b 2001-01-01 t:2001-01-01", "x 1999-01-01 c", "", "e", "f"], env.files["TODO/todo.txt"])
+    self.assertEqual(["today", "disable_filter", "preserve_line_numbers", "date_on_add"], calls)
+
+  def test_review_intervals_looked_up_once_per_run(self):
+    env = FilesTodoEnv(["a", "b"])
+    fallback = "Environment variable TODOTXT_SLICE_REVIEW_INTERVALS is not defined. Falling back to default: '_:0,A:1,B:7,C:56,Z:182'"
+
+    with capture(logging.getLogger("slice"), logging.WARN) as warnings:
+      slice.main(env, ["dummy.py", "slice", "export", "-o", "slice.txt", "review"])
+    self.assertIn("# Reviewable tasks (_:0,A:1,B:7,C:56,Z:182)", env.files["slice.txt"])
+    self.assertEqual([fallback], [warning.getMessage() for warning in warnings])
+
+    env.files["edited.txt"] = [line for line in env.files["slice.txt"] if line.startswith("#")] + ["i:1 a", "c"]
+    with capture(logging.getLogger("slice"), logging.WARN) as warnings:
+      slice.main(env, ["dummy.py", "slice", "apply", "edited.txt"])
+    self.assertEqual("Reviewable tasks (_:0,A:1,B:7,C:56,Z:182)", env.journal[0]["slice"])
+    self.assertEqual([fallback], [warning.getMessage() for warning in warnings])
+
+
+class SettingsTest(unittest.TestCase):
+  def test_slice_jobs(self):
+    self.assertEqual(1, slice.AbstractTodoEnv({}).slice_jobs())
+    self.assertEqual(4, slice.AbstractTodoEnv({"TODOTXT_SLICE_JOBS": "4"}).slice_jobs())
+    for value in ["auto", "", "0", "-2"]:
+      with capture(logging.getLogger("slice"), logging.WARN) as warnings:
+        with self.assertRaises(SystemExit):
+          slice.AbstractTodoEnv({"TODOTXT_SLICE_JOBS": value}).slice_jobs()
+      self.assertEqual(1, len(warnings))
+
+  def test_slice_journal_size(self):
+    self.assertEqual(100, slice.AbstractTodoEnv({}).slice_journal_size())
+    with capture(logging.getLogger("slice"), logging.WARN) as warnings:
+      with self.assertRaises(SystemExit):
+        slice.AbstractTodoEnv({"TODOTXT_SLICE_JOURNAL_SIZE": "0"}).slice_journal_size()
+    self.assertEqual(1, len(warnings))
+
+
+class InstrumentationTest(unittest.TestCase):
+  def test_stats_written_as_json(self):
+    import json
+    with tempfile.TemporaryDirectory() as dir_path:
+      stats_path = os.path.join(dir_path, "stats.json")
+      env = VirtualTodoEnv(True, ["a", "b"], ["i:1 a", "i:2 b"], ["i:1 c", "i:2 b"], ["c", "b"], True, {"TODOTXT_SLICE_STATS": stats_path}, set())
+      parse = Task.__dict__["parse"]
+      slice.main(env, ["dummy.py", "slice", "all"])
+      env.assert_success()
+      with open(stats_path) as f:
+        stats = json.load(f)
+
+    self.assertEqual(2, stats["functions"]["Task.load_all"]["calls"] + stats["functions"]["Task.load_matching"]["calls"])
+    self.assertEqual(1, stats["functions"]["editor"]["calls"])
+    self.assertEqual(1, stats["functions"]["SliceEditor.__merge_edited_tasks"]["calls"])
+    self.assertGreater(stats["task_allocations"], 0)
+    # the functions are restored after the run
+    self.assertIs(parse, Task.__dict__["parse"])
+    self.assertNotIn("subprocess_check_call", env.__dict__)
+
+  def test_stats_off_when_0(self):
+    with tempfile.TemporaryDirectory() as dir_path:
+      cwd = os.getcwd()
+      os.chdir(dir_path)
+      try:
+        env = VirtualTodoEnv(True, ["a"], ["i:1 a"], ["i:1 a"], ["a"], True, {"TODOTXT_SLICE_STATS": "0", "TODOTXT_SLICE_PROFILE": "0"}, set())
+        slice.main(env, ["dummy.py", "slice", "all"])
+        env.assert_success()
+      finally:
+        os.chdir(cwd)
+      self.assertEqual([], os.listdir(dir_path))
+
+
+class IncrementalParserTest(unittest.TestCase):
+  def test_only_new_lines_parsed(self):
+    parser = slice.IncrementalParser()
+    tasks = [parser.parse(line) for line in ["a @c", "b", "a @c"]]
+    self.assertEqual(2, parser.parse_count)
+    self.assertIs(tasks[0], tasks[2])
+
+    parser = slice.IncrementalParser(parser.parsed)
+    moved_tasks = [parser.parse(line) for line in ["c", "b", "a @c"]]
+    self.assertEqual(1, parser.parse_count)
+    self.assertIs(tasks[1], moved_tasks[1])
+    self.assertEqual({"c", "b", "a @c"}, set(parser.parsed.keys()))
+
+  def test_records(self):
+    parser = slice.IncrementalParser({"a @c": Task.parse("a @c").to_record()}, Task.from_record, Task.to_record)
+    self.assertEqual([Task.parse("a @c"), Task.parse("b")], [parser.parse("a @c"), parser.parse("b")])
+    self.assertEqual(1, parser.parse_count)
+    self.assertEqual(Task.parse("b").to_record(), parser.parsed["b"])
+
+
+class TaskStoreTest(unittest.TestCase):
+  def test_refresh_parses_changed_lines(self):
+    env = FilesTodoEnv(["a @c", "b", "c @c"])
+    store = slice.TaskStore(env, env.todo_file_path())
+    store.refresh()
+    tasks = dict(store.tasks)
+    self.assertEqual({1, 3}, store.index.ids_with_tag(ContextTag("c")))
+
+    env.files["TODO/todo.txt"] = ["a @c", "", "c @d", "d @c", ""]
+    store.refresh()
+    self.assertEqual([1, 3, 4], sorted(store.tasks.keys()))
+    self.assertIs(tasks[1], store.tasks[1])
+    self.assertEqual(Task.parse("c @d"), store.tasks[3])
+    self.assertEqual(4, store.max_id)
+    self.assertEqual({1, 4}, store.index.ids_with_tag(ContextTag("c")))
+
+  def test_refresh_reuses_moved_lines(self):
+    env = FilesTodoEnv(["a", "b @c", "c"])
+    store = slice.TaskStore(env, env.todo_file_path())
+    store.refresh()
+    tasks = dict(store.tasks)
+
+    env.files["TODO/todo.txt"] = ["b @c", "c", "d"]
+    store.refresh()
+    self.assertIs(tasks[2], store.tasks[1])
+    self.assertIs(tasks[3], store.tasks[2])
+    self.assertEqual({1}, store.index.ids_with_tag(ContextTag("c")))
+
+  def test_export_and_apply(self):
+    env = FilesTodoEnv(["a +p", "b", "c +p"])
+    store = slice.TaskStore(env, env.todo_file_path())
+    slice.export_slice(env, ["-o", "slice.txt", "tags", "+p"], store)
+    env.files["edited.txt"] = env.files["slice.txt"][:-2] + ["i:3 d", "e"]
+    slice.apply_slice(env, ["edited.txt"], store)
+    self.assertEqual(["", "b", "d +p", "e +p"], env.files["TODO/todo.txt"])
+
+    # the store sees its own changes
+    slice.export_slice(env, ["-o", "slice.txt", "tags", "+p"], store)
+    self.assertEqual(["i:3 d", "i:4 e"], [line for line in env.files["slice.txt"] if not line.startswith("#") and line != ""])
+
+
+class SliceServerTest(unittest.TestCase):
+  def test_listen_replaces_stale_socket(self):
+    import socket
+    with tempfile.TemporaryDirectory() as dir_path:
+      socket_path = os.path.join(dir_path, "slice.sock")
+      # a socket left behind by a server that was killed
+      stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      stale.bind(socket_path)
+      stale.close()
+      server = slice.SliceServer(FilesTodoEnv([]), socket_path).listen()
+      with server, socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+
+  def test_listen_refuses_running_server(self):
+    import socket
+    with tempfile.TemporaryDirectory() as dir_path:
+      socket_path = os.path.join(dir_path, "slice.sock")
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as running:
+        running.bind(socket_path)
+        running.listen()
+        with capture(logging.getLogger("slice"), logging.WARN) as warnings:
+          with self.assertRaises(SystemExit):
+            slice.SliceServer(FilesTodoEnv([]), socket_path).listen()
+        self.assertEqual(1, len(warnings))
+        self.assertTrue(os.path.exists(socket_path))
+
+  def test_socket_removed_on_sigterm(self):
+    import multiprocessing
+    import signal
+    import time
+    if "fork" not in multiprocessing.get_all_start_methods():
+      self.skipTest("needs fork")
+    with tempfile.TemporaryDirectory() as dir_path:
+      socket_path = os.path.join(dir_path, "slice.sock")
+      process = multiprocessing.get_context("fork").Process(target = slice.SliceServer(FilesTodoEnv([]), socket_path).serve_forever)
+      process.start()
+      deadline = time.monotonic() + 10
+      while not os.path.exists(socket_path) and time.monotonic() < deadline:
+        time.sleep(0.01)
+      self.assertTrue(os.path.exists(socket_path))
+      os.kill(process.pid, signal.SIGTERM)
+      process.join(10)
+      self.assertEqual(0, process.exitcode)
+      self.assertFalse(os.path.exists(socket_path))
+
+  def test_bad_requests_only_end_their_connection(self):
+    import json
+    import multiprocessing
+    import signal
+    import socket
+    import time
+    if "fork" not in multiprocessing.get_all_start_methods():
+      self.skipTest("needs fork")
+    with tempfile.TemporaryDirectory() as dir_path:
+      socket_path = os.path.join(dir_path, "slice.sock")
+      # the server logs the clients that go away, which would otherwise be printed to stderr
+      def serve():
+        slice.log.addHandler(logging.NullHandler())
+        slice.SliceServer(FilesTodoEnv([]), socket_path).serve_forever()
+      process = multiprocessing.get_context("fork").Process(target = serve)
+      process.start()
+      try:
+        deadline = time.monotonic() + 10
+        while not os.path.exists(socket_path) and time.monotonic() < deadline:
+          time.sleep(0.01)
+
+        def request(lines, read = True):
+          with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            with client.makefile("rwb") as f:
+              f.write(b"".join(lines))
+              f.flush()
+              return [json.loads(f.readline()) for line in lines] if read else None
+
+        responses = request([b"not json\n", b"[1]\n", b"\xff\n", json.dumps({"command": "nothing"}).encode("utf-8") + b"\n"])
+        self.assertEqual(["error", "error", "error"], [list(response.keys())[0] for response in responses[:3]])
+        self.assertEqual(1, responses[3]["status"])
+        # a client that goes away without reading its response
+        request([json.dumps({"command": "nothing"}).encode("utf-8") + b"\n"] * 100, read = False)
+        self.assertEqual(1, request([json.dumps({"command": "nothing"}).encode("utf-8") + b"\n"])[0]["status"])
+        self.assertTrue(process.is_alive())
+        os.kill(process.pid, signal.SIGTERM)
+        process.join(10)
+        self.assertEqual(0, process.exitcode)
+      finally:
+        if process.is_alive():
+          process.kill()
+
+
 if __name__ == "__main__":
   unittest.main()
 